@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 
 # IMPORT OF EXTERNAL LIBRARIES
+# urllib3, asyncio, concurrent.futures and the status server are imported where they are used, so console and
+# restapi runs from cron do not pay for loading them
 import os
 import sys
-import urllib3
+import signal
+import argparse
+import re
 import time
-import csv
 import json
-import serial
-import modbus_tk.defines as cst
-from modbus_tk import modbus_rtu
-from pathlib import Path
+import threading
 from simple_flock import SimpleFlock
+from modbus_broker import open_session, uses_broker, lock_file, BrokerSession
+from fleet import Unit, load_fleet, group_by_port
+from poll_scheduler import PollScheduler, activity
+from read_planner import ReadPlanner
+from history_upload import HistoryUploader, upload_failed
+from telemetry_spool import TelemetrySpool
+from status_publisher import StatusPublisher
+from csv_logger import CsvLogger
+from register_store import RegisterStore
+from water_meter import WaterCounter
+from snapshot import SnapshotWriter
+from metrics import Metrics
+from register_codec import BitfieldDecoder, RegisterCodec
+from sanitrax_registers import (modbus_keys, bstate, hstate, pstate, fstate, dstate, pump_fault_dict, register_groups,
+                                AntiFreeze_Status, Temperature, bitfield_registers, register_map)
 
 # Change directory to path of this file
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
@@ -20,370 +35,140 @@ os.chdir(os.path.dirname(os.path.realpath(__file__)))
 # PORT = '/dev/tty.usbmodem1411'
 # PORT = COM6
 PORT = '/dev/ttyUSB3'
+# Socket of the Modbus broker, the port is opened directly when the broker is not running
+BROKER_SOCKET = "/tmp/sanitrax_modbus.sock"
 proxy = '172.18.140.8:8080'
 proxy_dev = '172.18.140.8:8081'
-http = urllib3.PoolManager(timeout=urllib3.Timeout(connect=2.0, read=2.0), retries=urllib3.Retry(2, redirect=2))
+# Maximum number of HTTP requests in flight at the same time
+UPLOAD_PARALLEL = 4
+HTTP_RETRIES = 2
 # If started with this as the dbkey, json dumps will be put in /tmp to be read by the NI-Toolkit
 RESTAPI = "restapi"
+# Snapshot with all sections of the last cycle, written in RESTAPI mode. The per-section files in
+# RESTAPI_COMPAT_DIR are only written when RESTAPI_COMPAT_FILES is set.
+SNAPSHOT_FILE = "/tmp/sanitrax_snapshot.json"
+RESTAPI_COMPAT_DIR = "/tmp"
+RESTAPI_COMPAT_FILES = True
+# In daemon mode the decoded state is served over HTTP on this local port or Unix socket (None: not served)
+STATUS_PORT = None
+STATUS_SOCKET = None
+# Metrics of the serial bus, the uplink and the cycles, written after every cycle as a Prometheus textfile and as
+# JSON (None: not written). The JSON file is read back at start, so the counters continue across runs from cron.
+METRICS_PROM_FILE = "/tmp/sanitrax_metrics.prom"
+METRICS_JSON_FILE = "/tmp/sanitrax_metrics.json"
 # Where to find the output of the GPS script
 GPS_INPUT_FILE = "/tmp/gps_data.json"
 # LOCK FILE (to make sure this script only has 1 running instance
-LOCK_FILE = "/tmp/sanitrax_mb.lock"
+INSTANCE_LOCK_FILE = "/tmp/sanitrax_ctrl.lock"
+# The lock file of a serial port (see lock_file() in modbus_broker.py) is held during a cycle without the Modbus
+# broker, so the maintenance scripts (modbus_tool.py) and the broker can take the port between two daemon cycles.
 # Lock timeout in second
 LOCK_TIMEOUT = 5.0
-
-# Substructed raw value for correct scaling
-RAW_FACTOR = 4630
-# Raw values interval between equilevant -1 to 0 bars
-RAW_DIF = 14050
-
-# Raw value for 60 degrees (absence of calculation origin)
-RAW_TEMP_MAX = 10000
-RAW_TEMP_MIN = 0
-
-# Actual temperature value in Celsius degrees value equilavent to 8000
-TEMP_MAX = 100
-TEMP_MIN = -100
-
-# STRING TUPLES AND DICTIONARIES
-modbus_keys = ('mb_magic',  # Used for API version (R) and special functions (W)
-               'mb_hydrophore_postrun',  # Time to run after pressure has been reached
-               'mb_hydrophore_timeout',  # Maximum time to reach pressure
-               'mb_breaktank_delay',  # Delay for exiting error states in the breaktank
-               'mb_breaktank_fill_timeout',  # Maximum time for breaktank to go from empty to low
-               'mb_pump_start',  # Vacuum pressure value for pump start
-               'mb_pump_stop',  # Vacuum pressure value for pump stop
-               'mb_pump_throttle_start',  # Vacuum pressure value for pump to start throttling down
-               'mb_pump_throttle_stop',  # Vacuum pressure value for pump to stop throttling down
-               'mb_pump_timeout',  # Maximum time to reach vacuum pressure
-               'mb_pump_max_runtime',  # Maximum runtime at high power (fault if reached)
-               'mb_pump_max_temp',  # Maximum pump temperature
-               'mb_flush_start',  # Temperature value for flush valve open
-               'mb_flush_stop',  # Temperature value for flush valve close
-               'mb_flush_timeout',  # Maximum time to reach low temperature
-               'mb_antifreeze_dose_1',  # Dosing concentration in % when external_temp < temp_1, set by user
-               'mb_antifreeze_dose_2',  # Dosing concentration in % when external_temp < temp_2, set by user
-               'mb_antifreeze_dose_3',  # Dosing concentration in % when external_temp < temp_3, set by user
-               'mb_antifreeze_dose_4',  # Dosing concentration in % when external_temp < temp_4, set by user
-               'mb_antifreeze_dose_5',  # Dosing concentration in % when external_temp < temp_5, set by user
-               'mb_antifreeze_dose_manual',  # Manual dosing concentration in %
-               'mb_antifreeze_temp_1',  # temperature limit for low value
-               'mb_antifreeze_temp_2',  # temperature limit lower value
-               'mb_antifreeze_temp_3',  # temperature limit lower value
-               'mb_antifreeze_temp_4',  # temperature limit lower value
-               'mb_antifreeze_temp_5',  # temperature limit lowest value
-               'mb_dosingpump_factor',  # Dosing pump  capacity in liters per hour
-               'mb_watermeter_factor',  # Pulse per liter
-               'mb_reset_breaktank',  # Set to 1 for exiting timeout state
-               'mb_reset_hydrophore',  # Set to 1 for exiting timeout state
-               'mb_reset_pump_1',  # Set to 1 for reset procedure and or exit timeout state
-               'mb_reset_pump_2',  # Set to 1 for reset procedure and or exit timeout state
-               'mb_fault_mask',  # Can be changed to disable specific alarms from triggering main alarm
-               'mb_fault',  # 16-bit fault register
-               'mb_input_top',  # IO related
-               'mb_input_bottom',
-               'mb_output',
-               'mb_output_mask',
-               'mb_output_fault',
-               'mb_water_counter',  # Pulse counter
-               'mb_dose_counter',   # Dosing counter
-               'mb_current_dose',   # Current dosing percentage
-               'mb_pcb_temp',  # Temperature of onboard sensor x0.1 degrees Kelvin
-               'mb_external_temp',  # Environment temperature
-               'mb_external_temp_float_a',  # Part A of 32-bit float point value
-               'mb_external_temp_float_b',  # Part B of 32-bit float point value
-               'mb_bstate',  # Breaktank state
-               'mb_hstate',  # Hydrophore
-               'mb_p1state',  # Pump 1
-               'mb_p2state',  # Pump 2
-               'mb_f1state',  # Flush Valve 1
-               'mb_f2state',  # Flush Valve 2
-               'mb_dstate',   # Dose pump
-               'mb_p1_mbcode',  # Modbus error code for pump 1 (0 = OK)
-               'mb_p1_Pot',  # Pump variables
-               'mb_p1_Temp',
-               'mb_p1_Vac',
-               'mb_p1_State',
-               'mb_p1_Freq',
-               'mb_p1_PID',
-               'mb_p1_Fault',
-               'mb_p1_Status',
-               'mb_p1_Freq_Output',
-               'mb_p1_Freq_Ramp',
-               'mb_p1_Motor_Current',
-               'mb_p1_Motor_Torque',
-               'mb_p1_Ext_Status_Word',
-               'mb_p1_Mains_Volt',
-               'mb_p1_Motor_Volt',
-               'mb_p1_Drive_Therm_State',
-               'mb_p1_3210',
-               'mb_p1_Motor_Power',
-               'mb_p2_mbcode',  # Modbus error code for pump 2 (0 = OK)
-               'mb_p2_Pot',
-               'mb_p2_Temp',
-               'mb_p2_Vac',
-               'mb_p2_State',
-               'mb_p2_Freq',
-               'mb_p2_PID',
-               'mb_p2_Fault',
-               'mb_p2_Status',
-               'mb_p2_Freq_Output',
-               'mb_p2_Freq_Ramp',
-               'mb_p2_Motor_Current',
-               'mb_p2_Motor_Torque',
-               'mb_p2_Ext_Status_Word',
-               'mb_p2_Mains_Volt',
-               'mb_p2_Motor_Volt',
-               'mb_p2_Drive_Therm_State',
-               'mb_p2_3210',
-               'mb_p2_Motor_Power',
-               'mb_custom_run',  # Custom modbus command (R/W)
-               'mb_custom_slave',
-               'mb_custom_command',
-               'mb_custom_address',
-               'mb_custom_quantity',
-               'mb_custom_data0',
-               'mb_custom_data1',
-               'mb_custom_data2',
-               'mb_custom_data3',
-               'mb_custom_data4',
-               'mb_custom_data5',
-               'mb_custom_data6',
-               'mb_custom_data7',
-               'mb_custom_data8',
-               'mb_custom_data9',
-               'mb_custom_data10',
-               'mb_custom_data11',
-               'mb_custom_data12',
-               'mb_custom_data13',
-               'mb_custom_data14',
-               'mb_custom_data15')
-
-input_top_keys = ('DC_OK_12V',
-                  'DC_OK_24V',
-                  'Tank_Low',
-                  'Tank_Normal',
-                  'Tank_High',
-                  'Tank_Overflow',
-                  'Pressure_Switch',
-                  'Water_Counter',
-                  'Anti_Freeze',
-                  'Flush_Valve_2',
-                  'Flush_Valve_1',
-                  'Fill_Tank_Valve',
-                  'Dose_Switch_1',
-                  'Dose_Switch_2',
-                  'Hydrophore_OK',
-                  'Emergency_Stop_OK')
-
-input_bottom_keys = ('Vacuum_Pump_2_green',
-                     'Vacuum_Pump_2_red',
-                     'Vacuum_Pump_1_green',
-                     'Vacuum_Pump_1_red',
-                     'Hydrophore_Run',
-                     'Hydrophore_Red',
-                     'Alarm_Lamp',
-                     'Reset_Alarm',
-                     'Hydrophore_Manual',
-                     'Hydrophore_Auto',
-                     'Pump1_Manual',
-                     'Pump1_Auto',
-                     'Pump2_Manual',
-                     'Pump2_Auto',
-                     'Flush_Button_1',
-                     'Flush_Button_2')
-
-output_keys = ('b0',
-               'b1',
-               'b2',
-               'b3',
-               'Fill_Tank_Valve',
-               'Flush_Valve_1',
-               'Flush_Valve_2',
-               'Anti_Freeze',
-               'b8',
-               'Alarm_Lamp',
-               'Hydrophore_Red',
-               'Hydrophore_Run',
-               'Vacuum_Pump_1_red',
-               'Vacuum_Pump_1_green',
-               'Vacuum_Pump_2_red',
-               'Vacuum_Pump_2_green')
-
-fault_keys = ('Water_Supply_Error',
-              'Tank_Empty',
-              'Tank_Overflow',
-              'Hydrophore_Fail',
-              'Hydrophore_Timeout',
-              'Pump1_Comm_Error',
-              'Pump2_Comm_Error',
-              'Pump1_Fault',
-              'Pump2_Fault',
-              'Pump1_Timeout',
-              'Pump2_Timeout',
-              'Pump1_Overheat',
-              'Pump2_Overheat',
-              'Emergency_Stop',
-              'Dosing_Error',
-              'Temp_Sensor_Error')
-
-bstate = ('BREAKTANK_OFF',
-          'BREAKTANK_MANUAL',
-          'BREAKTANK_FAIL',
-          'BREAKTANK_AUTO_EMPTY',
-          'BREAKTANK_AUTO_LOW',
-          'BREAKTANK_AUTO_NORMAL',
-          'BREAKTANK_AUTO_HIGH',
-          'BREAKTANK_AUTO_OVERFLOW',
-          'BREAKTANK_AUTO_TIMEOUT')
-
-hstate = ('HYDROPHORE_OFF',
-          'HYDROPHORE_MANUAL',
-          'HYDROPHORE_FAIL',
-          'HYDROPHORE_AUTO_OFF',
-          'HYDROPHORE_AUTO_ON',
-          'HYDROPHORE_AUTO_POSTRUN',
-          'HYDROPHORE_AUTO_TIMEOUT')
-
-pstate = ('PUMP_OFF',
-          'PUMP_MANUAL',
-          'PUMP_FAIL',
-          'PUMP_AUTO_OFF',
-          'PUMP_AUTO_ON',
-          'PUMP_AUTO_TIMEOUT')
-
-fstate = ('FLUSH_OFF',
-          'FLUSH_MANUAL',
-          'FLUSH_AUTO_ON',
-          'FLUSH_AUTO_TIMEOUT')
-
-dstate = ('DOSE_OFF',
-          'DOSE_FIXED_OFF',
-          'DOSE_FIXED_ON',
-          'DOSE_AUTO_OFF',
-          'DOSE_AUTO_ON',
-          'DOSE_ALWAYS_ON',
-          'DOSE_ALWAYS_ON_PAUSE')
-
-pump_fault_dict = {'-3': 'Pump Overheat',
-                   '-2': 'Pump Timeout',
-                   '-1': 'No communication',
-                   '0': 'OK',
-                   '2': 'Control Eeprom (EEF1)',
-                   '3': 'Incorrect config. (CFF)',
-                   '4': 'Invalid config. (CFI)',
-                   '5': 'Modbus com. (SLF1)',
-                   '6': 'int. com.link (ILF)',
-                   '7': 'Com. network (CnF)',
-                   '8': 'External flt-LI/Bit (EPF1)',
-                   '9': 'Overcurrent (OCF)',
-                   '10': 'Precharge (CrF)',
-                   '11': 'Speed fdback loss (SPF)',
-                   '12': 'Load slipping (AnF)',
-                   '16': 'Drive overheat (OHF)',
-                   '17': 'Motor overload (OLF)',
-                   '18': 'Overbraking (ObF)',
-                   '19': 'Mains overvoltage (OSF)',
-                   '20': '1 output phase loss (OPF1)',
-                   '21': 'Input phase loss (PHF)',
-                   '22': 'Undervoltage (USF)',
-                   '23': 'Motor short circuit (SCF1)',
-                   '24': 'Overspeed (SOF)',
-                   '25': 'Auto-tuning (tnF)',
-                   '26': 'Rating error (InF1)',
-                   '27': 'PWR Calib. (InF2)',
-                   '28': 'Int.serial link (InF3)',
-                   '29': 'Int.Mfg area (InF4)',
-                   '30': 'Power Eeprom (EEF2)',
-                   '32': 'Ground short circuit (SCF3)',
-                   '33': '3out ph loss (OPF2)',
-                   '34': 'CAN com. (COF)',
-                   '35': 'Brake control (bLF)',
-                   '38': 'External fault com. (EPF2)',
-                   '41': 'Brake feedback (brF)',
-                   '42': 'PC com. (SLF2)',
-                   '44': 'Torque/current lim (SSF)',
-                   '45': 'HMI com. (SLF3)',
-                   '49': 'LI6=PTC probe (PtFL)',
-                   '50': 'PTC fault (OtFL)',
-                   '51': 'Internal- I measure (InF9)',
-                   '52': 'Internal-mains circuit (InFA)',
-                   '53': 'Internal- th. sensor (InFb)',
-                   '54': 'IGBT overheat (tJF)',
-                   '55': 'IGBT short circuit (SCF4)',
-                   '56': 'Motor short circuit (SCF5)',
-                   '58': 'Out. contact. stuck (FCF1)',
-                   '59': 'Out. contact. open. (FCF2)',
-                   '64': 'input contactor (LCF)',
-                   '67': 'IGBT desaturation (HdF)',
-                   '68': 'Internal-option (InF6)',
-                   '69': 'internal- CPU (InFE)',
-                   '71': 'AI3 4-20mA loss (LFF3)',
-                   '73': 'Cards pairing (HCF)',
-                   '76': 'Load fault (dLF)',
-                   '77': 'Bad conf (CFI2)',
-                   '99': 'Ch.sw. fault (CSF)',
-                   '100': 'Pr.Underload.Flt (ULF)',
-                   '101': 'Proc.Overload Flt (OLC)',
-                   '105': 'Angle error (ASF)',
-                   '107': 'Safety fault (SAFF)',
-                   '108': 'FB fault (FbE)',
-                   '109': 'FB stop flt. (FbES)'}
+# Default time between the start of two cycles in daemon mode (seconds)
+POLL_INTERVAL = 10.0
+# Adaptive polling in daemon mode (--adaptive): fast while a pump, the hydrophore or a breaktank timeout is active
+# or a fault is set, backing off to the slow heartbeat when the plant is idle (seconds)
+POLL_MIN_INTERVAL = 2.0
+POLL_MAX_INTERVAL = 300.0
+# In daemon firebase mode the actions from the app are delivered by a long-poll request that the proxy may hold
+# this many seconds (see action_subscription.py), a requested reset starts the next cycle at once (0: fetched
+# every cycle)
+ACTION_WAIT = 25.0
+# Number of cycles of history points that are uploaded together
+HISTORY_CYCLES = 1
+# Directory and maximum size of the spool for data that could not be uploaded
+SPOOL_DIR = "spool"
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+# Time in seconds per cycle after which no further spooled batch is replayed, the rest follows in later cycles
+SPOOL_REPLAY_BUDGET = 1.0
+# Maximum number of history points in one replayed batch, spooled records are not merged beyond it
+SPOOL_BATCH_POINTS = 5000
+# File with the last published status, the number of change-only publications between full publications and the
+# longest time in seconds between two writes of the file (it is also written at a full publication and at exit)
+STATUS_FILE = "LastStatus.json"
+STATUS_RESYNC_CYCLES = 60
+STATUS_PERSIST_INTERVAL = 3600.0
+# Rows of the CSV log are buffered until this many rows are waiting or this many seconds have passed
+LOG_FLUSH_ROWS = 60
+LOG_FLUSH_INTERVAL = 60.0
+# Format of the raw register log: "csv", "binary" (fixed-width records, see register_store.py) or "both"
+LOG_FORMAT = "csv"
+# Checkpoint of the water counter total, written every this many seconds or after this many pulses
+WATER_FILE = "WaterCounter.json"
+WATER_CHECKPOINT_INTERVAL = 300.0
+WATER_CHECKPOINT_DELTA = 1000
 
 gpsDict = {'Latitude': '',
            'Longitude': '',
            'Time': '',
            'Altitude': ''}
 
-
-Pump_Status = ('Reserved',
-               'Ready',
-               'Running',
-               'Fault',
-               'Power section line supply present',
-               'Reserved',
-               'Reserved',
-               'Alarm',
-               'Reserved',
-               'Command via Network',
-               'Reference reached',
-               'Reference outside limits',
-               'Reserved',
-               'Reserved',
-               'STOP key pressed',
-               'Reverse rotation')
-
-AntiFreeze_Status = ('Dose 1',
-                     'Dose 2',
-                     'Dose 3',
-                     'Dose 4',
-                     'Dose 5',
-                     'Fixed Dose',
-                     'Temperature 1',
-                     'Temperature 2',
-                     'Temperature 3',
-                     'Temperature 4',
-                     'Temperature 5',
-                     'Dosing pump factor',
-                     'Water meter factor',
-                     'Water counter',
-                     'Dose counter',
-                     'Current dose')
-
-Temperature = ('External temperature',
-               'External temperature A',
-               'External temperature B')
-
-
-def load_settings():
-    with open('settings.json', 'r') as fp:
-        return json.load(fp)
-
-
-def save_settings(settings):
-    with open('settings.json', 'w') as fp:
+# State kept in memory between cycles when running as a daemon. The state of a controller is kept in its Unit
+# (see fleet.py), the serial sessions are shared by the units on the same port.
+codec = RegisterCodec(modbus_keys, register_map)
+sessions = {}
+http = None
+executor = None
+port_workers = None
+concurrent = True
+snapshot = None
+status_server = None
+fleet_size = 1
+fleet_sections = {}
+fleet_lock = threading.Lock()
+running = True
+# Set to start the next daemon cycle at once
+wakeup = threading.Event()
+metrics = Metrics()
+metrics.declare("sanitrax_modbus_request_seconds", "histogram", "Duration of Modbus transactions")
+metrics.declare("sanitrax_modbus_errors_total", "counter", "Modbus transactions without a valid answer")
+metrics.declare("sanitrax_modbus_bytes_total", "counter", "Bytes of Modbus RTU frames sent and received")
+metrics.declare("sanitrax_http_request_seconds", "histogram", "Duration of HTTP requests to the proxy, with retries")
+metrics.declare("sanitrax_http_errors_total", "counter", "HTTP requests that failed or got no 2xx answer")
+metrics.declare("sanitrax_http_retries_total", "counter", "Retries of HTTP requests")
+metrics.declare("sanitrax_http_bytes_total", "counter", "Bytes of HTTP bodies sent and received")
+metrics.declare("sanitrax_action_polls_total", "counter", "Long-poll requests for the actions, by status")
+metrics.declare("sanitrax_spool_history_dropped_total", "counter",
+                "Spooled history points that were not replayed, the proxy has no batch endpoint")
+metrics.declare("sanitrax_history_rejected_total", "counter",
+                "History points dropped because the proxy rejected them with a 4xx answer")
+metrics.declare("sanitrax_file_write_seconds", "histogram", "Duration of log and snapshot writes")
+metrics.declare("sanitrax_cycle_seconds", "histogram", "Duration of poll cycles",
+                (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+metrics.declare("sanitrax_cycles_total", "counter", "Poll cycles")
+metrics.declare("sanitrax_cycle_overruns_total", "counter", "Daemon cycles that took longer than the poll interval")
+metrics.declare("sanitrax_last_cycle_timestamp_seconds", "gauge", "Unix time of the end of the last cycle")
+
+
+def setup_unit(unit):
+    # Connects a unit to the session of its serial port and creates its read planner and bitfield decoder.
+    # The serial port is shared through the Modbus broker when it is running (see modbus_broker.py).
+    if unit.port not in sessions:
+        sessions[unit.port] = open_session(BROKER_SOCKET, port=unit.port, baudrate=unit.baudrate, timeout=1)
+    unit.session = sessions[unit.port]
+    unit.planner = ReadPlanner.from_keys(modbus_keys, register_groups)
+    unit.bitfields = BitfieldDecoder.from_keys(modbus_keys, bitfield_registers)
+    return unit
+
+
+def load_settings(unit):
+    # The file is read again when it changed, so edits are picked up by a running daemon
+    path = unit.path('settings.json')
+    mtime = os.stat(path).st_mtime_ns
+    if unit.settings is None or mtime != unit.settings_mtime:
+        with open(path, 'r') as fp:
+            unit.settings = json.load(fp)
+        unit.settings_mtime = mtime
+    return unit.settings
+
+
+def save_settings(unit, settings):
+    path = unit.path('settings.json')
+    with open(path, 'w') as fp:
         json.dump(settings, fp, sort_keys=True, indent=4)
-        return "OK"
+    unit.settings = settings
+    unit.settings_mtime = os.stat(path).st_mtime_ns
+    return "OK"
 
 
 def read_gps_data_from_file():
@@ -398,41 +183,20 @@ def read_gps_data_from_file():
         }
 
 
-def water_counter(pulse):
-    water_dict = {
-        "sum": 0,
-        "previous": 0
-    }
-    try:
-        with open('WaterCounter.json', 'r') as fp:
-            data = json.load(fp)
-            water_dict = {
-                "sum": data["sum"],
-                "previous": data["previous"]
-            }
-    except:
-        pass
-
-    if (pulse < water_dict["previous"]):
-        water_dict["previous"] = 0
-
-    water_dict["sum"] += pulse - water_dict["previous"]
-    water_dict["previous"] = pulse
-
-    with open('WaterCounter.json', 'w') as fp:
-            json.dump(water_dict, fp, sort_keys=True, indent=4)
-
-    return water_dict['sum']
+def water_counter(unit, pulse):
+    # Returns the lifetime total of the water pulse counter, which is kept in memory with periodic checkpoints
+    if unit.water is None:
+        unit.water = WaterCounter(unit.path(WATER_FILE), checkpoint_interval=WATER_CHECKPOINT_INTERVAL,
+                                  checkpoint_delta=WATER_CHECKPOINT_DELTA)
+    return unit.water.update(pulse)
 
 
-def modbus_read(address, amount):
-    # Reads "amount" registers starting from address "address" from slave device 1
+def modbus_read(unit, address, amount):
+    # Reads "amount" registers starting from address "address" from the controller of the unit
+    start = time.monotonic()
     try:
-        master = modbus_rtu.RtuMaster(
-            serial.Serial(port=PORT, baudrate=9600, bytesize=8, parity='N', stopbits=1, xonxoff=0))
-        master.set_timeout(1)
-        master.set_verbose(True)
-        modbus_values = master.execute(1, cst.READ_HOLDING_REGISTERS, address, amount)
+        modbus_values = unit.session.read_holding_registers(address, amount, unit.slave)
+        record_modbus(unit, "read", start, 8, 5 + 2 * amount)
 
         if debug > 0:
             print("Read modbus values:")
@@ -440,6 +204,7 @@ def modbus_read(address, amount):
         return modbus_values
 
     except:
+        record_modbus(unit, "read", start, 8, None)
         print("Can not connect to modbus slave\n")
         modbus_values = "error"
         # Sample modbus values for debugging
@@ -450,228 +215,303 @@ def modbus_read(address, amount):
         return modbus_values
 
 
-def modbus_write(address, value):
-    # Writes value(s) to a modbus register (starting address) of slave device 1.
+def changed_runs(current, wanted):
+    # Returns a list of (offset, values) tuples, one for each run of consecutive registers where "wanted" differs
+    # from "current"
+    runs = []
+    for offset, (old, new) in enumerate(zip(current, wanted)):
+        if old == new:
+            continue
+        if runs and runs[-1][0] + len(runs[-1][1]) == offset:
+            runs[-1][1].append(new)
+        else:
+            runs.append((offset, [new]))
+    return runs
+
+
+def write_settings(unit, current, wanted):
+    # Writes only the settings registers that differ from the controller, one request per run of consecutive
+    # registers, and reads every run back to verify it. Returns True if all changes were verified.
+    verified = True
+    for offset, values in changed_runs(current, wanted):
+        address = 1 + offset
+        if debug > 0:
+            print("Writing settings", modbus_keys[address:address + len(values)], values)
+        if modbus_write(unit, address, values[0] if len(values) == 1 else values) == "error":
+            verified = False
+            continue
+        readback = modbus_read(unit, address, len(values))
+        # Negative values are written as two's complement, the controller returns them unsigned
+        if readback == "error" or list(readback) != [value & 0xFFFF for value in values]:
+            print("Settings verification failed for", modbus_keys[address:address + len(values)])
+            verified = False
+            continue
+        unit.planner.update(address, readback)
+    if not verified:
+        unit.planner.invalidate('settings')
+    return verified
+
+
+def read_registers(unit):
+    # Reads the register groups that are due and returns the merged image of all 95 registers
+    for address, amount in unit.planner.plan():
+        values = modbus_read(unit, address, amount)
+        if values == "error":
+            return "error"
+        unit.planner.store(address, values)
+    return unit.planner.values()
+
+
+def modbus_write(unit, address, value):
+    # Writes value(s) to a modbus register (starting address) of the controller of the unit.
     # "value" can be of type "int" or "list", for writing a single or multiple registers.
+    if type(value) not in (int, list):
+        print("Modbus write error, invalid value type: ", type(value))
+        return "error"
+    start = time.monotonic()
+    sent = 9 + 2 * len(value) if type(value) is list else 8
     try:
-        master = modbus_rtu.RtuMaster(
-            serial.Serial(port=PORT, baudrate=9600, bytesize=8, parity='N', stopbits=1, xonxoff=0))
-        master.set_timeout(1)
-        master.set_verbose(True)
-        if type(value) is int:
-            if debug > 0:
+        if debug > 0:
+            if type(value) is int:
                 print("Writing ", value ," to address", address)
-            result = master.execute(1, cst.WRITE_SINGLE_REGISTER, address, output_value=value)
-        elif type(value) is list:
-            if debug > 0:
+            else:
                 print("Writing ", len(value), " registers to address ", address)
-            result = master.execute(1, cst.WRITE_MULTIPLE_REGISTERS, address, output_value=value)
-        else:
-            print("Modbus write error, invalid value type: ", type(value))
+        result = unit.session.write_registers(address, value, unit.slave)
+        record_modbus(unit, "write", start, sent, 8)
         return result
 
     except:
+        record_modbus(unit, "write", start, sent, None)
         return "error"
 
 
+def record_modbus(unit, operation, start, sent, received):
+    # Records a Modbus transaction that started at "start" (time.monotonic()): the sizes in bytes of the RTU
+    # request and answer, "received" is None when there was no valid answer
+    labels = {"operation": operation, "unit": unit.dbkey}
+    metrics.observe("sanitrax_modbus_request_seconds", time.monotonic() - start, labels)
+    metrics.inc("sanitrax_modbus_bytes_total", {"direction": "sent", "unit": unit.dbkey}, sent)
+    if received is None:
+        metrics.inc("sanitrax_modbus_errors_total", labels)
+    else:
+        metrics.inc("sanitrax_modbus_bytes_total", {"direction": "received", "unit": unit.dbkey}, received)
+
+
+def get_http():
+    # Returns the HTTP connection pool, created on first use. All units share it, so it keeps enough connections
+    # to the proxy for the uploads of every unit, as the executor has workers for them.
+    global http
+    if http is None:
+        import urllib3
+        http = urllib3.PoolManager(timeout=urllib3.Timeout(connect=2.0, read=2.0),
+                                   retries=urllib3.Retry(HTTP_RETRIES, redirect=2),
+                                   maxsize=UPLOAD_PARALLEL * max(fleet_size, 1))
+    return http
+
+
+def record_http(method, command, start, sent, response, error=None):
+    # Records an HTTP request that started at "start" (time.monotonic()), with the response or the exception
+    labels = {"method": method, "endpoint": re.sub(r'/modules/[^/]+', '/modules/{dbkey}', command)}
+    metrics.observe("sanitrax_http_request_seconds", time.monotonic() - start, labels)
+    metrics.inc("sanitrax_http_bytes_total", {"direction": "sent"}, sent)
+    if response is not None:
+        metrics.inc("sanitrax_http_bytes_total", {"direction": "received"}, len(response.data))
+        retries = len(response.retries.history) if response.retries is not None else 0
+    else:
+        from urllib3.exceptions import MaxRetryError
+        retries = HTTP_RETRIES if isinstance(error, MaxRetryError) else 0
+    if retries:
+        metrics.inc("sanitrax_http_retries_total", labels, retries)
+    if response is None or not (200 <= response.status < 300 or response.status == 304):
+        metrics.inc("sanitrax_http_errors_total", labels)
+
+
+def record_action_poll(status):
+    # Records a long-poll request for the actions, with its status or None if it failed. They are held by the
+    # proxy, so they are counted apart from the latency of the other requests.
+    metrics.inc("sanitrax_action_polls_total", {"status": "error" if status is None else status})
+
+
 # Function to make HTTP post with JSON content
 def http_post_json(target, command, data):
+    start = time.monotonic()
+    encoded_data = b''
     try:
         encoded_data = json.dumps(data).encode('utf-8')
-        r = http.request('POST', target + command, body=encoded_data, headers={'Content-Type': 'application/json'})
+        r = get_http().request('POST', target + command, body=encoded_data,
+                               headers={'Content-Type': 'application/json'})
+        record_http('POST', command, start, len(encoded_data), r)
         return r.status
-    except:
+    except Exception as ex:
+        record_http('POST', command, start, len(encoded_data), None, ex)
         print("No connection to IP:", target)
         return 0
 
 
 # Function to make HTTP call with JSON content
 def http_get_json(target, command):
+    start = time.monotonic()
+    r = None
     try:
-        r = http.request('GET', target + command)
+        r = get_http().request('GET', target + command)
+        record_http('GET', command, start, 0, r)
         return json.loads(r.data.decode('utf-8'))
-    except:
+    except Exception as ex:
+        if r is None:
+            record_http('GET', command, start, 0, None, ex)
         print("No connection to IP:", target)
         return 0
 
 
-def write_log(filename, logheader, logdata):
+def get_history(unit):
+    # Returns the uploader that batches the history points of the unit
+    if unit.history is None:
+        unit.history = HistoryUploader(http_post_json, proxy, unit.dbkey, HISTORY_CYCLES,
+                                       lambda count: metrics.inc("sanitrax_history_rejected_total",
+                                                                 {"unit": unit.dbkey}, count))
+    return unit.history
+
+
+def get_spool(unit):
+    # Returns the on-disk spool for status and history data of the unit that could not be uploaded
+    if unit.spool is None:
+        unit.spool = TelemetrySpool(unit.path(SPOOL_DIR), SPOOL_MAX_BYTES)
+    return unit.spool
+
+
+def publish_status(unit, document):
+    # Publishes the status document, only the changed fields are sent unless a full resync is due.
+    # Returns False if the document could not be delivered and has to be spooled.
+    if unit.publisher is None:
+        unit.publisher = StatusPublisher(unit.path(STATUS_FILE), STATUS_RESYNC_CYCLES, STATUS_PERSIST_INTERVAL)
+    value, full = unit.publisher.prepare(document)
+    if value is None:
+        return True
+    status = http_post_json(proxy, '/database/update', {"id": unit.dbkey, "location": "status", "value": value})
+    if not 200 <= status < 300:
+        # Send the complete document again after a connection loss or a rejected update
+        unit.publisher.resync()
+        return not upload_failed(status)
+    unit.publisher.published(document, full)
+    return True
+
+
+def replay_spool(unit):
+    # Uploads a part of the backlog of the unit, returns True once the spool is empty
+    return get_spool(unit).replay(lambda kind, data: send_spooled(unit, kind, data), merge_spooled,
+                                  budget=SPOOL_REPLAY_BUDGET)
+
+
+def send_spooled(unit, kind, data):
+    # Uploads a batch of spooled data, returns True if it does not have to be retried. The status goes first, so
+    # a batch that is retried has not delivered any history points yet (sending the status twice only overwrites
+    # it). Spooled history is sent in one request to the batch endpoint: the per-series endpoints would store
+    # every point at the time of the replay, with one request per point. On a proxy without the batch endpoint
+    # the history points are dropped and only the status is replayed. Points that the proxy rejects with a 4xx
+    # answer are dropped as well, retrying them would stall the spool.
+    if data.get('status') and upload_failed(http_post_json(proxy, '/database/update', data['status'])):
+        return False
+    if data.get('history'):
+        failed = get_history(unit).send_batch(data['history'])
+        if failed is None:
+            metrics.inc("sanitrax_spool_history_dropped_total", {"unit": unit.dbkey}, spooled_points(data))
+        elif failed:
+            return False
+    return True
+
+
+def merge_spooled(kind, data, newer):
+    # Merges two spooled records: only the newest status is uploaded, history points are combined up to
+    # SPOOL_BATCH_POINTS per batch
+    if spooled_points(data) + spooled_points(newer) > SPOOL_BATCH_POINTS and spooled_points(newer):
+        return None
+    merged = {'status': newer.get('status') or data.get('status'),
+              'history': {series: list(points) for series, points in data.get('history', {}).items()}}
+    for series, points in newer.get('history', {}).items():
+        merged['history'].setdefault(series, []).extend(points)
+    return merged
+
+
+def spooled_points(data):
+    # Returns the number of history points in a spooled record
+    return sum(len(points) for points in data.get('history', {}).values())
+
+
+def write_log(unit, filename, logheader, logdata):
     # In the directory of this python file there should be a subdirectory or a symlink called "log"
     # where log files will be stored in separate CSV files per day, using UTC timestamps.
-    logdate = time.strftime("%Y-%m-%d", time.gmtime())
-    logtime = time.strftime("%H:%M:%S", time.gmtime())
-    logfile = 'log/' + logdate + "_" + filename + '.csv'
-
-    # If the file does not exists, also a header will be written
-    if not Path(logfile).is_file():
-        with open(logfile, 'a') as fp:
-            header = ["Date", "Time (UTC)"]
-            header.extend(logheader)
-            writer = csv.writer(fp, delimiter=";", quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(header)
-
-    with open(logfile, 'a') as fp:
-        data_row = [logdate, logtime]
-        data_row.extend(logdata)
-        writer = csv.writer(fp, delimiter=";", quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(data_row)
-
-
-def writeDictAsJsonData(data, filename):
-    json_data = json.dumps(data, indent=4)
-    filehandler = open("/tmp/" + filename + ".json", 'w')
-    print(json_data, file=filehandler)
-    filehandler.close()
-
-
-# Calculate the maximum temperature for 16 bits
-MAX_TEMPERATURE = pow(2, 16)
-
-
-# Modbus will return 2 complement values for values < 0, so this needs correction
-# @param temperature The temperature value to correct
-# @returns Returns a valid temperature
-def fixNegativeTemperature(temperature):
-
-    # This temp should never be reached, this is likely to be a 2complement value
-    if temperature > (MAX_TEMPERATURE / 2) - 1:
-        temperature -= MAX_TEMPERATURE
-
-    return temperature
-
-
-# Make sure the negative temperatures are packed as a two complement
-# (which will be the result for any negative value returned by modbus)
-def prepareData(modbus_values):
-    # Convert tuple (read only) to a list
-    values = list(modbus_values)
-
-    # Temperature fix(es)
-    external_temp_index = modbus_keys.index("mb_external_temp")
-    values[external_temp_index] = fixNegativeTemperature(values[external_temp_index] )
-    values[external_temp_index] /= 10
-
-    # Convert (possible) negative 2 complement value to normal value
-    start_index = modbus_keys.index("mb_antifreeze_temp_1")
-    end_index = modbus_keys.index("mb_antifreeze_temp_5")
-    while start_index <= end_index:
-        values[start_index] = fixNegativeTemperature(values[start_index])
-        start_index += 1
-
-    return tuple(values)
-
-
-## Scale analog value
-#  @param raw_in as integer for raw analog value
-#  @param raw_min as integer for minimum raw analog value
-#  @param raw_max as integer for maximum raw analog value
-#  @param eng_min as integer for minimum engineering value
-#  @param eng_max as integer for maximum engineering value
-#  @return as integer for scaled engineering value
-def scale_analog(*, raw_in: int, raw_min: int, raw_max: int, eng_min: int, eng_max: int) -> int:
-    raw_range = raw_max - raw_min
-    eng_range = eng_max - eng_min
-    value = ((((raw_in - raw_min) / raw_range) * eng_range) + eng_min)
-    return int(value)
-
-
-def main(mode):
-    modbus_values = modbus_read(0, 95)
-    if modbus_values == "error":
-        quit()
-
+    # The file of the day is kept open and rows are buffered, see LOG_FLUSH_ROWS and LOG_FLUSH_INTERVAL.
+    logger = unit.loggers.get(filename)
+    if logger is None:
+        logger = unit.loggers[filename] = CsvLogger('log', filename, logheader, LOG_FLUSH_ROWS, LOG_FLUSH_INTERVAL)
+    start = time.monotonic()
+    logger.write(logdata)
+    metrics.observe("sanitrax_file_write_seconds", time.monotonic() - start, {"file": "csv"})
+
+
+def write_store(unit, filename, count, logdata):
+    # Binary version of write_log: one file per day in "log" with a timestamp and the raw registers per record
+    store = unit.stores.get(filename)
+    if store is None:
+        store = unit.stores[filename] = RegisterStore('log', filename, count, LOG_FLUSH_ROWS, LOG_FLUSH_INTERVAL)
+    start = time.monotonic()
+    store.write(logdata)
+    metrics.observe("sanitrax_file_write_seconds", time.monotonic() - start, {"file": "binary"})
+
+
+def process(unit, mode, modbus_values):
+    # Logs, corrects and decodes the raw register values and syncs the settings with settings.json.
+    # Returns a dictionary with the decoded sections (named after the RESTAPI files) and the values needed for
+    # the database status.
     if mode == "firebase":
         # Write the raw data to a log file (without any alterations)
-        write_log("Sanitrax", modbus_keys[:95], modbus_values)
-    # Correct values before use and store comparison
-    modbus_values = prepareData(modbus_values)
+        if LOG_FORMAT in ("csv", "both"):
+            write_log(unit, unit.log_name, modbus_keys[:95], modbus_values)
+        if LOG_FORMAT in ("binary", "both"):
+            write_store(unit, unit.log_name, 95, modbus_values)
+    # Correct the signed values before use and store comparison, and convert all registers to engineering values
+    modbus_values, modbus_dict = codec.decode(modbus_values)
 
     # Load settings from file and compare to current settings
     # Write settings to controller if not up-to-date
     # If the file does not exist yet, then store the current settings in the controller
+    current_settings = list(modbus_values[1:28])
     try:
-        current_settings = list(modbus_values[1:28])
-        store = load_settings()
-        stored_settings = []
-        for key in modbus_keys[1:28]:
-            stored_settings.append(store[key])
+        store = load_settings(unit)
+        stored_settings = [store[key] for key in modbus_keys[1:28]]
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        print("settings.json does not exist or is invalid, creating new file")
+        current_settings = dict(zip(modbus_keys[1:28], modbus_values[1:28]))
+        save_settings(unit, current_settings)
+    else:
         if current_settings != stored_settings:
             if debug > 0:
                 print("Settings do not match stored values, updating:")
                 print(store)
                 print(stored_settings)
                 print(current_settings)
-            modbus_write(1, stored_settings)
-    except:
-        print("settings.json does not exist, creating new file")
-        current_settings = dict(zip(modbus_keys[1:28], modbus_values[1:28]))
-        save_settings(current_settings)
+            write_settings(unit, current_settings, stored_settings)
 
-    # Create a dictionary of all the modbus values for easier reference in further processing
-    modbus_dict = dict(zip(modbus_keys, modbus_values))
-    water_sum = water_counter(modbus_dict['mb_water_counter'])
+    water_sum = water_counter(unit, modbus_dict['mb_water_counter'])
     gps_dict = read_gps_data_from_file()
 
-    # Create lists of bits from 16-bit registers (reversed order, represented as int with value 0 or 1)
-    input_top_val = list(map(int, reversed(bin(modbus_dict['mb_input_top'])[2:].zfill(16))))
-    input_bottom_val = list(map(int, reversed(bin(modbus_dict['mb_input_bottom'])[2:].zfill(16))))
-    output_val = list(map(int, reversed(bin(modbus_dict['mb_output'])[2:].zfill(16))))
-    output_mask = list(map(int, reversed(bin(modbus_dict['mb_output_mask'])[2:].zfill(16))))
-    output_fault = list(map(int, reversed(bin(modbus_dict['mb_output_fault'])[2:].zfill(16))))
-    fault_val = list(map(int, reversed(bin(modbus_dict['mb_fault'])[2:].zfill(16))))
-    fault_mask = list(map(int, reversed(bin(modbus_dict['mb_fault_mask'])[2:].zfill(16))))
-    pump1_status = list(map(int, reversed(bin(modbus_dict['mb_p1_Status'])[2:].zfill(16))))
-    pump2_status = list(map(int, reversed(bin(modbus_dict['mb_p2_Status'])[2:].zfill(16))))
-
-    # Create dictionaries from keys and values
-    input_top_dict = dict(zip(input_top_keys, input_top_val))
-    input_bottom_dict = dict(zip(input_bottom_keys, input_bottom_val))
-    output_dict = dict(zip(output_keys, output_val))
-    output_mask_dict = dict(zip(output_keys, output_mask))
-    output_fault_dict = dict(zip(output_dict, output_fault))
-    fault_dict = dict(zip(fault_keys, fault_val))
-    fault_mask_dict = dict(zip(fault_keys, fault_mask))
-    pump1_status_dict = dict(zip(Pump_Status, pump1_status))
-    pump2_status_dict = dict(zip(Pump_Status, pump2_status))
+    # Create dictionaries of bits (int with value 0 or 1) from the 16-bit bitfield registers, all in one pass
+    bits = unit.bitfields.decode(modbus_values)
+    if debug > 0:
+        print("Changed bits:", unit.bitfields.changes(modbus_values))
+    input_top_dict = bits['top']
+    input_bottom_dict = bits['bottom']
+    output_dict = bits['output']
+    output_mask_dict = bits['output_mask']
+    output_fault_dict = bits['output_fault']
+    fault_dict = bits['fault']
+    fault_mask_dict = bits['fault_mask']
+    pump1_status_dict = bits['pump1']
+    pump2_status_dict = bits['pump2']
     antifreeze_pump_dict = dict(zip(AntiFreeze_Status, modbus_values[15:28] + modbus_values[39:42]))
-    temperature_dict = dict(zip(Temperature, modbus_values[43:46]))
-
-    # Value scaling
-    modbus_dict["mb_p1_Vac"] = ((modbus_dict["mb_p1_Vac"] - RAW_FACTOR) / RAW_DIF) - 1
-    modbus_dict["mb_p2_Vac"] = ((modbus_dict["mb_p2_Vac"] - RAW_FACTOR) / RAW_DIF) - 1
-
-    modbus_dict["mb_p1_Temp"] = scale_analog(raw_in=modbus_dict["mb_p1_Temp"],
-                                             raw_min=RAW_TEMP_MIN,
-                                             raw_max=RAW_TEMP_MAX,
-                                             eng_min=TEMP_MIN,
-                                             eng_max=TEMP_MAX)
-
-    modbus_dict["mb_p2_Temp"] = scale_analog(raw_in=modbus_dict["mb_p2_Temp"],
-                                             raw_min=RAW_TEMP_MIN,
-                                             raw_max=RAW_TEMP_MAX,
-                                             eng_min=TEMP_MIN,
-                                             eng_max=TEMP_MAX)
-
-    modbus_dict["mb_p1_Motor_Current"] /= 10
-    modbus_dict["mb_p2_Motor_Current"] /= 10
- 
-    modbus_dict["mb_p1_Mains_Volt"] /= 10
-    modbus_dict["mb_p2_Mains_Volt"] /= 10
-
-    total_water_usage = water_sum / modbus_dict['mb_watermeter_factor']
-
-    # Create dictionaries that are used to display actual values in the App.
-    pump1_display_dict = {"current": modbus_dict["mb_p1_Motor_Current"],
-                          "mains_voltage": modbus_dict["mb_p1_Mains_Volt"],
-                          "pump_temperature": modbus_dict["mb_p1_Temp"],
-                          "relative_pressure": modbus_dict["mb_p1_Vac"],
-                          }
-    pump2_display_dict = {"current": modbus_dict["mb_p2_Motor_Current"],
-                          "mains_voltage": modbus_dict["mb_p2_Mains_Volt"],
-                          "pump_temperature": modbus_dict["mb_p2_Temp"],
-                          "relative_pressure": modbus_dict["mb_p2_Vac"],
-                          }
-    hydrophore_display_dict = {"total": total_water_usage}
+    temperature_dict = dict(zip(Temperature, (modbus_dict['mb_external_temp'],
+                                              modbus_dict['mb_external_temp_float_a'],
+                                              modbus_dict['mb_external_temp_float_b'])))
 
     # The drives store fault codes in their fault registers, but these are only "active" when the fault bit in the
     # status word is true. We overwrite the fault code with '0' when this bit is not true, indicating "no fault".
@@ -712,213 +552,680 @@ def main(mode):
     states_dict["Flush Valve 2"] = fstate[modbus_dict['mb_f2state']]
     states_dict["Antifreeze Pump"] = dstate[modbus_dict['mb_dstate']]
 
-    # Operate in either console, FireBase or RESTAPI mode
-    if mode == RESTAPI:
-        writeDictAsJsonData(modbus_dict, "modbus")
-        writeDictAsJsonData(input_top_dict, "top")
-        writeDictAsJsonData(input_bottom_dict, "bottom")
-        writeDictAsJsonData(output_dict, "output")
-        writeDictAsJsonData(output_mask_dict, "output_mask")
-        writeDictAsJsonData(output_fault_dict, "output_fault")
-        writeDictAsJsonData(fault_dict, "fault")
-        writeDictAsJsonData(fault_mask_dict, "fault_mask")
-        writeDictAsJsonData(p1_dict, "pump1")
-        writeDictAsJsonData(p2_dict, "pump2")
-        writeDictAsJsonData(states_dict, "states")
-        writeDictAsJsonData(antifreeze_pump_dict, "antifreeze")
-        writeDictAsJsonData(temperature_dict, "temperature")
-        writeDictAsJsonData(gps_dict, "gps")
-        return
+    sections = {"modbus": modbus_dict,
+                "top": input_top_dict,
+                "bottom": input_bottom_dict,
+                "output": output_dict,
+                "output_mask": output_mask_dict,
+                "output_fault": output_fault_dict,
+                "fault": fault_dict,
+                "fault_mask": fault_mask_dict,
+                "pump1": p1_dict,
+                "pump2": p2_dict,
+                "states": states_dict,
+                "antifreeze": antifreeze_pump_dict,
+                "temperature": temperature_dict,
+                "gps": gps_dict}
+    return {"values": modbus_values, "water_sum": water_sum, "sections": sections}
+
+
+def write_restapi(cycle):
+    # Writes the decoded sections to the snapshot file for the NI-Toolkit, and to their own json files in
+    # RESTAPI_COMPAT_DIR when RESTAPI_COMPAT_FILES is set. Nothing is written when no section changed.
+    global snapshot
+    if snapshot is None:
+        snapshot = SnapshotWriter(SNAPSHOT_FILE, RESTAPI_COMPAT_DIR if RESTAPI_COMPAT_FILES else None)
+    start = time.monotonic()
+    snapshot.write(cycle["sections"])
+    metrics.observe("sanitrax_file_write_seconds", time.monotonic() - start, {"file": "snapshot"})
+
+
+def print_console(cycle):
+    # Prints all decoded sections to the console
+    sections = cycle["sections"]
+    print(sections["modbus"])
+
+    print("\n======== Input Top =============")
+    for key, value in sections["top"].items():
+        print(key + ': ', value)
+
+    print(" \n========= Input Bottom =========")
+    for key, value in sections["bottom"].items():
+        print(key + ': ', value)
+
+    print(" \n========= Output ===============")
+    for key, value in sections["output"].items():
+        print(key + ': ', value)
+
+    print(" \n========= Output Mask ============")
+    for key, value in sections["output_mask"].items():
+        print(key + ': ', value)
+
+    print(" \n========= Output Fault ============")
+    for key, value in sections["output_fault"].items():
+        print(key + ': ', value)
+
+    print(" \n========= Fault Registers ============")
+    for key, value in sections["fault"].items():
+        print(key + ': ', value)
+
+    print(" \n========= Fault Mask ============")
+    for key, value in sections["fault_mask"].items():
+        print(key + ': ', value)
+
+    print("\n========== Pump 1 Status ==========")
+    for key, value in sections["pump1"].items():
+        print(key + ': ', value)
+
+    print("\n========== Pump 2 Status ==========")
+    for key, value in sections["pump2"].items():
+        print(key + ': ', value)
+
+    print(" \n========= States ============")
+    for key, value in sections["states"].items():
+        print(key + ': ', value)
+
+    print("\n========== Antifreeze Status ==========")
+    for key, value in sections["antifreeze"].items():
+        print(key + ': ', value)
+
+    print("\n========== Temperature Status ==========")
+    for key, value in sections["temperature"].items():
+        print(key + ': ', value)
+
+    print("\n========== GPS Readout ==========")
+    for key, value in sections["gps"].items():
+        print(key + ': ', value)
+
+
+def actions_command(unit):
+    # Database path of the actions requested from the app
+    return "/database/modules/" + unit.dbkey + "/settings/actions"
+
+
+def fetch_actions(unit):
+    # Returns the actions requested from the app. With a subscription they are only returned when they changed,
+    # None means there is nothing new to do.
+    if unit.subscription is None:
+        return http_get_json(proxy, actions_command(unit))
+    return unit.subscription.take()
+
+
+def run_actions(unit, actions, modbus_values):
+    # Handles the actions and sends their acknowledgements one after the other. When an acknowledgement is lost
+    # the flag stays set in the database without a change, so the subscription hands the actions out again in
+    # the next cycle.
+    if not handle_actions(unit, actions, modbus_values, lambda data: http_post_json(proxy, '/database/update', data)):
+        if unit.subscription is not None:
+            unit.subscription.retry()
+
+
+def handle_actions(unit, actions, modbus_values, post):
+    # Executes the resets and setting changes requested from the app, in order. "post(data)" sends the
+    # acknowledgement to the database and returns the HTTP status. Returns False if an update could not be
+    # delivered, the flag is then still set in the database and the actions have to be handled again.
+    if actions is None:
+        return True
+    failed = []
 
-    if mode == "console":
-        print(modbus_dict)
+    def acknowledge(data):
+        if not 200 <= post(data) < 300:
+            failed.append(data)
 
-        print("\n======== Input Top =============")
-        for key, value in input_top_dict.items():
-            print(key + ': ', value)
+    try:
+        if actions['resetBreaktank']:
+            modbus_write(unit, modbus_keys.index('mb_reset_breaktank'), 1)
+            data = {"id": unit.dbkey, "location": "/settings/actions", "value": {"resetBreaktank": False}}
+            acknowledge(data)
+        if actions['resetHydrophore']:
+            modbus_write(unit, modbus_keys.index('mb_reset_hydrophore'), 1)
+            data = {"id": unit.dbkey, "location": "/settings/actions", "value": {"resetHydrophore": False}}
+            acknowledge(data)
+        if actions['resetPump1']:
+            modbus_write(unit, modbus_keys.index('mb_reset_pump_1'), 1)
+            data = {"id": unit.dbkey, "location": "/settings/actions", "value": {"resetPump1": False}}
+            acknowledge(data)
+        if actions['resetPump2']:
+            modbus_write(unit, modbus_keys.index('mb_reset_pump_2'), 1)
+            data = {"id": unit.dbkey, "location": "/settings/actions", "value": {"resetPump2": False}}
+            acknowledge(data)
+        if actions['applyChanges']:
+            new_settings = http_get_json(proxy, "/database/modules/" + unit.dbkey + "/settings/new")
+            current_settings = dict(zip(modbus_keys[1:28], modbus_values[1:28]))
+            if new_settings != current_settings:
+                save_settings(unit, new_settings)
+
+                # Create list in correct order with new settings
+                settings_array = []
+                for key in modbus_keys[1:28]:
+                    settings_array.append(new_settings[key])
+                
+                if debug > 0:
+                    print("Applying new settings from database:")
+                    print(settings_array)
+                write_settings(unit, modbus_values[1:28], settings_array)
+                # Then write the new settings as "current" to database
+                data = {"id": unit.dbkey, "location": "settings/current", "value": new_settings}
+                acknowledge(data)
+            data = {"id": unit.dbkey, "location": "/settings/actions", "value": {"applyChanges": False}}
+            acknowledge(data)
 
-        print(" \n========= Input Bottom =========")
-        for key, value in input_bottom_dict.items():
-            print(key + ': ', value)
+    except:
+        print("/settings/actions not defined in database")
+    return not failed
+
+
+def build_status(cycle):
+    # Builds the API v2 status document for the database
+    sections = cycle["sections"]
+    modbus_dict = sections["modbus"]
+    fault_dict = sections["fault"]
+    gps_dict = sections["gps"]
+    water_sum = cycle["water_sum"]
+    total_water_usage = water_sum / modbus_dict['mb_watermeter_factor']
+    modbus_values = cycle["values"]
+
+    # Create dictionaries that are used to display actual values in the App.
+    pump1_display_dict = {"current": modbus_dict["mb_p1_Motor_Current"],
+                          "mains_voltage": modbus_dict["mb_p1_Mains_Volt"],
+                          "pump_temperature": modbus_dict["mb_p1_Temp"],
+                          "relative_pressure": modbus_dict["mb_p1_Vac"],
+                          }
+    pump2_display_dict = {"current": modbus_dict["mb_p2_Motor_Current"],
+                          "mains_voltage": modbus_dict["mb_p2_Mains_Volt"],
+                          "pump_temperature": modbus_dict["mb_p2_Temp"],
+                          "relative_pressure": modbus_dict["mb_p2_Vac"],
+                          }
+    hydrophore_display_dict = {"total": total_water_usage}
 
-        print(" \n========= Output ===============")
-        for key, value in output_dict.items():
-            print(key + ': ', value)
+    return {
+        "breakTank": {
+            "state": bstate[modbus_dict['mb_bstate']],
+            "waterCounter": water_sum
+        },
+        "dosingPump": {
+            "state": dstate[modbus_dict['mb_dstate']],
+            "doseCounter": modbus_dict['mb_dose_counter'],
+            "currentDose": modbus_dict['mb_current_dose'],
+        },
+        "environment": {
+            "gpsLocation": str(gps_dict['Latitude'])+","+str(gps_dict['Longitude']),
+            "gpsTimestamp": gps_dict['Time'],
+            "temperature": modbus_dict['mb_external_temp']
+        },
+        "heartbeat": {
+            "timestamp": int(time.time()),
+        },
+        "hydrophore": {
+            "error": fault_dict["Hydrophore_Fail"],
+            "state": hstate[modbus_dict['mb_hstate']],
+            "display": hydrophore_display_dict,
+        },
+        "pump1": {
+            "data": dict(zip(modbus_keys[53:72], modbus_values[53:72])),
+            "error": modbus_dict["mb_p1_Fault"],
+            "errorDescription": pump_fault_dict[str(modbus_dict["mb_p1_Fault"])],
+            "flush": fstate[modbus_dict['mb_f1state']],
+            "state": pstate[modbus_dict['mb_p1state']],
+            "status": sections["pump1"],
+            "display": pump1_display_dict,
+        },
+        "pump2": {
+            "data": dict(zip(modbus_keys[72:91], modbus_values[72:91])),
+            "error": modbus_dict["mb_p2_Fault"],
+            "errorDescription": pump_fault_dict[str(modbus_dict["mb_p2_Fault"])],
+            "flush": fstate[modbus_dict['mb_f2state']],
+            "state": pstate[modbus_dict['mb_p2state']],
+            "status": sections["pump2"],
+            "display": pump2_display_dict,
+        },
+        "system": {
+            "fault": fault_dict,
+            "inputTop": sections["top"],
+            "inputBottom": sections["bottom"],
+            "output": sections["output"],
+            "pcbTemperature": modbus_dict["mb_pcb_temp"]
+        }
+    }
 
-        print(" \n========= Output Mask ============")
-        for key, value in output_mask_dict.items():
-            print(key + ': ', value)
 
-        print(" \n========= Output Fault ============")
-        for key, value in output_fault_dict.items():
-            print(key + ': ', value)
+def collect_history(unit, cycle):
+    # Adds the history points of this cycle, the points of one or more cycles are uploaded in one request
+    modbus_dict = cycle["sections"]["modbus"]
+    history = get_history(unit)
+    history.add('waterCounter', cycle["water_sum"])
+    history.add('pump1Current', modbus_dict["mb_p1_Motor_Current"])
+    history.add('pump1Pressure', modbus_dict["mb_p1_Vac"])
+    history.add('pump1Temperature', modbus_dict["mb_p1_Temp"])
+    history.add('pump1Voltage', modbus_dict["mb_p1_Mains_Volt"])
+    history.add('pump2Current', modbus_dict["mb_p2_Motor_Current"])
+    history.add('pump2Pressure', modbus_dict["mb_p2_Vac"])
+    history.add('pump2Temperature', modbus_dict["mb_p2_Temp"])
+    history.add('pump2Voltage', modbus_dict["mb_p2_Mains_Volt"])
+    return history
+
+
+def upload(unit, cycle, api_2_data):
+    # Uploads the status document and the history points of this cycle
+    history = collect_history(unit, cycle)
+
+    # Write data to database. Data that can not be delivered goes to the spool, which is replayed first once
+    # the connection is back. As long as there is a backlog new data is queued behind it to keep the order.
+    # The spool always holds the full status document, the first publication after it is a full one.
+    spool = get_spool(unit)
+    data = {"id": unit.dbkey, "location": "status", "value": api_2_data}
+    if spool.pending() and not replay_spool(unit):
+        spool.append('telemetry', {'status': data, 'history': history.take()})
+        if unit.publisher is not None:
+            unit.publisher.resync()
+    elif not publish_status(unit, api_2_data):
+        spool.append('telemetry', {'status': data, 'history': history.take()})
+    else:
+        failed = history.end_cycle()
+        if failed:
+            spool.append('telemetry', {'history': failed})
 
-        print(" \n========= Fault Registers ============")
-        for key, value in fault_dict.items():
-            print(key + ': ', value)
 
-        print(" \n========= Fault Mask ============")
-        for key, value in fault_mask_dict.items():
-            print(key + ': ', value)
+def publish_sections(unit, sections):
+    # Publishes the sections on the status server. With a fleet the sections of all units are served together,
+    # as "<dbkey>/<section>".
+    if status_server is None:
+        return
+    if fleet_size == 1:
+        status_server.publish(sections)
+        return
+    with fleet_lock:
+        for name, section in sections.items():
+            fleet_sections[unit.dbkey + "/" + name] = section
+        status_server.publish(fleet_sections)
 
-        print("\n========== Pump 1 Status ==========")
-        for key, value in p1_dict.items():
-            print(key + ': ', value)
 
-        print("\n========== Pump 2 Status ==========")
-        for key, value in p2_dict.items():
-            print(key + ': ', value)
+def update_activity(unit, modbus_values):
+    # Records whether the plant of the unit is active, for the adaptive poll scheduler
+    reasons = activity(modbus_values)
+    if debug > 0 and reasons:
+        print("Active:", ", ".join(reasons))
+    unit.active = bool(reasons)
 
-        print(" \n========= States ============")
-        for key, value in states_dict.items():
-            print(key + ': ', value)
 
-        print("\n========== Antifreeze Status ==========")
-        for key, value in antifreeze_pump_dict.items():
-            print(key + ': ', value)
+def main(unit, mode):
+    modbus_values = read_registers(unit)
+    if modbus_values == "error":
+        unit.active = None
+        return
+    update_activity(unit, modbus_values)
+    cycle = process(unit, mode, modbus_values)
+    publish_sections(unit, cycle["sections"])
 
-        print("\n========== Temperature Status ==========")
-        for key, value in temperature_dict.items():
-            print(key + ': ', value)
+    # Operate in either console, FireBase or RESTAPI mode
+    if mode == RESTAPI:
+        write_restapi(cycle)
+        return
 
-        print("\n========== GPS Readout ==========")
-        for key, value in gps_dict.items():
-            print(key + ': ', value)
+    if mode == "console":
+        print_console(cycle)
 
     if mode == "firebase":
         # API v2 on production database.
         # Check for reset or setting changes
+        actions = fetch_actions(unit)
+        run_actions(unit, actions, cycle["values"])
+        upload(unit, cycle, build_status(cycle))
+
+
+async def main_async(unit, mode):
+    # Same cycle as main(), but the blocking serial and HTTP calls run in worker threads so they can overlap:
+    # the actions are fetched while the registers are read, and the status update and history upload are sent
+    # concurrently (at most UPLOAD_PARALLEL at a time). Modbus writes are still executed one by one, in order.
+    # Actions of a subscription are taken after a successful read, a cycle that is aborted would lose them.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    pool = get_executor()
+    limit = asyncio.Semaphore(UPLOAD_PARALLEL)
+
+    async def run(function, *args):
+        async with limit:
+            return await loop.run_in_executor(pool, function, *args)
+
+    reading = loop.run_in_executor(pool, read_registers, unit)
+    if mode == "firebase" and unit.subscription is None:
+        modbus_values, actions = await asyncio.gather(reading, run(fetch_actions, unit))
+    else:
+        modbus_values = await reading
+    if modbus_values == "error":
+        unit.active = None
+        return
+    update_activity(unit, modbus_values)
+    cycle = process(unit, mode, modbus_values)
+    publish_sections(unit, cycle["sections"])
+
+    if mode == RESTAPI:
+        write_restapi(cycle)
+        return
+
+    if mode == "console":
+        print_console(cycle)
+
+    if mode == "firebase":
+        if unit.subscription is not None:
+            actions = await run(fetch_actions, unit)
+        # The acknowledgements are sent one after the other as in main(), "applyChanges" is cleared only after the
+        # new settings have been written to the database
+        await loop.run_in_executor(pool, run_actions, unit, actions, cycle["values"])
+        api_2_data = build_status(cycle)
+        history = collect_history(unit, cycle)
+
+        # Same spool rules as upload(), but the status and history are sent at the same time
+        spool = get_spool(unit)
+        data = {"id": unit.dbkey, "location": "status", "value": api_2_data}
+        if spool.pending() and not await run(replay_spool, unit):
+            spool.append('telemetry', {'status': data, 'history': history.take()})
+            if unit.publisher is not None:
+                unit.publisher.resync()
+            return
+        results = await asyncio.gather(run(publish_status, unit, api_2_data), run(history.end_cycle))
+        if not results[0]:
+            spool.append('telemetry', {'status': data})
+        if results[1]:
+            spool.append('telemetry', {'history': results[1]})
+
+
+def get_executor():
+    # Returns the worker threads for the blocking serial and HTTP calls of main_async(), enough for the units
+    # of all serial ports to run their cycle at the same time
+    global executor
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=(UPLOAD_PARALLEL + 1) * max(len(sessions), 1))
+    return executor
+
+
+def run_unit(unit, mode):
+    # Runs one cycle of a unit, with the concurrent engine unless it has been disabled. Only firebase mode has
+    # HTTP calls to overlap, the other modes use the sequential engine.
+    try:
+        if concurrent and mode == "firebase":
+            import asyncio
+            asyncio.run(main_async(unit, mode))
+        else:
+            main(unit, mode)
+    except Exception as ex:
+        if fleet_size == 1:
+            raise
+        # One failing controller must not stop the cycle of the others
+        print("Cycle of", unit.dbkey, "failed:", ex)
+
+
+def run_port(units, mode):
+    # Runs the cycles of the units on one serial port one after the other, they share the bus
+    for unit in units:
+        run_unit(unit, mode)
+
+
+def run_cycle(mode, units):
+    # Runs one cycle of all units. Every serial port has its own worker, so the ports are polled in parallel.
+    groups = group_by_port(units)
+    if len(groups) == 1:
+        run_port(groups[0], mode)
+        return
+    global port_workers
+    if port_workers is None:
+        from concurrent.futures import ThreadPoolExecutor
+        port_workers = ThreadPoolExecutor(max_workers=len(groups))
+    for result in [port_workers.submit(run_port, group, mode) for group in groups]:
+        result.result()
+
+
+def refresh_sessions(units):
+    # Switches the serial ports that are used without the broker to the broker once it runs: a broker takes the
+    # lock of its port before it creates its socket, so it only starts between two cycles
+    for port, session in list(sessions.items()):
+        if isinstance(session, BrokerSession):
+            session.reconnect()
+            continue
+        broker = open_session(BROKER_SOCKET, port=port, baudrate=session.baudrate, timeout=1)
+        if not uses_broker(broker):
+            continue
+        session.close()
+        sessions[port] = broker
+        for unit in units:
+            if unit.port == port:
+                unit.session = broker
+
+
+def port_lock(mode):
+    # Returns the locks of the serial ports that a cycle opens itself, the ports of the broker need none
+    from contextlib import ExitStack
+    locks = ExitStack()
+    if mode != "console":
         try:
-            actions = http_get_json(proxy, "/database/modules/" + dbkey + "/settings/actions")
-            if actions['resetBreaktank']:
-                modbus_write(modbus_keys.index('mb_reset_breaktank'), 1)
-                data = {"id": dbkey, "location": "/settings/actions", "value": {"resetBreaktank": False}}
-                http_post_json(proxy, '/database/update', data)
-            if actions['resetHydrophore']:
-                modbus_write(modbus_keys.index('mb_reset_hydrophore'), 1)
-                data = {"id": dbkey, "location": "/settings/actions", "value": {"resetHydrophore": False}}
-                http_post_json(proxy, '/database/update', data)
-            if actions['resetPump1']:
-                modbus_write(modbus_keys.index('mb_reset_pump_1'), 1)
-                data = {"id": dbkey, "location": "/settings/actions", "value": {"resetPump1": False}}
-                http_post_json(proxy, '/database/update', data)
-            if actions['resetPump2']:
-                modbus_write(modbus_keys.index('mb_reset_pump_2'), 1)
-                data = {"id": dbkey, "location": "/settings/actions", "value": {"resetPump2": False}}
-                http_post_json(proxy, '/database/update', data)
-            if actions['applyChanges']:
-                new_settings = http_get_json(proxy, "/database/modules/" + dbkey + "/settings/new")
-                current_settings = dict(zip(modbus_keys[1:28], modbus_values[1:28]))
-                if new_settings != current_settings:
-                    save_settings(new_settings)
-
-                    # Create list in correct order with new settings
-                    settings_array = []
-                    for key in modbus_keys[1:28]:
-                        settings_array.append(new_settings[key])
-                    
-                    if debug > 0:
-                        print("Applying new settings from database:")
-                        print(settings_array)
-                    modbus_write(1, settings_array)
-                    # Then write the new settings as "current" to database
-                    data = {"id": dbkey, "location": "settings/current", "value": new_settings}
-                    http_post_json(proxy, '/database/update', data)
-                data = {"id": dbkey, "location": "/settings/actions", "value": {"applyChanges": False}}
-                http_post_json(proxy, '/database/update', data)
-
-        except:
-            print("/settings/actions not defined in database")
-
-        api_2_data = {
-            "breakTank": {
-                "state": bstate[modbus_dict['mb_bstate']],
-                "waterCounter": water_sum
-            },
-            "dosingPump": {
-                "state": dstate[modbus_dict['mb_dstate']],
-                "doseCounter": modbus_dict['mb_dose_counter'],
-                "currentDose": modbus_dict['mb_current_dose'],
-            },
-            "environment": {
-                "gpsLocation": str(gps_dict['Latitude'])+","+str(gps_dict['Longitude']),
-                "gpsTimestamp": gps_dict['Time'],
-                "temperature": modbus_dict['mb_external_temp']
-            },
-            "heartbeat": {
-                "timestamp": int(time.time()),
-            },
-            "hydrophore": {
-                "error": fault_dict["Hydrophore_Fail"],
-                "state": hstate[modbus_dict['mb_hstate']],
-                "display": hydrophore_display_dict,
-            },
-            "pump1": {
-                "data": dict(zip(modbus_keys[53:72], modbus_values[53:72])),
-                "error": modbus_dict["mb_p1_Fault"],
-                "errorDescription": pump_fault_dict[str(modbus_dict["mb_p1_Fault"])],
-                "flush": fstate[modbus_dict['mb_f1state']],
-                "state": pstate[modbus_dict['mb_p1state']],
-                "status": pump1_status_dict,
-                "display": pump1_display_dict,
-            },
-            "pump2": {
-                "data": dict(zip(modbus_keys[72:91], modbus_values[72:91])),
-                "error": modbus_dict["mb_p2_Fault"],
-                "errorDescription": pump_fault_dict[str(modbus_dict["mb_p2_Fault"])],
-                "flush": fstate[modbus_dict['mb_f2state']],
-                "state": pstate[modbus_dict['mb_p2state']],
-                "status": pump2_status_dict,
-                "display": pump2_display_dict,
-            },
-            "system": {
-                "fault": fault_dict,
-                "inputTop": input_top_dict,
-                "inputBottom": input_bottom_dict,
-                "output": output_dict,
-                "pcbTemperature": modbus_dict["mb_pcb_temp"]
-            }
-        }
+            for port, session in sessions.items():
+                if not uses_broker(session):
+                    locks.enter_context(SimpleFlock(lock_file(port), LOCK_TIMEOUT))
+        except TimeoutError:
+            locks.close()
+            raise
+    return locks
 
-        # Write data to database
-        data = {"id": dbkey, "location": "status", "value": api_2_data}
-        http_post_json(proxy, '/database/update', data)
 
-        # Write historical data to log
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/waterCounter', water_sum)
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/pump1Current', modbus_dict["mb_p1_Motor_Current"])
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/pump1Pressure', modbus_dict["mb_p1_Vac"])
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/pump1Temperature', modbus_dict["mb_p1_Temp"])
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/pump1Voltage', modbus_dict["mb_p1_Mains_Volt"])
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/pump2Current', modbus_dict["mb_p2_Motor_Current"])
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/pump2Pressure', modbus_dict["mb_p2_Vac"])
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/pump2Temperature', modbus_dict["mb_p2_Temp"])
-        http_post_json(proxy, '/api/v2/modules/' + dbkey + '/history/pump2Voltage', modbus_dict["mb_p2_Mains_Volt"])
+def timed_cycle(mode, units, interval=None):
+    # Runs one cycle of all units and records its duration, a daemon cycle that takes longer than "interval"
+    # is an overrun. The metrics files are written after the cycle.
+    start = time.monotonic()
+    try:
+        refresh_sessions(units)
+        with port_lock(mode):
+            run_cycle(mode, units)
+    finally:
+        duration = time.monotonic() - start
+        metrics.observe("sanitrax_cycle_seconds", duration)
+        metrics.inc("sanitrax_cycles_total")
+        if interval is not None and duration > interval:
+            metrics.inc("sanitrax_cycle_overruns_total")
+        metrics.set("sanitrax_last_cycle_timestamp_seconds", time.time())
+        try:
+            metrics.write(METRICS_PROM_FILE, METRICS_JSON_FILE)
+        except OSError as ex:
+            print("Unable to write the metrics:", ex)
+
+
+def shutdown(units):
+    # Uploads history points that are still waiting, writes the buffered log rows, stops the worker threads and
+    # closes the serial ports
+    for unit in units:
+        if unit.subscription is not None:
+            unit.subscription.stop()
+        if unit.history is not None and unit.history.points:
+            failed = unit.history.flush()
+            if failed:
+                get_spool(unit).append('telemetry', {'history': failed})
+        if unit.spool is not None:
+            unit.spool.close()
+        if unit.publisher is not None:
+            unit.publisher.close()
+        for logger in unit.loggers.values():
+            logger.close()
+        for store in unit.stores.values():
+            store.close()
+        if unit.water is not None:
+            unit.water.close()
+    if status_server is not None:
+        status_server.stop()
+    if port_workers is not None:
+        port_workers.shutdown()
+    if executor is not None:
+        executor.shutdown()
+    for session in sessions.values():
+        session.close()
+
+
+def stop_daemon(signum, frame):
+    # Let the daemon finish its current cycle and exit
+    global running
+    running = False
+    wakeup.set()
+
+
+def fleet_activity(units):
+    # True if the plant of any unit is active, None if no unit could be read
+    states = [unit.active for unit in units if unit.active is not None]
+    return any(states) if states else None
+
+
+def run_daemon(mode, interval, units, scheduler=None):
+    # Runs main() every "interval" seconds in the same process, so the serial port, the HTTP connection pool
+    # and the in-memory state are kept between cycles. With a PollScheduler the interval follows the activity
+    # of the plant instead, "interval" is not used then. Actions from the app are received in the background and
+    # start a cycle at once.
+    global status_server
+    if STATUS_PORT or STATUS_SOCKET:
+        from status_server import StatusServer
+        status_server = StatusServer(STATUS_PORT, STATUS_SOCKET)
+        status_server.start()
+    if mode == "firebase" and ACTION_WAIT > 0:
+        from action_subscription import ActionSubscription
+        for unit in units:
+            unit.subscription = ActionSubscription(proxy, actions_command(unit), get_http, ACTION_WAIT, wakeup.set,
+                                                   record_http, record_action_poll)
+            unit.subscription.start()
+    signal.signal(signal.SIGTERM, stop_daemon)
+    signal.signal(signal.SIGINT, stop_daemon)
+    while running:
+        start = time.monotonic()
+        if scheduler is not None:
+            # The current interval of the scheduler is the budget of this cycle and the time until the next one
+            interval = scheduler.interval
+        try:
+            timed_cycle(mode, units, interval)
+        except TimeoutError:
+            print("Serial port in use by a maintenance script, cycle skipped")
+        except Exception as ex:
+            print("Cycle failed:", ex)
+        if debug > 0:
+            for port, session in sessions.items():
+                print("Modbus session", port + ":", session.stats())
+            for unit in units:
+                if unit.subscription is not None:
+                    print("Actions of", unit.dbkey + ":", unit.subscription.stats())
+        if scheduler is not None:
+            interval = scheduler.next_interval(fleet_activity(units))
+            if debug > 0:
+                print("Next poll in", interval, "s")
+        delay = interval - (time.monotonic() - start)
+        while running and delay > 0 and not wakeup.is_set():
+            wakeup.wait(min(delay, 1.0))
+            delay = interval - (time.monotonic() - start)
+        wakeup.clear()
 
 
 if __name__ == "__main__":
-    global dbkey
     global debug
-    debug = 0
-    if len(sys.argv) < 2:
-        print("Usage: Sanitrax_CTRL.py key [debug: 0 or 1]")
+    parser = argparse.ArgumentParser(description="Sanitrax controller polling script")
+    parser.add_argument("key", nargs="?", help="database key, or \"" + RESTAPI + "\" for NI-Toolkit json dumps")
+    parser.add_argument("debug", nargs="?", type=int, default=0, help="debug: 0 or 1")
+    parser.add_argument("--daemon", action="store_true", help="keep running and poll every interval")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL,
+                        help="seconds between polls in daemon mode (default %(default)s)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="daemon mode: poll fast while the plant is active and slow when it is idle")
+    parser.add_argument("--min-interval", type=float,
+                        help="adaptive polling: seconds between polls while active (default %g)" % POLL_MIN_INTERVAL)
+    parser.add_argument("--max-interval", type=float,
+                        help="adaptive polling: seconds between polls while idle (default %g)" % POLL_MAX_INTERVAL)
+    parser.add_argument("--proxy", default=proxy, help="address of the proxy (default %(default)s)")
+    parser.add_argument("--action-wait", type=float, default=ACTION_WAIT,
+                        help="daemon mode: seconds the proxy may hold the request for actions, 0 fetches them "
+                             "every cycle (default %(default)s)")
+    parser.add_argument("--history-cycles", type=int, default=HISTORY_CYCLES,
+                        help="number of cycles of history points to upload together (default %(default)s)")
+    parser.add_argument("--resync-cycles", type=int, default=STATUS_RESYNC_CYCLES,
+                        help="number of change-only status updates between full updates (default %(default)s)")
+    parser.add_argument("--sequential", action="store_true",
+                        help="run the serial and HTTP calls one after the other instead of overlapping them")
+    parser.add_argument("--log-format", choices=("csv", "binary", "both"), default=LOG_FORMAT,
+                        help="format of the raw register log (default %(default)s)")
+    parser.add_argument("--status-port", type=int, default=STATUS_PORT,
+                        help="daemon mode: serve the decoded state over HTTP on this port of 127.0.0.1")
+    parser.add_argument("--status-socket", default=STATUS_SOCKET,
+                        help="daemon mode: serve the decoded state over HTTP on this Unix socket")
+    parser.add_argument("--fleet", metavar="FILE",
+                        help="poll the controllers of a fleet configuration (see fleet.py) in firebase mode")
+    parser.add_argument("--metrics-file", default=METRICS_PROM_FILE,
+                        help="Prometheus textfile with the metrics (default %(default)s)")
+    parser.add_argument("--metrics-json", default=METRICS_JSON_FILE,
+                        help="JSON file with the metrics, also read at start (default %(default)s)")
+    parser.add_argument("--no-metrics", action="store_true", help="do not write the metrics files")
+    parser.add_argument("--no-compat-files", action="store_true",
+                        help="restapi mode: only write the snapshot file, not the json file per section")
+    args = parser.parse_args()
+    if args.adaptive and not args.daemon:
+        parser.error("--adaptive requires --daemon")
+    if (args.min_interval is not None or args.max_interval is not None) and not args.adaptive:
+        parser.error("--min-interval and --max-interval require --adaptive")
+
+    debug = args.debug
+    proxy = args.proxy
+    HISTORY_CYCLES = args.history_cycles
+    ACTION_WAIT = args.action_wait
+    STATUS_RESYNC_CYCLES = args.resync_cycles
+    concurrent = not args.sequential
+    LOG_FORMAT = args.log_format
+    RESTAPI_COMPAT_FILES = not args.no_compat_files
+    STATUS_PORT = args.status_port
+    STATUS_SOCKET = args.status_socket
+    METRICS_PROM_FILE = None if args.no_metrics else args.metrics_file
+    METRICS_JSON_FILE = None if args.no_metrics else args.metrics_json
+    if METRICS_JSON_FILE is not None:
+        metrics.restore(METRICS_JSON_FILE)
+    if args.fleet is not None:
+        try:
+            units = load_fleet(args.fleet, default_port=PORT)
+        except (OSError, KeyError, TypeError, ValueError) as ex:
+            print("Invalid fleet configuration:", ex)
+            sys.exit(1)
+        mode = "firebase"
+    elif args.key is None:
+        print("Usage: Sanitrax_CTRL.py key [debug: 0 or 1] [--daemon] [--interval seconds]")
         print("Running in console mode now")
-        main("console")
-
+        units = [Unit(None, PORT)]
+        mode = "console"
     else:
-
-        dbkey = sys.argv[1]
-        if len(sys.argv) > 2:
-            debug = int(sys.argv[2])
         if debug > 0:
-            print("dbkey:", dbkey)
+            print("dbkey:", args.key)
+        units = [Unit(args.key, PORT)]
+        # HACK: if key = "restapi" then use a special console version
+        mode = RESTAPI if args.key == RESTAPI else "firebase"
+    fleet_size = len(units)
+    scheduler = None
+    if args.adaptive:
+        try:
+            scheduler = PollScheduler(POLL_MIN_INTERVAL if args.min_interval is None else args.min_interval,
+                                      POLL_MAX_INTERVAL if args.max_interval is None else args.max_interval)
+        except ValueError as ex:
+            print(ex)
+            sys.exit(1)
+    for unit in units:
+        setup_unit(unit)
 
+    if mode == "console":
+        try:
+            if args.daemon:
+                run_daemon(mode, args.interval, units, scheduler)
+            else:
+                timed_cycle(mode, units)
+        finally:
+            shutdown(units)
+    else:
         try:
-            with SimpleFlock(LOCK_FILE, LOCK_TIMEOUT):
-                # HACK: if key = "restapi" then use a special console version
-                if dbkey == RESTAPI:
-                    main(RESTAPI)
-                else:
-                    main("firebase")
+            # The daemon keeps the instance lock for its whole lifetime, so cron started instances will quit. The
+            # lock of the serial port is taken per cycle, see port_lock().
+            with SimpleFlock(INSTANCE_LOCK_FILE, LOCK_TIMEOUT):
+                try:
+                    if args.daemon:
+                        run_daemon(mode, args.interval, units, scheduler)
+                    else:
+                        timed_cycle(mode, units)
+                finally:
+                    shutdown(units)
         except TimeoutError:
             print("Unable to acquire lock, quitting...")
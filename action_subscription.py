@@ -0,0 +1,163 @@
+import json
+import time
+import threading
+
+# Longest time in seconds that the proxy is asked to hold a request for the actions
+LONG_POLL_WAIT = 25.0
+# Time in seconds before a failed long-poll request is tried again
+RETRY_DELAY = 5.0
+# Number of long-poll requests in a row that may fail before the actions are fetched once per cycle instead
+LONG_POLL_FAILURES = 3
+# Time in seconds after a fallback before the long-poll request is tried again
+REPROBE_DELAY = 300.0
+# How the actions are fetched
+LONG_POLL = "long-poll"
+CONDITIONAL = "conditional"
+PLAIN = "plain"
+
+
+## Keeps the actions requested from the app (resets, applyChanges) of one module, so the cycle does not have to
+#  wait for a GET of /settings/actions. A background thread keeps a long-poll request open against the proxy:
+#  "GET <command>?wait=<seconds>" with the ETag of the last answer in If-None-Match, which the proxy holds until
+#  the actions change and then answers with the new actions (the protocol of status_server.py).
+#  A proxy that answers at once while nothing changed does not hold requests, and a proxy that keeps failing
+#  the long-poll request may not support it. The actions are then fetched once per cycle by take() instead, with
+#  If-None-Match when the proxy sends an ETag (304 while nothing changed) and with a plain GET otherwise, and
+#  the long-poll request is tried again every REPROBE_DELAY seconds, so an outage does not end it for good.
+#  A new ETag counts as a change, so the same action requested twice is delivered twice. Without ETags the
+#  actions themselves are compared.
+#  Only held requests use the long timeout of the subscription, all others use the connection pool of the cycle.
+class ActionSubscription:
+    ## Initializes the subscription, call start() to open the long-poll request
+    #  @param target Address of the proxy
+    #  @param command Database path of the actions
+    #  @param http Function returning the connection pool of the cycle, for the requests that are not held
+    #  @param wait (optional) Longest time in seconds that the proxy may hold a request
+    #  @param on_change (optional) Function called from the background thread when actions arrive that request
+    #         something, so the caller can run its next cycle at once
+    #  @param record (optional) Function (method, command, start, sent, response, error) called after every
+    #         request that is not held, for the metrics
+    #  @param record_held (optional) Function (status) called after every held request, None if it failed
+    def __init__(self, target: str, command: str, http, wait: float=LONG_POLL_WAIT, on_change=None, record=None,
+                 record_held=None):
+        self.target = target
+        self.command = command
+        self.http = http
+        self.wait = wait
+        self.on_change = on_change
+        self.record = record
+        self.record_held = record_held
+        self.mode = LONG_POLL
+        self.requests = 0
+        self.deliveries = 0
+        self.errors = 0
+        self.__http = None
+        self.__etag = None
+        self.__actions = None
+        self.__pending = False
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        import urllib3
+        self.__http = urllib3.PoolManager(maxsize=1, retries=False,
+                                          timeout=urllib3.Timeout(connect=2.0, read=self.wait + 10.0))
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    ## Stops the background thread, a request that is still held by the proxy is abandoned
+    def stop(self):
+        self.__stopped.set()
+
+    ## Returns the actions if they changed since the last call, otherwise None. Without a long-poll request the
+    #  actions are fetched first, a failed request also returns None. A proxy without ETags answers every fetch
+    #  in full anyway, so then the actions of every cycle are returned, as they were before the subscription.
+    def take(self):
+        if self.mode != LONG_POLL:
+            try:
+                self.__fetch(0)
+            except Exception:
+                self.errors += 1
+                return None
+        with self.__lock:
+            if not self.__pending and self.mode != PLAIN:
+                return None
+            self.__pending = False
+            return self.__actions
+
+    ## Hands the last actions out again on the next take(), for actions whose acknowledgement could not be
+    #  delivered: their flags are still set in the database, which does not change until they are acknowledged
+    def retry(self):
+        with self.__lock:
+            self.__pending = self.__actions is not None
+
+    ## Returns the counters of the subscription
+    def stats(self) -> dict:
+        return {"mode": self.mode, "requests": self.requests, "deliveries": self.deliveries, "errors": self.errors}
+
+    def __run(self):
+        failures = 0
+        while not self.__stopped.is_set():
+            start = time.monotonic()
+            try:
+                changed = self.__fetch(self.wait)
+            except Exception:
+                self.errors += 1
+                failures += 1
+                if failures < LONG_POLL_FAILURES:
+                    self.__stopped.wait(RETRY_DELAY)
+                    continue
+            else:
+                if changed or time.monotonic() - start >= self.wait / 2:
+                    self.mode = LONG_POLL
+                    failures = 0
+                    continue
+                # The proxy answered at once although nothing changed, it does not hold requests
+            # Fetch the actions once per cycle in take() until the next try of the long-poll request. The mode
+            # changes back to LONG_POLL only once a request was held, so take() keeps fetching during the probe.
+            failures = 0
+            self.mode = CONDITIONAL if self.__etag is not None else PLAIN
+            self.__stopped.wait(REPROBE_DELAY)
+
+    ## Fetches the actions, waiting up to "wait" seconds for a change once an ETag is known.
+    #  Returns True if the actions changed.
+    def __fetch(self, wait: float) -> bool:
+        headers = {}
+        url = self.target + self.command
+        held = self.__etag is not None and wait > 0
+        if self.__etag is not None:
+            headers['If-None-Match'] = self.__etag
+        if held:
+            url += '?wait=%g' % wait
+        self.requests += 1
+        start = time.monotonic()
+        response = None
+        error = None
+        try:
+            response = (self.__http if held else self.http()).request('GET', url, headers=headers)
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            if held and self.record_held is not None:
+                self.record_held(response.status if response is not None else None)
+            elif not held and self.record is not None:
+                self.record('GET', self.command, start, 0, response, error)
+        if response.status == 304:
+            return False
+        if response.status != 200:
+            raise ValueError("Unexpected status %d for %s" % (response.status, self.command))
+        actions = json.loads(response.data.decode('utf-8'))
+        etag = response.headers.get('ETag')
+        with self.__lock:
+            changed = etag != self.__etag if etag is not None else actions != self.__actions
+            self.__etag = etag
+            if changed:
+                self.__actions = actions
+                self.__pending = True
+                self.deliveries += 1
+        if changed and self.on_change is not None and isinstance(actions, dict) and any(actions.values()):
+            self.on_change()
+        return changed
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmark of the poll cycle: runs the cycle of Sanitrax_CTRL.py in console, restapi and firebase mode
+# against the simulated controller (modbus_simulator.py) and the stand-in proxy (fake_proxy.py), and reports the
+# time per stage, the cycles per second and the peak RSS. Every scenario and mode runs in its own process, in a
+# temporary directory, so the results do not influence each other and nothing of a real installation is touched.
+#   python3 benchmark.py [--scenarios baseline,slow-link] [--modes firebase] [--cycles 20] [--output results.json]
+#   python3 benchmark.py --compare results.json     exits with 1 when a run got slower than --threshold
+#   python3 benchmark.py --startup [--repeat 10]      cold start: a new interpreter per run, as from cron
+# The stage times are exclusive: the time of "decode" does not include the settings sync and file writes that
+# process() calls. The serial and "http ..." stages count the calls that failed as errors.
+# In firebase mode the actions are delivered by an ActionSubscription, as in the daemon. A run that ends with an
+# action still set in the database (it was not executed or not acknowledged) fails.
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import re
+import resource
+import tempfile
+import threading
+import subprocess
+from contextlib import redirect_stdout
+
+MODES = ("console", "restapi", "firebase")
+DBKEY = "benchmark"
+
+# Plant that changes its fault bits and states every 50 ms, so every cycle decodes and uploads changes
+FAULT_SCENARIO = [
+    {"name": "faults", "duration": 0.05,
+     "set": {"mb_fault": ["Tank_Empty", "Hydrophore_Timeout", "Pump1_Fault", "Pump2_Overheat", "Emergency_Stop"],
+             "mb_bstate": "BREAKTANK_AUTO_TIMEOUT", "mb_hstate": "HYDROPHORE_AUTO_TIMEOUT",
+             "mb_p1state": "PUMP_FAIL", "mb_p2state": "PUMP_AUTO_TIMEOUT", "mb_input_top": 0x5A5A},
+     "rate": {"mb_water_counter": 200}},
+    {"name": "recover", "duration": 0.05,
+     "set": {"mb_fault": ["Water_Supply_Error", "Pump1_Comm_Error", "Dosing_Error"],
+             "mb_bstate": "BREAKTANK_AUTO_LOW", "mb_hstate": "HYDROPHORE_AUTO_ON",
+             "mb_p1state": "PUMP_AUTO_ON", "mb_p2state": "PUMP_AUTO_ON", "mb_input_top": 0xA5A5},
+     "rate": {"mb_water_counter": 200}}]
+
+# Scenario: (description, simulator options, proxy options or None for a proxy that refuses connections,
+# plant scenario or None for the default one, options: "actions" set from the app before the first cycle,
+# "ports" number of serial ports with one simulated controller each)
+SCENARIOS = {
+    "baseline": ("fast bus and proxy", {}, {}, None, {}),
+    "slow-link": ("30-50 ms bus answers, 200 ms proxy answers",
+                  {"latency": 0.03, "jitter": 0.02}, {"delay": 0.2}, None, {}),
+    "dead-proxy": ("proxy refuses connections, uploads go to the spool", {}, None, None, {}),
+    "heavy-faults": ("fault bits and states change every cycle", {}, {}, FAULT_SCENARIO, {}),
+    "noisy-bus": ("10% answers with a bad CRC, 5% without answer", {"crc_error_rate": 0.1, "timeout_rate": 0.05},
+                  {}, None, {}),
+    "lost-ack": ("a reset from the app whose first acknowledgement fails", {}, {"fail_acks": 1}, None,
+                 {"actions": {"resetBreaktank": True}}),
+    "slow-bus": ("30-50 ms bus answers, fast proxy", {"latency": 0.03, "jitter": 0.02}, {}, None, {}),
+    "two-ports": ("slow-bus with a controller on each of two serial ports", {"latency": 0.03, "jitter": 0.02}, {},
+                  None, {"ports": 2}),
+}
+
+# Cold start run: a new interpreter imports Sanitrax_CTRL and runs one cycle the way a run from cron does, against
+# the simulator and proxy of the benchmark process. Arguments: package directory, mode, port, proxy, directory.
+STARTUP_CODE = '''
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import Sanitrax_CTRL as S
+imported = time.perf_counter()
+mode, directory = sys.argv[2], sys.argv[5]
+S.os.chdir(directory)
+S.debug = 0
+S.BROKER_SOCKET = None
+S.proxy = sys.argv[4]
+S.SNAPSHOT_FILE = directory + "/snapshot.json"
+S.RESTAPI_COMPAT_DIR = directory
+S.GPS_INPUT_FILE = directory + "/gps_data.json"
+S.METRICS_PROM_FILE = directory + "/metrics.prom"
+S.METRICS_JSON_FILE = directory + "/metrics.json"
+S.metrics.restore(S.METRICS_JSON_FILE)
+units = [S.setup_unit(S.Unit("benchmark" if mode == "firebase" else None, sys.argv[3], directory=directory))]
+stdout, sys.stdout = sys.stdout, open(S.os.devnull, "w")
+try:
+    S.timed_cycle(mode, units)
+finally:
+    S.shutdown(units)
+    sys.stdout = stdout
+print(S.json.dumps({"import": imported - start, "cycle": time.perf_counter() - imported, "modules": len(sys.modules),
+                    "failed": units[0].active is None}))
+'''
+
+# Functions of Sanitrax_CTRL.py that are timed, and their stage
+STAGES = (('modbus_read', "serial read"),
+          ('modbus_write', "serial write"),
+          ('process', "decode"),
+          ('load_settings', "settings sync"),
+          ('save_settings', "settings sync"),
+          ('write_settings', "settings sync"),
+          ('water_counter', "water counter"),
+          ('write_log', "file writes"),
+          ('write_store', "file writes"),
+          ('write_restapi', "file writes"),
+          ('print_console', "console output"),
+          ('handle_actions', "actions"),
+          ('build_status', "build status"),
+          ('collect_history', "history"),
+          ('publish_status', "status publish"),
+          ('replay_spool', "spool replay"))
+
+
+## Collects the exclusive time per stage, also for stages that run in worker threads
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    ## Returns a function that calls "function" and adds its time to "stage"
+    #  @param stage Name of the stage, or a function that returns the name from the arguments
+    #  @param failed (optional) Function that returns True if a result is an error
+    def wrap(self, stage, function, failed=None):
+        def timed(*args, **kwargs):
+            stack = self.__local.__dict__.setdefault('stack', [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = failed is not None and failed(result)
+                return result
+            finally:
+                elapsed = time.perf_counter() - start
+                children = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                self.add(stage(*args) if callable(stage) else stage, elapsed - children, error)
+        return timed
+
+    def add(self, stage: str, seconds: float, failed: bool=False):
+        with self.__lock:
+            entry = self.stages.setdefault(stage, {"calls": 0, "errors": 0, "total": 0.0, "max": 0.0})
+            entry["calls"] += 1
+            entry["errors"] += int(failed)
+            entry["total"] += seconds
+            entry["max"] = max(entry["max"], seconds)
+
+    def reset(self):
+        with self.__lock:
+            self.stages = {}
+
+
+## Returns the HTTP stage name of a request, with the database key replaced by "{dbkey}"
+def http_stage(method: str, command: str) -> str:
+    return "http " + method + " " + re.sub(re.escape(DBKEY) + r"(-\d+)?", "{dbkey}", command)
+
+
+## Returns True if modbus_read() or modbus_write() failed
+def failed_transaction(result) -> bool:
+    return isinstance(result, str) and result == "error"
+
+
+## Returns an address on which nothing listens
+def refused_address() -> str:
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % listener.getsockname()[1]
+    listener.close()
+    return address
+
+
+## Returns the "fraction" percentile of a sorted list
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+## Runs the cycles of one scenario and mode in this process and returns the result
+def run_benchmark(scenario: str, mode: str, cycles: int, warmup: int, concurrent: bool) -> dict:
+    from modbus_simulator import ModbusSimulator, SimulatedPlant
+    from fake_proxy import FakeProxy
+    import Sanitrax_CTRL as S
+
+    from action_subscription import ActionSubscription
+
+    description, simulator_options, proxy_options, plant_scenario, options = SCENARIOS[scenario]
+    directory = tempfile.mkdtemp(prefix="sanitrax_benchmark_")
+    os.makedirs(os.path.join(directory, 'log'))
+    os.chdir(directory)
+    S.debug = 0
+    S.concurrent = concurrent
+    S.BROKER_SOCKET = None
+    S.SNAPSHOT_FILE = os.path.join(directory, 'snapshot.json')
+    S.RESTAPI_COMPAT_DIR = directory
+    S.GPS_INPUT_FILE = os.path.join(directory, 'gps_data.json')
+    S.LOG_FORMAT = "both"
+
+    timer = StageTimer()
+    for name, stage in STAGES:
+        setattr(S, name, timer.wrap(stage, getattr(S, name), failed_transaction if name.startswith('modbus_') else None))
+    S.http_get_json = timer.wrap(lambda target, command: http_stage("GET", command), S.http_get_json,
+                                 lambda result: type(result) is int and result == 0)
+    S.http_post_json = timer.wrap(lambda target, command, data: http_stage("POST", command), S.http_post_json,
+                                  lambda status: not 200 <= status < 300)
+
+    proxy = FakeProxy(**proxy_options) if proxy_options is not None else None
+    ports = options.get("ports", 1)
+    simulators = [ModbusSimulator({1: SimulatedPlant(plant_scenario)}, seed=1 + n, **simulator_options)
+                  for n in range(ports)]
+    durations = []
+    failed = 0
+    try:
+        for simulator in simulators:
+            simulator.start()
+        if proxy is not None:
+            proxy.start()
+        S.proxy = proxy.address if proxy is not None else refused_address()
+        if ports == 1:
+            units = [S.Unit(DBKEY if mode == "firebase" else None, simulators[0].port, directory=directory)]
+        else:
+            # A fleet, every unit has its own port and directory as with --fleet
+            units = [S.Unit("%s-%d" % (DBKEY, n + 1), simulator.port,
+                            directory=os.path.join(directory, "%s-%d" % (DBKEY, n + 1)),
+                            log_name="Sanitrax_%s-%d" % (DBKEY, n + 1)) for n, simulator in enumerate(simulators)]
+        S.fleet_size = len(units)
+        units = [S.setup_unit(unit) for unit in units]
+        if mode == "firebase":
+            if proxy is not None:
+                proxy.set_actions(**options.get("actions", {}))
+            for unit in units:
+                unit.subscription = ActionSubscription(S.proxy, S.actions_command(unit), S.get_http,
+                                                       record=S.record_http, record_held=S.record_action_poll)
+                unit.subscription.start()
+            deadline = time.monotonic() + 2.0
+            while proxy is not None and not all(unit.subscription.deliveries for unit in units) \
+                    and time.monotonic() < deadline:
+                time.sleep(0.01)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for cycle in range(warmup + cycles):
+                if cycle == warmup:
+                    timer.reset()
+                    failed = 0
+                start = time.perf_counter()
+                S.run_cycle(mode, units)
+                durations.append(time.perf_counter() - start)
+                failed += int(any(unit.active is None for unit in units))
+            S.shutdown(units)
+        open_actions = sorted(name for name, value in proxy.actions.items() if value) if proxy is not None else []
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+        if proxy is not None:
+            proxy.stop()
+        os.chdir('/')
+        shutil.rmtree(directory, ignore_errors=True)
+
+    durations = sorted(durations[warmup:])
+    total = sum(durations)
+    return {"scenario": scenario,
+            "mode": mode,
+            "description": description,
+            "engine": "concurrent" if concurrent else "sequential",
+            "cycles": cycles,
+            "failed_cycles": failed,
+            "open_actions": open_actions,
+            "cycles_per_second": cycles / total if total else 0.0,
+            "cycle": {"mean": total / cycles if cycles else 0.0,
+                      "p50": percentile(durations, 0.5),
+                      "p95": percentile(durations, 0.95),
+                      "max": durations[-1] if durations else 0.0},
+            "stages": {name: dict(entry, mean=entry["total"] / entry["calls"])
+                       for name, entry in sorted(timer.stages.items())},
+            "simulator": simulators[0].stats() if ports == 1 else [simulator.stats() for simulator in simulators],
+            # Linux reports the peak in kilobytes
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+## Measures the cold start of a mode: every run is a new interpreter that imports Sanitrax_CTRL and runs one cycle
+#  against the simulator and proxy of this process. The total includes the start of the interpreter.
+def run_startup(mode: str, repeat: int) -> dict:
+    from modbus_simulator import ModbusSimulator
+    from fake_proxy import FakeProxy
+
+    package = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    with ModbusSimulator() as simulator, FakeProxy() as proxy:
+        for run in range(repeat):
+            directory = tempfile.mkdtemp(prefix="sanitrax_startup_")
+            os.makedirs(os.path.join(directory, 'log'))
+            try:
+                start = time.perf_counter()
+                process = subprocess.run([sys.executable, "-c", STARTUP_CODE, package, mode, simulator.port,
+                                          proxy.address, directory],
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+                wall = time.perf_counter() - start
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            if process.returncode != 0:
+                print("Startup", mode, "failed:", process.stderr.strip().splitlines()[-1:], file=sys.stderr)
+                return None
+            runs.append(dict(json.loads(process.stdout.strip().splitlines()[-1]), wall=wall))
+
+    def statistics(key):
+        values = sorted(run[key] for run in runs)
+        return {"min": values[0], "median": percentile(values, 0.5), "max": values[-1]}
+
+    return {"scenario": "startup",
+            "mode": mode,
+            "runs": repeat,
+            "failed_cycles": sum(run["failed"] for run in runs),
+            "wall": statistics("wall"),
+            "import": statistics("import"),
+            "cycle": statistics("cycle"),
+            "modules": runs[-1]["modules"]}
+
+
+## Prints a cold start result
+def print_startup(result: dict, out=sys.stdout):
+    print("startup       %-9s total %6.1f ms (min %6.1f)  import %6.1f ms  first cycle %6.1f ms  %d modules"
+          "  failed %d/%d" % (result["mode"], 1000.0 * result["wall"]["median"], 1000.0 * result["wall"]["min"],
+                              1000.0 * result["import"]["median"], 1000.0 * result["cycle"]["median"],
+                              result["modules"], result["failed_cycles"], result["runs"]), file=out)
+
+
+## Runs one scenario and mode in a new process and returns its result, or None if it failed
+def run_isolated(scenario: str, mode: str, cycles: int, warmup: int, concurrent: bool):
+    command = [sys.executable, os.path.abspath(__file__), "--run", scenario, mode, "--cycles", str(cycles),
+               "--warmup", str(warmup)]
+    if not concurrent:
+        command.append("--sequential")
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        print("Benchmark", scenario, mode, "failed:", process.stderr.strip().splitlines()[-1:], file=sys.stderr)
+        return None
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+## Prints a result as a summary line and its stages
+def print_result(result: dict, out=sys.stdout):
+    print("%-13s %-9s %7.1f cycles/s  mean %7.1f ms  p95 %7.1f ms  failed %d/%d  peak RSS %6.1f MB" % (
+        result["scenario"], result["mode"], result["cycles_per_second"], 1000.0 * result["cycle"]["mean"],
+        1000.0 * result["cycle"]["p95"], result["failed_cycles"], result["cycles"], result["peak_rss_kb"] / 1024.0),
+        file=out)
+    if result["open_actions"]:
+        print("    actions still set in the database:", ", ".join(result["open_actions"]), file=out)
+    for name, stage in sorted(result["stages"].items(), key=lambda item: -item[1]["total"]):
+        print("    %-48s %5d calls %4d errors  %8.2f ms/cycle  max %7.2f ms" % (
+            name, stage["calls"], stage["errors"], 1000.0 * stage["total"] / result["cycles"],
+            1000.0 * stage["max"]), file=out)
+
+
+## Compares results with an earlier run, returns the list of regressions as text
+#  @param threshold Fraction by which the mean cycle time, the peak RSS or the median cold start may grow
+def compare(results: list, previous: list, threshold: float) -> list:
+    earlier = {(result["scenario"], result["mode"]): result for result in previous}
+    regressions = []
+    for result in results:
+        old = earlier.get((result["scenario"], result["mode"]))
+        if old is None:
+            continue
+        if result["scenario"] == "startup":
+            values = (("median cold start", result["wall"]["median"], old["wall"]["median"]),)
+        else:
+            values = (("mean cycle time", result["cycle"]["mean"], old["cycle"]["mean"]),
+                      ("peak RSS", result["peak_rss_kb"], old["peak_rss_kb"]))
+        for label, new_value, old_value in values:
+            if old_value > 0 and new_value > old_value * (1.0 + threshold):
+                regressions.append("%s %s: %s %.4g -> %.4g (+%.0f%%)" % (
+                    result["scenario"], result["mode"], label, old_value, new_value,
+                    100.0 * (new_value / old_value - 1.0)))
+    return regressions
+
+
+## Compares the cycle time of "two-ports" with "slow-bus", returns the modes in which the ports were not polled in
+#  parallel as text. The ports have their own worker, so two ports may not take much longer than one.
+#  @param limit Fraction by which the mean cycle time of two ports may exceed the one of a single port
+def check_ports(results: list, limit: float=1.5) -> list:
+    single = {result["mode"]: result for result in results if result["scenario"] == "slow-bus"}
+    failures = []
+    for result in results:
+        if result["scenario"] == "two-ports" and result["mode"] in single:
+            ratio = result["cycle"]["mean"] / single[result["mode"]]["cycle"]["mean"]
+            if ratio > limit:
+                failures.append("%s: two ports take %.1fx the cycle time of one" % (result["mode"], ratio))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the Sanitrax poll cycle against simulated hardware")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="comma separated scenarios (default %(default)s)")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated modes (default %(default)s)")
+    parser.add_argument("--cycles", type=int, default=20, help="measured cycles per run (default %(default)s)")
+    parser.add_argument("--warmup", type=int, default=2, help="cycles before measuring (default %(default)s)")
+    parser.add_argument("--sequential", action="store_true", help="benchmark the sequential cycle engine")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed growth of the cycle time and peak RSS with --compare (default %(default)s)")
+    parser.add_argument("--startup", action="store_true",
+                        help="measure the cold start of the modes instead of the cycles of the scenarios")
+    parser.add_argument("--repeat", type=int, default=10, help="cold start runs per mode (default %(default)s)")
+    parser.add_argument("--run", nargs=2, metavar=("SCENARIO", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(json.dumps(run_benchmark(args.run[0], args.run[1], args.cycles, args.warmup, not args.sequential)))
+        return
+
+    scenarios = args.scenarios.split(',')
+    modes = args.modes.split(',')
+    for name in scenarios + modes:
+        if name not in SCENARIOS and name not in MODES:
+            print("Unknown scenario or mode:", name, file=sys.stderr)
+            sys.exit(2)
+    results = []
+    if args.startup:
+        scenarios = ["startup"]
+        for mode in modes:
+            result = run_startup(mode, args.repeat)
+            if result is not None:
+                print_startup(result)
+                results.append(result)
+    else:
+        for scenario in scenarios:
+            for mode in modes:
+                result = run_isolated(scenario, mode, args.cycles, args.warmup, not args.sequential)
+                if result is not None:
+                    print_result(result)
+                    results.append(result)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump({"time": time.time(), "python": platform.python_version(), "machine": platform.machine(),
+                       "results": results}, fp, indent=2)
+    regressions = []
+    if args.compare is not None:
+        with open(args.compare, 'r') as fp:
+            regressions = compare(results, json.load(fp)["results"], args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+    serialized = check_ports(results) if not args.startup else []
+    for failure in serialized:
+        print("SERIALIZED", failure)
+    unhandled = [result for result in results if result.get("open_actions")]
+    sys.exit(1 if regressions or serialized or unhandled or len(results) < len(scenarios) * len(modes) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import csv
+import time
+
+
+## Writes rows to one CSV file per UTC day ("<directory>/YYYY-MM-DD_<name>.csv"). The file of the current day is
+#  kept open and rows are buffered in memory, they are written once "flush_rows" rows are waiting or
+#  "flush_interval" seconds have passed. The header is written only when a new file is started.
+class CsvLogger:
+    ## Initializes the logger, the file is opened with the first row
+    #  @param directory Directory of the log files
+    #  @param name Name of the log, part of the file name
+    #  @param header List of column names after the "Date" and "Time (UTC)" columns
+    #  @param flush_rows (optional) Number of buffered rows that triggers a write
+    #  @param flush_interval (optional) Maximum time in seconds that a row stays in the buffer
+    def __init__(self, directory: str, name: str, header, flush_rows: int=1, flush_interval: float=0.0):
+        self.directory = directory
+        self.name = name
+        self.header = ["Date", "Time (UTC)"] + list(header)
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval
+        self.__rows = []
+        self.__day = None
+        self.__fp = None
+        self.__writer = None
+        self.__last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ## Returns the file name of the log for a date (YYYY-MM-DD)
+    def filename(self, logdate: str) -> str:
+        return os.path.join(self.directory, logdate + "_" + self.name + '.csv')
+
+    def __open(self, logdate: str):
+        self.__close_file()
+        self.__fp = open(self.filename(logdate), 'a', newline='')
+        self.__writer = csv.writer(self.__fp, delimiter=";", quoting=csv.QUOTE_MINIMAL)
+        self.__day = logdate
+        # A new (empty) file gets a header
+        if self.__fp.tell() == 0:
+            self.__writer.writerow(self.header)
+
+    def __close_file(self):
+        if self.__fp is not None:
+            self.__fp.close()
+            self.__fp = None
+            self.__writer = None
+
+    ## Adds a row with the current UTC date and time
+    #  @param logdata List of values, in the order of the header
+    #  @param timestamp (optional) Unix timestamp of the row, defaults to now
+    def write(self, logdata, timestamp: float=None):
+        logdate, logtime = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp)).split(' ')
+        row = [logdate, logtime]
+        row.extend(logdata)
+        self.__rows.append(row)
+        if len(self.__rows) >= self.flush_rows or time.monotonic() - self.__last_flush >= self.flush_interval:
+            self.flush()
+
+    ## Writes all buffered rows to their files, a new file is started for every new UTC day
+    def flush(self):
+        for row in self.__rows:
+            if row[0] != self.__day:
+                self.__open(row[0])
+            self.__writer.writerow(row)
+        self.__rows = []
+        self.__last_flush = time.monotonic()
+        if self.__fp is not None:
+            self.__fp.flush()
+
+    ## Writes the buffered rows and closes the file
+    def close(self):
+        self.flush()
+        self.__close_file()
+        self.__day = None
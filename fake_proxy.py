@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the proxy HTTP API, for testing uploads without a network connection.
+# Run "python3 fake_proxy.py --port 8080" and start Sanitrax_CTRL.py with "--proxy 127.0.0.1:8080".
+# The actions answer with an ETag and hold a request with a matching If-None-Match and "?wait=<seconds>" until
+# they change, like the long-poll of status_server.py. --no-long-poll and --no-etag emulate older proxies.
+
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ACTIONS = {"resetBreaktank": False,
+                   "resetHydrophore": False,
+                   "resetPump1": False,
+                   "resetPump2": False,
+                   "applyChanges": False}
+
+HISTORY_BATCH = re.compile(r"^/api/v2/modules/([^/]+)/history$")
+HISTORY_SERIES = re.compile(r"^/api/v2/modules/([^/]+)/history/([^/]+)$")
+SETTINGS = re.compile(r"^/database/modules/([^/]+)/settings/(actions|new)$")
+# Longest time in seconds that a long-poll request for the actions is held
+MAX_WAIT = 60.0
+
+
+## Request handler, the server state is kept on the FakeProxy object
+class FakeProxyHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        if self.server.proxy.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def __reply(self, status, data=None, etag=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        proxy = self.server.proxy
+        proxy.record('GET', self.path, None)
+        time.sleep(proxy.delay)
+        url = urlsplit(self.path)
+        match = SETTINGS.match(url.path)
+        if match is None:
+            self.__reply(404)
+        elif match.group(2) == 'actions':
+            self.__reply_actions(proxy, url.query)
+        else:
+            self.__reply(200, proxy.new_settings)
+
+    def __reply_actions(self, proxy, query):
+        if not proxy.etag:
+            self.__reply(200, proxy.wait_actions(None, 0)[0])
+            return
+        known = self.headers.get('If-None-Match')
+        wait = 0.0
+        if proxy.long_poll and known is not None:
+            try:
+                wait = min(float(parse_qs(query).get('wait', ['0'])[0]), MAX_WAIT)
+            except ValueError:
+                self.__reply(400)
+                return
+        actions, version = proxy.wait_actions(known, wait)
+        if version == known:
+            self.__reply(304, etag=version)
+        else:
+            self.__reply(200, actions, version)
+
+    def do_POST(self):
+        proxy = self.server.proxy
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self.__reply(400)
+            return
+        proxy.record('POST', self.path, data)
+        time.sleep(proxy.delay)
+        if self.path == '/database/update':
+            if proxy.fail_ack(data):
+                self.__reply(500)
+                return
+            proxy.update(data)
+            self.__reply(200, {"result": "OK"})
+        elif HISTORY_BATCH.match(self.path):
+            self.__reply(200 if proxy.batch else 404)
+        elif HISTORY_SERIES.match(self.path):
+            self.__reply(200)
+        else:
+            self.__reply(404)
+
+
+## Fake proxy server running in a background thread. Every request is recorded in "requests" as a
+#  (method, path, data) tuple and /database/update calls are applied to "database".
+class FakeProxy:
+    ## Initializes the server, call start() to serve
+    #  @param host (optional) Address to listen on
+    #  @param port (optional) Port to listen on, 0 picks a free port
+    #  @param batch (optional) Set to False to emulate a server without the history batch endpoint
+    #  @param delay (optional) Delay in seconds before answering every request (slow link)
+    #  @param verbose (optional) Log every request to stderr
+    #  @param long_poll (optional) Set to False to answer requests for the actions at once
+    #  @param etag (optional) Set to False to answer the actions without an ETag
+    #  @param fail_acks (optional) Number of updates of the actions (acknowledgements) to answer with 500
+    def __init__(self, host: str='127.0.0.1', port: int=0, batch: bool=True, delay: float=0.0,
+                 verbose: bool=False, long_poll: bool=True, etag: bool=True, fail_acks: int=0):
+        self.batch = batch
+        self.delay = delay
+        self.verbose = verbose
+        self.long_poll = long_poll
+        self.etag = etag
+        self.fail_acks = fail_acks
+        self.actions = dict(DEFAULT_ACTIONS)
+        self.actions_version = 1
+        self.new_settings = {}
+        self.database = {}
+        self.requests = []
+        self.__lock = threading.Condition()
+        self.__server = ThreadingHTTPServer((host, port), FakeProxyHandler)
+        self.__server.daemon_threads = True
+        self.__server.proxy = self
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    ## Returns the "host:port" address of the server, as used for the proxy setting
+    @property
+    def address(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return host + ':' + str(port)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def record(self, method: str, path: str, data):
+        with self.__lock:
+            self.requests.append((method, path, data))
+
+    def update(self, data: dict):
+        with self.__lock:
+            node = self.database.setdefault(data.get("id"), {})
+            for key in data.get("location", "").strip('/').split('/'):
+                if key:
+                    node = node.setdefault(key, {})
+            if isinstance(data.get("value"), dict):
+                # Keys with slashes are multi-path updates of nested children
+                for path, value in data["value"].items():
+                    parent = node
+                    keys = str(path).split('/')
+                    for key in keys[:-1]:
+                        if not isinstance(parent.get(key), dict):
+                            parent[key] = {}
+                        parent = parent[key]
+                    if value is None:
+                        parent.pop(keys[-1], None)
+                    else:
+                        parent[keys[-1]] = value
+            if data.get("location", "").strip('/') == "settings/actions":
+                self.actions.update(data["value"])
+                self.actions_version += 1
+                self.__lock.notify_all()
+
+    ## Returns True if the update "data" is an acknowledgement that has to fail, see "fail_acks"
+    def fail_ack(self, data: dict) -> bool:
+        with self.__lock:
+            if self.fail_acks <= 0 or data.get("location", "").strip('/') != "settings/actions":
+                return False
+            self.fail_acks -= 1
+            return True
+
+    ## Sets actions as the app does, for example set_actions(resetPump1=True), held requests are answered
+    def set_actions(self, **actions):
+        with self.__lock:
+            self.actions.update(actions)
+            self.actions_version += 1
+            self.__lock.notify_all()
+
+    ## Returns the actions and their ETag, after waiting up to "wait" seconds while the ETag is still "known"
+    def wait_actions(self, known: str, wait: float) -> tuple:
+        with self.__lock:
+            self.__lock.wait_for(lambda: '"%d"' % self.actions_version != known, wait)
+            return dict(self.actions), '"%d"' % self.actions_version
+
+    ## Returns the recorded requests whose path starts with "prefix"
+    def matching(self, prefix: str) -> list:
+        with self.__lock:
+            return [request for request in self.requests if request[1].startswith(prefix)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Sanitrax proxy HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--no-batch", action="store_true", help="answer the history batch endpoint with 404")
+    parser.add_argument("--delay", type=float, default=0.0, help="delay in seconds before every answer")
+    parser.add_argument("--no-long-poll", action="store_true", help="answer requests for the actions at once")
+    parser.add_argument("--no-etag", action="store_true", help="answer the actions without an ETag")
+    args = parser.parse_args()
+
+    proxy = FakeProxy(args.host, args.port, batch=not args.no_batch, delay=args.delay, verbose=True,
+                      long_poll=not args.no_long_poll, etag=not args.no_etag)
+    proxy.start()
+    print("Fake proxy listening on", proxy.address, file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        proxy.stop()
+
+
+if __name__ == "__main__":
+    main()
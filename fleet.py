@@ -0,0 +1,82 @@
+import os
+import json
+
+DEFAULT_BAUDRATE = 9600
+
+
+## State of one Sanitrax controller: where it is connected, its database key and everything that is kept between
+#  cycles. The files of a unit (settings.json, WaterCounter.json, LastStatus.json, spool/) are kept in its own
+#  directory, its raw register log is "<log_name>" in the log directory.
+class Unit:
+    ## Initializes the unit, the session and the other members are filled in by the polling script
+    #  @param dbkey Database key of the controller
+    #  @param port (optional) Serial port of the RS-485 bus
+    #  @param slave (optional) Modbus slave id of the controller
+    #  @param baudrate (optional) Baudrate of the bus
+    #  @param directory (optional) Directory for the files of the unit, created if it does not exist
+    #  @param log_name (optional) Name of the raw register log
+    def __init__(self, dbkey: str, port: str=None, slave: int=1, baudrate: int=DEFAULT_BAUDRATE,
+                 directory: str='.', log_name: str="Sanitrax"):
+        self.dbkey = dbkey
+        self.port = port
+        self.slave = slave
+        self.baudrate = baudrate
+        self.directory = directory
+        self.log_name = log_name
+        os.makedirs(directory, exist_ok=True)
+        self.session = None
+        self.planner = None
+        self.bitfields = None
+        self.settings = None
+        # Modification time of settings.json when it was read, a newer file is read again
+        self.settings_mtime = None
+        self.water = None
+        self.history = None
+        self.spool = None
+        self.publisher = None
+        # ActionSubscription of the daemon, None when the actions are fetched every cycle
+        self.subscription = None
+        self.loggers = {}
+        self.stores = {}
+        # Activity of the plant in the last cycle, see poll_scheduler.activity(), None if it could not be read
+        self.active = None
+
+    def __repr__(self) -> str:
+        return "Unit(%s, %s, slave %d)" % (self.dbkey, self.port, self.slave)
+
+    ## Returns the path of a file of this unit
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+
+## Reads a fleet configuration file and returns its units. The file is JSON:
+#  {"units": [{"dbkey": "...", "port": "/dev/ttyUSB3", "slave": 1, "baudrate": 9600}, ...]}
+#  "slave" and "baudrate" are optional. Every unit gets the directory "<directory>/<dbkey>".
+#  @param path Configuration file
+#  @param directory (optional) Parent directory of the unit directories
+#  @param default_port (optional) Port of units without "port"
+def load_fleet(path: str, directory: str="units", default_port: str=None) -> list:
+    with open(path, 'r') as fp:
+        config = json.load(fp)
+    units = []
+    for entry in config["units"]:
+        dbkey = str(entry["dbkey"])
+        if any(unit.dbkey == dbkey for unit in units):
+            raise ValueError("Duplicate dbkey in fleet configuration: " + dbkey)
+        port = entry.get("port", default_port)
+        baudrate = int(entry.get("baudrate", DEFAULT_BAUDRATE))
+        if any(unit.port == port and unit.baudrate != baudrate for unit in units):
+            raise ValueError("Units on " + str(port) + " have different baudrates")
+        units.append(Unit(dbkey, port, int(entry.get("slave", 1)), baudrate, os.path.join(directory, dbkey),
+                          "Sanitrax_" + dbkey))
+    if not units:
+        raise ValueError("No units in fleet configuration " + path)
+    return units
+
+
+## Returns the units grouped per serial port, as a list of lists in configuration order
+def group_by_port(units: list) -> list:
+    groups = {}
+    for unit in units:
+        groups.setdefault(unit.port, []).append(unit)
+    return list(groups.values())
@@ -0,0 +1,134 @@
+import time
+
+# Status codes that tell us the proxy does not know the batch endpoint
+BATCH_UNSUPPORTED = (404, 405, 501)
+# Number of flushes after which the batch endpoint is tried again on a server that did not support it
+BATCH_RETRY_FLUSHES = 360
+
+
+# Status codes of a 4xx answer that may be different on a retry: authentication, timeout, rate limit
+RETRY_STATUSES = (401, 403, 408, 429)
+
+
+## Returns True if an upload has to be retried later: no connection, a server error or one of RETRY_STATUSES.
+#  Other answers (2xx, or a 4xx such as 400 or 422 for an invalid payload) are final.
+def upload_failed(status: int) -> bool:
+    return status == 0 or status >= 500 or status in RETRY_STATUSES
+
+
+## Collects the history points of one or more cycles and uploads them in a single request to
+#  /api/v2/modules/<dbkey>/history as {"series": {"<name>": [[timestamp, value], ...]}}.
+#  Servers that only know the per-series endpoints (/history/<name>, one value per POST) are detected by the
+#  status code of the batch request, after which the points are posted per series like before.
+class HistoryUploader:
+    ## Initializes the uploader
+    #  @param post Function (target, command, data) returning the HTTP status, 0 for no connection
+    #  @param target Address of the proxy
+    #  @param dbkey Database key of this module
+    #  @param flush_cycles (optional) Number of cycles to collect before uploading
+    #  @param rejected (optional) Function (count) called with the number of points the proxy rejected for good,
+    #                  those points are dropped instead of being retried
+    def __init__(self, post, target: str, dbkey: str, flush_cycles: int=1, rejected=None):
+        self.__post = post
+        self.__rejected = rejected
+        self.target = target
+        self.dbkey = dbkey
+        self.flush_cycles = max(1, flush_cycles)
+        self.points = {}
+        self.cycles = 0
+        self.batch_supported = True
+        self.batch_delivered = False
+        self.__batch_retry = 0
+
+    ## Adds a point to a series
+    #  @param series Name of the history series (for example "waterCounter")
+    #  @param value Value of the point
+    #  @param timestamp (optional) Unix timestamp of the point, defaults to now
+    def add(self, series: str, value, timestamp: int=None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        self.points.setdefault(series, []).append([timestamp, value])
+
+    ## Ends a cycle and uploads the collected points once "flush_cycles" cycles have been collected
+    #  @return The points that could not be delivered, see send()
+    def end_cycle(self) -> dict:
+        self.cycles += 1
+        if self.cycles < self.flush_cycles:
+            return {}
+        return self.flush()
+
+    ## Returns the collected points without uploading them and starts collecting again
+    def take(self) -> dict:
+        points = self.points
+        self.points = {}
+        self.cycles = 0
+        return points
+
+    ## Uploads all collected points
+    #  @return The points that could not be delivered, see send()
+    def flush(self) -> dict:
+        return self.send(self.take())
+
+    ## Uploads a dictionary of points, in one request if the server supports it
+    #  @param points Dictionary of series name to a list of [timestamp, value] pairs
+    #  @return Dictionary with the points that could not be delivered (empty if everything was delivered)
+    def send(self, points: dict) -> dict:
+        failed = self.send_batch(points)
+        return self.send_per_series(points) if failed is None else failed
+
+    ## Uploads a dictionary of points in one request to the batch endpoint, without the per-series fallback. The
+    #  per-series endpoints store a point at the time it is received, so they are no use for old points.
+    #  @param points Dictionary of series name to a list of [timestamp, value] pairs
+    #  @return Dictionary with the points that could not be delivered, None if the server does not support the
+    #          batch endpoint
+    def send_batch(self, points: dict):
+        if not points:
+            return {}
+        if not self.batch_supported:
+            self.__batch_retry -= 1
+            if self.__batch_retry <= 0:
+                self.batch_supported = True
+        if not self.batch_supported:
+            return None
+        status = self.__post(self.target, self.__command(), {"series": points})
+        if 200 <= status < 300:
+            self.batch_delivered = True
+            return {}
+        # A proxy that does not know the route may also answer 400, once the batch endpoint delivered a 400 is
+        # about the payload
+        if status not in BATCH_UNSUPPORTED and (status != 400 or self.batch_delivered):
+            if upload_failed(status):
+                return points
+            self.__reject(sum(len(series_points) for series_points in points.values()))
+            return {}
+        self.batch_supported = False
+        self.__batch_retry = BATCH_RETRY_FLUSHES
+        return None
+
+    ## Uploads points with one POST per point to the per-series endpoints
+    #  @return Dictionary with the points that could not be delivered
+    def send_per_series(self, points: dict) -> dict:
+        failed = {}
+        for series, series_points in points.items():
+            if failed:
+                # Do not wait for more timeouts once the server is unreachable
+                failed[series] = series_points
+                continue
+            for index, (timestamp, value) in enumerate(series_points):
+                status = self.__post(self.target, self.__command(series), value)
+                if upload_failed(status):
+                    failed[series] = series_points[index:]
+                    break
+                if not 200 <= status < 300:
+                    self.__reject(1)
+        return failed
+
+    def __reject(self, count: int):
+        if self.__rejected is not None:
+            self.__rejected(count)
+
+    def __command(self, series: str=None) -> str:
+        command = '/api/v2/modules/' + self.dbkey + '/history'
+        if series is not None:
+            command += '/' + series
+        return command
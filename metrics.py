@@ -0,0 +1,169 @@
+import json
+import math
+import threading
+from snapshot import replace_file
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+## Histogram of observed values with cumulative buckets, as Prometheus uses them
+class Histogram:
+    ## @param buckets (optional) Sorted upper bounds of the buckets, a +Inf bucket is added
+    def __init__(self, buckets: tuple=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    ## Returns the cumulative counts per upper bound, the last bound is +Inf
+    def cumulative(self) -> list:
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+## Counters, gauges and histograms of the polling script, identified by a name and labels. Every metric is
+#  declared once with declare() before it is used. The whole set can be exported as a Prometheus textfile (for the
+#  node_exporter textfile collector) or as JSON, and restored from the JSON export so counters continue across
+#  runs from cron.
+class Metrics:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__types = {}  # name: (type, help, buckets)
+        self.__values = {}  # name: {labels: value or Histogram}
+
+    @staticmethod
+    def __key(labels: dict) -> tuple:
+        return tuple(sorted((name, str(value)) for name, value in (labels or {}).items() if value is not None))
+
+    ## Declares a metric, restored series of the metric are kept
+    #  @param name Name of the metric
+    #  @param kind "counter", "gauge" or "histogram"
+    #  @param help Description of the metric
+    #  @param buckets (optional) Upper bounds of the buckets of a histogram
+    def declare(self, name: str, kind: str, help: str, buckets: tuple=LATENCY_BUCKETS):
+        with self.__lock:
+            self.__types[name] = (kind, help, tuple(buckets))
+            self.__values.setdefault(name, {})
+
+    ## Adds "amount" to a counter
+    def inc(self, name: str, labels: dict=None, amount: float=1):
+        key = self.__key(labels)
+        with self.__lock:
+            series = self.__values[name]
+            series[key] = series.get(key, 0) + amount
+
+    ## Sets a gauge
+    def set(self, name: str, value: float, labels: dict=None):
+        key = self.__key(labels)
+        with self.__lock:
+            self.__values[name][key] = value
+
+    ## Adds a value to a histogram
+    def observe(self, name: str, value: float, labels: dict=None):
+        key = self.__key(labels)
+        with self.__lock:
+            series = self.__values[name]
+            if key not in series:
+                series[key] = Histogram(self.__types[name][2])
+            series[key].observe(value)
+
+    ## Returns the value of a counter or gauge, or the count of a histogram, 0 if it does not exist
+    def get(self, name: str, labels: dict=None) -> float:
+        with self.__lock:
+            value = self.__values.get(name, {}).get(self.__key(labels), 0)
+            return value.count if isinstance(value, Histogram) else value
+
+    ## Returns the metrics in the Prometheus text exposition format
+    def prometheus(self) -> str:
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                                  for name, value in pairs) + '}'
+
+        lines = []
+        with self.__lock:
+            for name, (kind, help, buckets) in sorted(self.__types.items()):
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for labels, value in sorted(self.__values[name].items()):
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, labels_text(labels), repr(float(value))))
+                        continue
+                    for bound, count in value.cumulative():
+                        lines.append('%s_bucket%s %d' % (name, labels_text(labels, (
+                            ('le', '+Inf' if bound == math.inf else repr(bound)),)), count))
+                    lines.append('%s_sum%s %s' % (name, labels_text(labels), repr(value.sum)))
+                    lines.append('%s_count%s %d' % (name, labels_text(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+    ## Returns the metrics as a JSON serializable dictionary, {name: {"type", "help", "series": [...]}}
+    def as_dict(self) -> dict:
+        result = {}
+        with self.__lock:
+            for name, (kind, help, buckets) in sorted(self.__types.items()):
+                series = []
+                for labels, value in sorted(self.__values[name].items()):
+                    entry = {"labels": dict(labels)}
+                    if kind == 'histogram':
+                        entry.update(buckets=list(value.buckets), counts=list(value.counts), sum=value.sum,
+                                     count=value.count)
+                    else:
+                        entry["value"] = value
+                    series.append(entry)
+                result[name] = {"type": kind, "help": help, "series": series}
+        return result
+
+    ## Restores the series of the declared metrics from a JSON export, returns False if the file could not be read.
+    #  Series of metrics that are no longer declared, or that changed their type or buckets, are left out.
+    def restore(self, path: str) -> bool:
+        try:
+            with open(path, 'r') as fp:
+                stored = json.load(fp)
+            values = {}
+            for name, metric in stored.items():
+                kind, help, buckets = self.__types.get(name, (None, None, None))
+                if metric["type"] != kind:
+                    continue
+                series = values[name] = {}
+                for entry in metric["series"]:
+                    key = self.__key(entry["labels"])
+                    if kind == 'histogram':
+                        if tuple(entry["buckets"]) != buckets:
+                            continue
+                        histogram = series[key] = Histogram(buckets)
+                        histogram.counts = list(entry["counts"])
+                        histogram.sum = entry["sum"]
+                        histogram.count = entry["count"]
+                    else:
+                        series[key] = entry["value"]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return False
+        with self.__lock:
+            self.__values.update(values)
+        return True
+
+    ## Writes the Prometheus textfile and/or the JSON export, each is replaced atomically
+    #  @param prometheus_path (optional) Path of the textfile, should end in ".prom" for the textfile collector
+    #  @param json_path (optional) Path of the JSON export
+    def write(self, prometheus_path: str=None, json_path: str=None):
+        if prometheus_path is not None:
+            replace_file(prometheus_path, self.prometheus())
+        if json_path is not None:
+            replace_file(json_path, json.dumps(self.as_dict(), separators=(',', ':')) + '\n')
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+
+# Serial bus broker: the only process that opens the Modbus port. Clients (Sanitrax_CTRL.py and the maintenance
+# scripts) send their transactions over a Unix socket, the broker executes them one at a time in priority order,
+# so a pump reset goes ahead of the routine polls and frames of two tools never collide on the bus.
+# Run "python3 modbus_broker.py" and start the clients as usual, they use the broker when its socket exists.
+#
+# Protocol: one JSON object per line in both directions. A request is
+#   {"id": 1, "op": "execute", "function": 3, "address": 0, "quantity": 95, "value": 0, "priority": 5, "slave": 1}
+# or {"id": 2, "op": "stats"}, the answer {"id": 1, "result": [...]} or {"id": 1, "error": "...", "kind": "..."}.
+# Requests may be pipelined, answers carry the id of their request.
+
+import os
+import sys
+import json
+import heapq
+import signal
+import socket
+import argparse
+import threading
+from simple_flock import SimpleFlock
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+import modbus_tk.defines as cst
+from modbus_tk.exceptions import ModbusError, ModbusInvalidResponseError
+
+SOCKET_PATH = "/tmp/sanitrax_modbus.sock"
+PORT = '/dev/ttyUSB3'
+BAUDRATE = 9600
+# Priorities, lower numbers are executed first
+PRIORITY_ACTION = 0
+PRIORITY_WRITE = 2
+PRIORITY_POLL = 5
+# Lock file of a serial port ("{}" is the name of the port, for example ttyUSB3). The broker holds it for its
+# lifetime, clients that open the port themselves hold it while they use the port.
+LOCK_FILE = "/tmp/sanitrax_mb.{}.lock"
+# Time in seconds that the broker waits for the lock of its port at start, longer than a poll cycle
+LOCK_TIMEOUT = 30.0
+
+
+## Raised by BrokerSession when the broker reports a failed transaction
+class BrokerError(Exception):
+    ## @param message Error message of the broker
+    #  @param kind "modbus" (exception response), "timeout" (no valid answer), "port" (serial port) or "request"
+    def __init__(self, message: str, kind: str):
+        Exception.__init__(self, message)
+        self.kind = kind
+
+
+## Queue of transactions that are executed one by one on a ModbusSession by a worker thread
+class TransactionQueue:
+    ## Initializes the queue, call start() to begin executing
+    #  @param session ModbusSession that owns the port
+    def __init__(self, session):
+        self.session = session
+        self.executed = 0
+        self.__heap = []
+        self.__sequence = 0
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__thread = None
+
+    def __len__(self) -> int:
+        with self.__condition:
+            return len(self.__heap)
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    ## Stops the worker after the current transaction, queued transactions are answered with an error
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+        for priority, sequence, request, reply in self.__heap:
+            reply({"id": request.get("id"), "error": "Broker stopped", "kind": "port"})
+        self.__heap = []
+
+    ## Queues a request, "reply" is called with the answer from the worker thread
+    def put(self, request: dict, reply):
+        with self.__condition:
+            self.__sequence += 1
+            heapq.heappush(self.__heap, (int(request.get("priority", PRIORITY_POLL)), self.__sequence, request, reply))
+            self.__condition.notify()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while self.__running and not self.__heap:
+                    self.__condition.wait()
+                if not self.__running:
+                    return
+                priority, sequence, request, reply = heapq.heappop(self.__heap)
+            reply(self.execute(request))
+
+    ## Executes a request and returns the answer
+    def execute(self, request: dict) -> dict:
+        answer = {"id": request.get("id")}
+        if request.get("op") == "stats":
+            answer["result"] = dict(self.session.stats(), queued=len(self.__heap), executed=self.executed)
+            return answer
+        if request.get("op") != "execute":
+            answer.update(error="Unknown operation: " + str(request.get("op")), kind="request")
+            return answer
+        try:
+            slave = request.get("slave")
+            result = self.session.execute(int(request["function"]), int(request["address"]),
+                                          int(request.get("quantity", 0)), request.get("value", 0),
+                                          None if slave is None else int(slave))
+            answer["result"] = list(result) if result is not None else None
+        except ModbusInvalidResponseError as ex:
+            answer.update(error=str(ex), kind="timeout")
+        except ModbusError as ex:
+            answer.update(error=str(ex), kind="modbus")
+        except (KeyError, TypeError, ValueError) as ex:
+            answer.update(error="Invalid request: " + str(ex), kind="request")
+        except Exception as ex:
+            # Serial port errors, the session reopens the port on a later transaction
+            answer.update(error=str(ex), kind="port")
+        self.executed += 1
+        return answer
+
+
+## Reads the requests of one client connection and queues them, answers are written as they complete
+class BrokerRequestHandler(StreamRequestHandler):
+    def handle(self):
+        lock = threading.Lock()
+
+        def reply(answer):
+            with lock:
+                try:
+                    self.wfile.write((json.dumps(answer, separators=(',', ':')) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+                except OSError:
+                    pass
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError("request is not an object")
+            except ValueError as ex:
+                reply({"id": None, "error": "Invalid request: " + str(ex), "kind": "request"})
+                continue
+            self.server.queue.put(request, reply)
+
+
+class BrokerServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+## Client side of the broker with the interface of ModbusSession, so it can be used in its place. One connection
+#  is kept open, calls from several threads are serialized. With a "fallback" the session opens the serial port
+#  itself when the broker goes away (its socket is gone or refuses or closes the connection, not on a timeout),
+#  and goes back to the broker on the next call once a broker answers on the socket again. A broker only creates
+#  its socket after taking the lock of the port, so it never starts while a client still uses the port itself.
+class BrokerSession:
+    ## Initializes the session, the connection is made on the first call
+    #  @param path (optional) Socket of the broker
+    #  @param priority (optional) Priority of the transactions of this session
+    #  @param timeout (optional) Time in seconds to wait for an answer, including the time in the queue
+    #  @param port (optional) Serial port served by the broker
+    #  @param fallback (optional) Function returning a ModbusSession for the port, used while the broker is gone
+    def __init__(self, path: str=SOCKET_PATH, priority: int=PRIORITY_POLL, timeout: float=30.0, port: str=None,
+                 fallback=None):
+        self.path = path
+        self.priority = priority
+        self.timeout = timeout
+        self.port = port
+        self.fallback = fallback
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.direct = None
+        self.__socket = None
+        self.__reader = None
+        self.__id = 0
+        self.__lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def connected(self) -> bool:
+        return self.__socket is not None
+
+    ## Closes the connection to the broker, but not the direct session of a fallback
+    def close_socket(self):
+        if self.__socket is not None:
+            self.__reader.close()
+            self.__socket.close()
+            self.__socket = None
+            self.__reader = None
+
+    def open(self):
+        if self.__socket is not None:
+            return
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        try:
+            connection.connect(self.path)
+        except OSError:
+            connection.close()
+            raise
+        self.__socket = connection
+        self.__reader = connection.makefile('rb')
+
+    def close(self):
+        self.close_socket()
+        if self.direct is not None:
+            self.direct.close()
+            self.direct = None
+
+    ## Sends a list of requests at once and returns their answers in the same order. The broker executes them
+    #  in the order of their priority, the answers are not checked for errors.
+    #  @param requests List of request dictionaries without "id", the priority defaults to the session priority
+    def transact(self, requests: list) -> list:
+        with self.__lock:
+            self.open()
+            ids = []
+            lines = []
+            for request in requests:
+                self.__id += 1
+                ids.append(self.__id)
+                request = dict({"priority": self.priority}, **request)
+                request["id"] = self.__id
+                lines.append(json.dumps(request, separators=(',', ':')))
+            answers = {}
+            try:
+                self.__socket.sendall(('\n'.join(lines) + '\n').encode('utf-8'))
+                while len(answers) < len(ids):
+                    line = self.__reader.readline()
+                    if not line:
+                        raise ConnectionError("Modbus broker closed the connection")
+                    answer = json.loads(line.decode('utf-8'))
+                    answers[answer.get("id")] = answer
+            except (OSError, ValueError):
+                # The answers of this connection can no longer be matched, start over with a new connection
+                self.close()
+                raise
+            return [answers[request_id] for request_id in ids]
+
+    ## Executes a single Modbus request through the broker, with the arguments of ModbusSession.execute()
+    #  @param slave (optional) Slave id, defaults to the slave id of the broker's session
+    #  @param priority (optional) Priority of this request, defaults to the session priority
+    def execute(self, function_code: int, address: int, quantity_of_x: int=0, output_value=0, slave: int=None,
+                priority: int=None):
+        if self.direct is not None and not self.reconnect():
+            return self.direct.execute(function_code, address, quantity_of_x, output_value, slave)
+        self.calls += 1
+        request = {"op": "execute", "function": function_code, "address": address, "quantity": quantity_of_x,
+                   "value": output_value, "priority": self.priority if priority is None else priority}
+        if slave is not None:
+            request["slave"] = slave
+        try:
+            answer = self.transact([request])[0]
+        except (ConnectionError, FileNotFoundError):
+            self.errors += 1
+            if self.fallback is None:
+                raise
+            # The broker is gone, open the port directly
+            with self.__lock:
+                if self.direct is None:
+                    self.direct = self.fallback()
+                    self.fallbacks += 1
+            return self.direct.execute(function_code, address, quantity_of_x, output_value, slave)
+        except (OSError, ValueError):
+            self.errors += 1
+            raise
+        if "error" in answer:
+            self.errors += 1
+            raise BrokerError(answer["error"], answer.get("kind", "port"))
+        return tuple(answer["result"]) if answer["result"] is not None else None
+
+    ## Goes back to the broker after a fallback when a broker for the port answers on the socket, which closes the
+    #  direct session
+    #  @return True if the transactions go through the broker
+    def reconnect(self) -> bool:
+        with self.__lock:
+            if self.direct is None:
+                return True
+            if not os.path.exists(self.path):
+                return False
+            try:
+                self.open()
+                if self.port is not None and self.__broker_port() != self.port:
+                    self.close_socket()
+                    return False
+            except (OSError, ValueError):
+                # A socket file left behind by the broker that stopped, connecting to it fails at once
+                self.close_socket()
+                return False
+            self.direct.close()
+            self.direct = None
+            return True
+
+    def __broker_port(self):
+        self.__socket.sendall(b'{"id":0,"op":"stats"}\n')
+        return json.loads(self.__reader.readline().decode('utf-8')).get("result", {}).get("port")
+
+    ## Reads "amount" holding registers starting from "address"
+    def read_holding_registers(self, address: int, amount: int, slave: int=None) -> tuple:
+        return self.execute(cst.READ_HOLDING_REGISTERS, address, amount, slave=slave)
+
+    ## Writes value(s) starting from "address", an int writes a single register and a list multiple registers.
+    #  Writes go ahead of the polls of other clients.
+    def write_registers(self, address: int, value, slave: int=None):
+        priority = min(self.priority, PRIORITY_WRITE)
+        if type(value) is int:
+            return self.execute(cst.WRITE_SINGLE_REGISTER, address, output_value=value, slave=slave, priority=priority)
+        elif type(value) is list:
+            return self.execute(cst.WRITE_MULTIPLE_REGISTERS, address, output_value=value, slave=slave,
+                                priority=priority)
+        raise TypeError("Modbus write error, invalid value type: " + str(type(value)))
+
+    ## Returns the counters of the broker's serial session, plus the calls and errors of this client
+    def stats(self) -> dict:
+        direct = self.direct
+        if direct is not None:
+            stats = direct.stats()
+        else:
+            try:
+                stats = self.transact([{"op": "stats"}])[0].get("result", {})
+            except (OSError, ValueError):
+                stats = {"connected": False}
+        stats.update(broker=self.path, client_calls=self.calls, client_errors=self.errors,
+                     client_fallbacks=self.fallbacks, direct=direct is not None)
+        return stats
+
+
+## Returns True if the transactions of "session" currently go through the broker, False for a direct session or
+#  a BrokerSession that fell back to the serial port
+def uses_broker(session) -> bool:
+    return isinstance(session, BrokerSession) and session.direct is None
+
+
+## Returns the lock file of a serial port, see LOCK_FILE
+def lock_file(port: str) -> str:
+    return LOCK_FILE.format(os.path.basename(str(port)))
+
+
+## Returns True if a broker answers on the socket "path"
+def broker_running(path: str) -> bool:
+    session = BrokerSession(path, timeout=2.0)
+    try:
+        session.open()
+        return True
+    except OSError:
+        return False
+    finally:
+        session.close()
+
+
+## Returns a BrokerSession when the broker is running for "port", otherwise a ModbusSession that opens the port.
+#  The BrokerSession falls back to a ModbusSession when the broker stops later on.
+#  @param path (optional) Socket of the broker
+#  @param priority (optional) Priority of the transactions through the broker
+#  @param port (optional) Serial port for a direct session
+#  @param baudrate (optional) Baudrate for a direct session
+#  @param timeout (optional) Response timeout of a direct session
+def open_session(path: str=SOCKET_PATH, priority: int=PRIORITY_POLL, port: str=PORT, baudrate: int=BAUDRATE,
+                 timeout: float=1.0):
+    def direct():
+        from modbus_session import ModbusSession
+        return ModbusSession(port, baudrate=baudrate, slave=1, timeout=timeout)
+
+    if path and os.path.exists(path):
+        session = BrokerSession(path, priority, port=port, fallback=direct)
+        try:
+            session.open()
+            if session.stats().get("port") == port:
+                return session
+            session.close()
+        except OSError:
+            # A socket file left behind by a broker that is not running anymore
+            pass
+    return direct()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shares the Modbus serial port between the Sanitrax tools")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Unix socket to listen on (default %(default)s)")
+    parser.add_argument("--port", default=PORT, help="serial port (default %(default)s)")
+    parser.add_argument("--baudrate", type=int, default=BAUDRATE, help="baudrate (default %(default)s)")
+    parser.add_argument("--timeout", type=float, default=1.0, help="response timeout in seconds (default 1)")
+    args = parser.parse_args()
+
+    if broker_running(args.socket):
+        print("A Modbus broker is already running on", args.socket, file=sys.stderr)
+        sys.exit(1)
+    try:
+        # Held for the lifetime of the broker, so clients that opened the port themselves finish first and do not
+        # open it again while the broker runs
+        with SimpleFlock(lock_file(args.port), LOCK_TIMEOUT):
+            serve(args)
+    except TimeoutError:
+        print("Serial port", args.port, "is in use (" + lock_file(args.port) + ")", file=sys.stderr)
+        sys.exit(1)
+
+
+def serve(args):
+    from modbus_session import ModbusSession
+    session = ModbusSession(args.port, baudrate=args.baudrate, slave=1, timeout=args.timeout)
+    queue = TransactionQueue(session)
+    if os.path.exists(args.socket):
+        # Left behind by a broker that did not stop cleanly, no broker answered on it
+        os.remove(args.socket)
+    server = BrokerServer(args.socket, BrokerRequestHandler)
+    server.queue = queue
+    queue.start()
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print("Modbus broker on", args.socket, "for", args.port, file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        queue.stop()
+        session.close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
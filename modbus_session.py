@@ -0,0 +1,169 @@
+import time
+import threading
+import serial
+import modbus_tk.defines as cst
+from modbus_tk import modbus_rtu
+from modbus_tk.exceptions import ModbusError, ModbusInvalidResponseError
+
+
+## Keeps one Modbus RTU connection open for as long as the session lives. When the serial port drops (for example
+#  when the USB adapter is unplugged or re-enumerated) the port is closed and reopened on a later call, with an
+#  exponential backoff between attempts. A run of timeouts also reopens the port, for a tty that was left in a bad
+#  state (wrong serial settings, stuck adapter) while it stays open for the lifetime of a daemon. Every call is
+#  timed and counted so callers can see how the bus behaves.
+#  Calls on one session are serialized by the session itself, not by the lock that modbus_tk shares between all
+#  masters, so sessions on different serial ports run their transactions at the same time.
+class ModbusSession:
+    ## Initializes the session, the port is opened on the first call
+    #  @param port Serial port of the RS-485 adapter
+    #  @param baudrate (optional) Baudrate of the bus
+    #  @param slave (optional) Modbus slave id of the controller
+    #  @param timeout (optional) Response timeout in seconds
+    #  @param backoff_min (optional) First delay in seconds before reopening a dropped port
+    #  @param backoff_max (optional) Maximum delay in seconds before reopening a dropped port
+    #  @param reset_timeouts (optional) Number of timeouts in a row after which the port is closed and reopened
+    def __init__(self, port: str, baudrate: int=9600, slave: int=1, timeout: float=1.0,
+                 backoff_min: float=0.5, backoff_max: float=30.0, reset_timeouts: int=5):
+        self.port = port
+        self.baudrate = baudrate
+        self.slave = slave
+        self.__timeout = timeout
+        self.__backoff_min = backoff_min
+        self.__backoff_max = backoff_max
+        self.__reset_timeouts = reset_timeouts
+        self.__timeouts_in_row = 0
+        self.__backoff = 0.0
+        self.__retry_at = 0.0
+        self.__master = None
+        self.__was_open = False
+        self.__lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.resets = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ## Returns True when the serial port is currently open
+    @property
+    def connected(self) -> bool:
+        return self.__master is not None
+
+    ## Opens the serial port, raises ConnectionError while still backing off from a previous failure
+    def open(self):
+        if self.__master is not None:
+            return
+        if time.monotonic() < self.__retry_at:
+            raise ConnectionError("Modbus port " + self.port + " unavailable, retrying in %.1f s"
+                                  % (self.__retry_at - time.monotonic()))
+        try:
+            master = modbus_rtu.RtuMaster(
+                serial.Serial(port=self.port, baudrate=self.baudrate, bytesize=8, parity='N', stopbits=1, xonxoff=0))
+            master.set_timeout(self.__timeout)
+            master.set_verbose(True)
+            master.open()
+        except (serial.SerialException, OSError):
+            self.__schedule_reconnect()
+            raise
+        if self.__was_open:
+            self.reconnects += 1
+        self.__was_open = True
+        self.__master = master
+
+    ## Closes the serial port, the next call will open it again
+    def close(self):
+        if self.__master is not None:
+            try:
+                self.__master.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.__master = None
+
+    def __schedule_reconnect(self):
+        self.__backoff = min(max(self.__backoff * 2, self.__backoff_min), self.__backoff_max)
+        self.__retry_at = time.monotonic() + self.__backoff
+
+    ## Executes a single Modbus request on the open port
+    #  @param function_code Modbus function code (modbus_tk.defines)
+    #  @param address Starting register address
+    #  @param quantity_of_x (optional) Number of registers to read
+    #  @param output_value (optional) Value or list of values to write
+    #  @param slave (optional) Slave id, for a bus with several controllers, defaults to the session's slave id
+    #  @return The response of modbus_tk's execute()
+    def execute(self, function_code: int, address: int, quantity_of_x: int=0, output_value=0, slave: int=None):
+        with self.__lock:
+            return self.__execute(function_code, address, quantity_of_x, output_value, slave)
+
+    def __execute(self, function_code: int, address: int, quantity_of_x: int, output_value, slave: int):
+        self.calls += 1
+        try:
+            self.open()
+        except (serial.SerialException, OSError):
+            self.errors += 1
+            raise
+        try:
+            start = time.monotonic()
+            try:
+                result = self.__master.execute(self.slave if slave is None else slave, function_code, address,
+                                               quantity_of_x, output_value, threadsafe=False)
+            finally:
+                self.last_latency = time.monotonic() - start
+                self.total_latency += self.last_latency
+                self.max_latency = max(self.max_latency, self.last_latency)
+        except ModbusInvalidResponseError:
+            # No (valid) answer from the slave, the port itself is fine unless this keeps happening
+            self.errors += 1
+            self.timeouts += 1
+            self.__timeouts_in_row += 1
+            if self.__timeouts_in_row >= self.__reset_timeouts:
+                self.__timeouts_in_row = 0
+                self.resets += 1
+                self.close()
+                self.__schedule_reconnect()
+            raise
+        except ModbusError:
+            # Exception response from the slave
+            self.errors += 1
+            raise
+        except (serial.SerialException, OSError):
+            # The port dropped, reopen it on a later call
+            self.errors += 1
+            self.close()
+            self.__schedule_reconnect()
+            raise
+        self.__backoff = 0.0
+        self.__timeouts_in_row = 0
+        return result
+
+    ## Reads "amount" holding registers starting from "address"
+    def read_holding_registers(self, address: int, amount: int, slave: int=None) -> tuple:
+        return self.execute(cst.READ_HOLDING_REGISTERS, address, amount, slave=slave)
+
+    ## Writes value(s) starting from "address", an int writes a single register and a list multiple registers
+    def write_registers(self, address: int, value, slave: int=None):
+        if type(value) is int:
+            return self.execute(cst.WRITE_SINGLE_REGISTER, address, output_value=value, slave=slave)
+        elif type(value) is list:
+            return self.execute(cst.WRITE_MULTIPLE_REGISTERS, address, output_value=value, slave=slave)
+        raise TypeError("Modbus write error, invalid value type: " + str(type(value)))
+
+    ## Returns the call counters and latencies (seconds) of this session as a dictionary
+    def stats(self) -> dict:
+        return {"port": self.port,
+                "connected": self.connected,
+                "calls": self.calls,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "reconnects": self.reconnects,
+                "resets": self.resets,
+                "last_latency": self.last_latency,
+                "max_latency": self.max_latency,
+                "avg_latency": self.total_latency / self.calls if self.calls else 0.0}
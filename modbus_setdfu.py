@@ -1,50 +1,23 @@
 #!/usr/bin/env python3
 # -*- coding: utf_8 -*-
-"""
- Modbus TestKit: Implementation of Modbus protocol in python
 
- (C)2009 - Luc Jean - luc.jean@gmail.com
- (C)2009 - Apidev - http://www.apidev.fr
+# Puts the controller in firmware update mode, see modbus_tool.py for other maintenance steps.
+# The write goes through the Modbus broker, ahead of the routine polls, when the broker is running.
+# Otherwise the port is opened directly, once the polling script has released it.
 
- This is distributed under GNU LGPL license, see license.txt
-"""
-
-import serial
-
-import modbus_tk
-import modbus_tk.defines as cst
-from modbus_tk import modbus_rtu
+import sys
+from modbus_broker import open_session, PRIORITY_ACTION, BAUDRATE
+from modbus_tool import parse_script, run_locked
 
 #PORT = 1
 PORT = '/dev/ttyUSB3'
 
-def main():
-    """main"""
-    logger = modbus_tk.utils.create_logger("console")
-
-    try:
-        #Connect to the slave
-        master = modbus_rtu.RtuMaster(
-            serial.Serial(port=PORT, baudrate=115200, bytesize=8, parity='N', stopbits=1, xonxoff=0)
-        )
-        master.set_timeout(5.0)
-        master.set_verbose(True)
-        logger.info("connected")
-
-        logger.info(master.execute(1, cst.READ_HOLDING_REGISTERS, 0, 1))
 
-        #send some queries
-        #logger.info(master.execute(1, cst.READ_COILS, 0, 10))
-        #logger.info(master.execute(1, cst.READ_DISCRETE_INPUTS, 0, 8))
-        #logger.info(master.execute(1, cst.READ_INPUT_REGISTERS, 100, 3))
-        #logger.info(master.execute(1, cst.READ_HOLDING_REGISTERS, 100, 12))
-        #logger.info(master.execute(1, cst.WRITE_SINGLE_COIL, 7, output_value=1))
-        logger.info(master.execute(1, cst.WRITE_SINGLE_REGISTER, 0, output_value=65535))
-        #logger.info(master.execute(1, cst.WRITE_MULTIPLE_COILS, 0, output_value=[1, 1, 0, 1, 1, 0, 1, 1]))
-        #logger.info(master.execute(1, cst.WRITE_MULTIPLE_REGISTERS, 100, output_value=xrange(12)))
+def main():
+    with open_session(priority=PRIORITY_ACTION, port=PORT, baudrate=BAUDRATE, timeout=5.0) as session:
+        if run_locked(session, parse_script(["read mb_magic", "write mb_magic 65535"])) is None:
+            sys.exit(1)
 
-    except modbus_tk.modbus.ModbusError as exc:
-        logger.error("%s- Code=%d", exc, exc.get_exception_code())
 
 if __name__ == "__main__":
     main()
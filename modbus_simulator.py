@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+# Simulated Sanitrax controller: answers Modbus RTU requests on a pseudo-terminal, so the polling script and the
+# tools can run without hardware. "python3 modbus_simulator.py --link /tmp/ttySanitrax" prints the port and
+# serves until it is stopped, point PORT (or --port of the tools) at it.
+# The plant follows a scenario, a JSON list of steps that run one after the other and repeat:
+#   [{"name": "demand", "duration": 15, "set": {"mb_p1state": "PUMP_AUTO_ON", "mb_fault": ["Tank_Empty"]},
+#     "rate": {"mb_water_counter": 3}}, ...]
+# "set" assigns registers at the start of the step (a number, a state name or a list of fault bit names), "rate"
+# adds that many counts per second during the step. Writes to the reset registers clear the matching timeout
+# states and fault bits, like the controller does. Latency, CRC errors and timeouts can be injected.
+
+import os
+import sys
+import tty
+import json
+import time
+import struct
+import random
+import select
+import signal
+import argparse
+import threading
+from modbus_tk.utils import calculate_crc
+from sanitrax_registers import modbus_keys, fault_keys, bstate, hstate, pstate
+
+# Register values of a controller in normal operation
+SAMPLE_REGISTERS = (1, 60, 900, 10, 30, 15870, 10250, 13000, 11500, 30, 1200, 8000, 7000, 6750, 6000, 10, 20, 30,
+                    40, 50, 50, 5, 0, 65536 - 5, 65536 - 15, 65536 - 25, 0, 0, 0, 0, 0, 0, 65535, 0, 49247, 10752, 0,
+                    65276, 0, 0, 0, 0, 1223, 11, 11, 11, 0, 6, 3, 3, 3, 0, 2, 0, 0, 0, 6584, 15443, 0, 350, 0, 5,
+                    2611, 0, 350, 0, 0, 2, 4722, 0, 32, 32768, 0, 0, 1057, 6384, 15425, 0, 350, 0, 5, 2611, 0, 350,
+                    0, 0, 2, 4717, 0, 30, 32768, 0)
+
+# Idle, a demand that runs pump 1 and the hydrophore, refilling, and a breaktank timeout that needs a reset
+DEFAULT_SCENARIO = [
+    {"name": "idle", "duration": 20,
+     "set": {"mb_bstate": "BREAKTANK_AUTO_NORMAL", "mb_hstate": "HYDROPHORE_AUTO_OFF", "mb_p1state": "PUMP_AUTO_OFF",
+             "mb_p2state": "PUMP_AUTO_OFF", "mb_fault": []}},
+    {"name": "demand", "duration": 15,
+     "set": {"mb_hstate": "HYDROPHORE_AUTO_ON", "mb_p1state": "PUMP_AUTO_ON", "mb_p1_Motor_Current": 52},
+     "rate": {"mb_water_counter": 3}},
+    {"name": "refill", "duration": 10,
+     "set": {"mb_bstate": "BREAKTANK_AUTO_LOW", "mb_hstate": "HYDROPHORE_AUTO_POSTRUN", "mb_p1state": "PUMP_AUTO_OFF",
+             "mb_p1_Motor_Current": 0},
+     "rate": {"mb_water_counter": 1}},
+    {"name": "timeout", "duration": 15,
+     "set": {"mb_bstate": "BREAKTANK_AUTO_TIMEOUT", "mb_hstate": "HYDROPHORE_AUTO_OFF", "mb_fault": ["Tank_Empty"]}}]
+
+# Reset register: (state register, states that are left, state after the reset, fault bits that are cleared)
+RESETS = {'mb_reset_breaktank': (('mb_bstate',), ('BREAKTANK_AUTO_TIMEOUT',), 'BREAKTANK_AUTO_NORMAL',
+                                 ('Water_Supply_Error', 'Tank_Empty', 'Tank_Overflow')),
+          'mb_reset_hydrophore': (('mb_hstate',), ('HYDROPHORE_AUTO_TIMEOUT', 'HYDROPHORE_FAIL'), 'HYDROPHORE_AUTO_OFF',
+                                  ('Hydrophore_Fail', 'Hydrophore_Timeout')),
+          'mb_reset_pump_1': (('mb_p1state',), ('PUMP_AUTO_TIMEOUT', 'PUMP_FAIL'), 'PUMP_AUTO_OFF',
+                              ('Pump1_Fault', 'Pump1_Timeout', 'Pump1_Overheat')),
+          'mb_reset_pump_2': (('mb_p2state',), ('PUMP_AUTO_TIMEOUT', 'PUMP_FAIL'), 'PUMP_AUTO_OFF',
+                              ('Pump2_Fault', 'Pump2_Timeout', 'Pump2_Overheat'))}
+
+STATES = {'mb_bstate': bstate, 'mb_hstate': hstate, 'mb_p1state': pstate, 'mb_p2state': pstate}
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_ADDRESS = 2
+ILLEGAL_VALUE = 3
+
+
+## Returns the register value of a scenario value: a number, a state name or a list of fault bit names
+def register_value(key: str, value) -> int:
+    if isinstance(value, str):
+        return STATES[key].index(value)
+    if isinstance(value, list):
+        return sum(1 << fault_keys.index(name) for name in value)
+    return int(value) & 0xFFFF
+
+
+## Register space of one simulated controller, driven by a scenario
+class SimulatedPlant:
+    ## Initializes the plant with the sample registers and starts the first step of the scenario
+    #  @param scenario (optional) List of steps, see the top of this file
+    #  @param clock (optional) Function that returns the time in seconds
+    def __init__(self, scenario: list=None, clock=time.monotonic):
+        for step in scenario or []:
+            for key, value in step.get("set", {}).items():
+                register_value(key, value)
+            for key in step.get("rate", {}):
+                modbus_keys.index(key)
+        self.registers = list(SAMPLE_REGISTERS) + [0] * (len(modbus_keys) - len(SAMPLE_REGISTERS))
+        # The sample was taken without a water meter, the polling script divides by its factor
+        self['mb_watermeter_factor'] = 1
+        self.scenario = scenario if scenario is not None else DEFAULT_SCENARIO
+        self.reads = 0
+        self.writes = 0
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__step = -1
+        self.__step_end = clock()
+        self.__last = clock()
+        self.__fractions = {}
+        self.__advance(clock())
+
+    def __setitem__(self, key: str, value):
+        self.registers[modbus_keys.index(key)] = register_value(key, value)
+
+    def __getitem__(self, key: str) -> int:
+        return self.registers[modbus_keys.index(key)]
+
+    ## Name of the current scenario step
+    @property
+    def step(self) -> str:
+        if not self.scenario:
+            return None
+        return self.scenario[self.__step].get("name", str(self.__step))
+
+    def __advance(self, now: float):
+        # Applies the rates up to "now" and starts the steps whose time has come
+        while self.scenario:
+            step = self.scenario[self.__step] if self.__step >= 0 else {}
+            until = min(now, self.__step_end)
+            for key, rate in step.get("rate", {}).items():
+                total = self.__fractions.get(key, 0.0) + rate * (until - self.__last)
+                address = modbus_keys.index(key)
+                self.registers[address] = (self.registers[address] + int(total)) & 0xFFFF
+                self.__fractions[key] = total - int(total)
+            self.__last = until
+            if now < self.__step_end:
+                return
+            self.__step = (self.__step + 1) % len(self.scenario)
+            step = self.scenario[self.__step]
+            for key, value in step.get("set", {}).items():
+                self[key] = value
+            self.__step_end += max(float(step.get("duration", 0)), 0.001)
+
+    ## Returns "count" registers from "address", or raises IndexError outside the register space
+    def read(self, address: int, count: int) -> list:
+        with self.__lock:
+            if address < 0 or count < 1 or address + count > len(self.registers):
+                raise IndexError(address)
+            self.__advance(self.__clock())
+            self.reads += 1
+            return self.registers[address:address + count]
+
+    ## Writes registers from "address", a write of 1 to a reset register resets the matching part of the plant
+    def write(self, address: int, values: list):
+        with self.__lock:
+            if address < 0 or not values or address + len(values) > len(self.registers):
+                raise IndexError(address)
+            self.__advance(self.__clock())
+            self.writes += 1
+            for offset, value in enumerate(values):
+                key = modbus_keys[address + offset]
+                if key in RESETS and value:
+                    self.__reset(*RESETS[key])
+                elif key == 'mb_fault' or key in STATES:
+                    # Read only on the controller
+                    continue
+                else:
+                    self.registers[address + offset] = value & 0xFFFF
+
+    def __reset(self, state_keys: tuple, failed: tuple, state: str, faults: tuple):
+        for key in state_keys:
+            if STATES[key][self[key]] in failed:
+                self[key] = state
+        for name in faults:
+            self.registers[modbus_keys.index('mb_fault')] &= ~(1 << fault_keys.index(name)) & 0xFFFF
+
+
+## Returns the length of the RTU request at the start of "frame", or None if more bytes are needed
+def request_length(frame: bytes):
+    if len(frame) < 2:
+        return None
+    if frame[1] == 16:
+        return 9 + frame[6] if len(frame) >= 7 else None
+    return 8
+
+
+## Returns a frame with its CRC appended
+def with_crc(frame: bytes) -> bytes:
+    return frame + struct.pack(">H", calculate_crc(frame))
+
+
+## Answers Modbus RTU requests (functions 3, 6 and 16) for one or more simulated controllers on a pseudo-terminal
+class ModbusSimulator:
+    ## Creates the pseudo-terminal, call start() to answer requests
+    #  @param plants (optional) Dictionary of slave id to SimulatedPlant, defaults to one plant as slave 1
+    #  @param latency (optional) Time in seconds before an answer is sent
+    #  @param jitter (optional) Random extra latency, up to this many seconds
+    #  @param crc_error_rate (optional) Fraction of the answers that is sent with a wrong CRC
+    #  @param timeout_rate (optional) Fraction of the requests that is not answered
+    #  @param link (optional) Symlink to create to the pseudo-terminal, for a fixed port name
+    #  @param seed (optional) Seed of the random jitter and errors, for repeatable runs
+    def __init__(self, plants: dict=None, latency: float=0.0, jitter: float=0.0, crc_error_rate: float=0.0,
+                 timeout_rate: float=0.0, link: str=None, seed: int=None):
+        self.plants = plants if plants is not None else {1: SimulatedPlant()}
+        self.latency = latency
+        self.jitter = jitter
+        self.crc_error_rate = crc_error_rate
+        self.timeout_rate = timeout_rate
+        self.link = link
+        self.requests = 0
+        self.answered = 0
+        self.crc_errors = 0
+        self.timeouts = 0
+        self.bad_frames = 0
+        self.__master, self.__slave = os.openpty()
+        tty.setraw(self.__slave)
+        self.port = os.ttyname(self.__slave)
+        if link is not None:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+        self.__running = False
+        self.__thread = None
+        self.__random = random.Random(seed)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.__running = True
+        self.__thread = threading.Thread(target=self.serve, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        os.close(self.__master)
+        os.close(self.__slave)
+        if self.link is not None and os.path.islink(self.link):
+            os.remove(self.link)
+
+    ## Returns the counters of the simulator
+    def stats(self) -> dict:
+        return {"port": self.port, "requests": self.requests, "answered": self.answered,
+                "crc_errors": self.crc_errors, "timeouts": self.timeouts, "bad_frames": self.bad_frames}
+
+    ## Answers requests until stop() is called
+    def serve(self):
+        buffer = b''
+        while self.__running:
+            ready, _, _ = select.select([self.__master], [], [], 0.1)
+            if not ready:
+                # A silent line ends a frame, drop what is left of an incomplete one
+                if buffer:
+                    self.bad_frames += 1
+                buffer = b''
+                continue
+            buffer += os.read(self.__master, 256)
+            length = request_length(buffer)
+            while length is not None and len(buffer) >= length:
+                frame, buffer = buffer[:length], buffer[length:]
+                answer = self.answer(frame)
+                if answer is not None:
+                    os.write(self.__master, answer)
+                length = request_length(buffer)
+
+    ## Returns the answer to a request frame, None if it is not answered
+    def answer(self, frame: bytes):
+        if with_crc(frame[:-2]) != frame:
+            self.bad_frames += 1
+            return None
+        plant = self.plants.get(frame[0])
+        if plant is None:
+            return None
+        self.requests += 1
+        if self.__random.random() < self.timeout_rate:
+            self.timeouts += 1
+            return None
+        function = frame[1]
+        try:
+            if function == 3:
+                address, count = struct.unpack(">HH", frame[2:6])
+                if not 1 <= count <= 125:
+                    raise ValueError(count)
+                values = plant.read(address, count)
+                pdu = struct.pack(">BB", function, 2 * count) + struct.pack(">%dH" % count, *values)
+            elif function == 6:
+                address, value = struct.unpack(">HH", frame[2:6])
+                plant.write(address, [value])
+                pdu = frame[1:6]
+            elif function == 16:
+                address, count, size = struct.unpack(">HHB", frame[2:7])
+                if not 1 <= count <= 123 or size != 2 * count:
+                    raise ValueError(count)
+                plant.write(address, list(struct.unpack(">%dH" % count, frame[7:7 + size])))
+                pdu = frame[1:6]
+            else:
+                pdu = struct.pack(">BB", function | 0x80, ILLEGAL_FUNCTION)
+        except IndexError:
+            pdu = struct.pack(">BB", function | 0x80, ILLEGAL_ADDRESS)
+        except ValueError:
+            pdu = struct.pack(">BB", function | 0x80, ILLEGAL_VALUE)
+        delay = self.latency + self.__random.uniform(0.0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        answer = with_crc(frame[:1] + pdu)
+        if self.__random.random() < self.crc_error_rate:
+            self.crc_errors += 1
+            answer = answer[:-1] + bytes([answer[-1] ^ 0xFF])
+        self.answered += 1
+        return answer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates Sanitrax controllers on a pseudo-terminal")
+    parser.add_argument("--slaves", default="1", help="comma separated slave ids (default %(default)s)")
+    parser.add_argument("--scenario", help="JSON file with the scenario steps (default: built-in scenario)")
+    parser.add_argument("--link", help="symlink to the pseudo-terminal, for example /tmp/ttySanitrax")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before an answer (default 0)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency in seconds (default 0)")
+    parser.add_argument("--crc-errors", type=float, default=0.0, help="fraction of answers with a wrong CRC")
+    parser.add_argument("--timeouts", type=float, default=0.0, help="fraction of requests that is not answered")
+    args = parser.parse_args()
+
+    try:
+        scenario = None
+        if args.scenario is not None:
+            with open(args.scenario, 'r') as fp:
+                scenario = json.load(fp)
+        plants = {int(slave): SimulatedPlant(scenario) for slave in args.slaves.split(',')}
+    except (OSError, ValueError, KeyError, TypeError) as ex:
+        print("Invalid scenario or slave ids:", ex, file=sys.stderr)
+        sys.exit(2)
+
+    simulator = ModbusSimulator(plants, args.latency, args.jitter, args.crc_errors, args.timeouts, args.link)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    print("Simulated controller(s)", args.slaves, "on", args.link or simulator.port, file=sys.stderr)
+    with simulator:
+        while not stopped.wait(10.0):
+            print(simulator.stats(), {slave: plant.step for slave, plant in plants.items()}, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Maintenance tool that runs a script of Modbus steps over one connection (through the broker when it runs).
+# Steps, one per line, registers by address or by name (sanitrax_registers.py), "#" starts a comment:
+#   read <register> [count]            read registers
+#   write <register> <value> [...]     write one or more consecutive registers
+#   verify <register> <value> [...]    write, read back and compare
+#   expect <register> <value> [...]    read and compare
+#   sleep <seconds>                    wait, for example after a reset
+# Example: "echo 'verify mb_pump_start 15870' | python3 modbus_tool.py -" or "python3 modbus_tool.py params.txt".
+# Through the broker all steps up to a sleep are sent at once (pipelined) and a timing report is printed.
+
+import sys
+import time
+import argparse
+import modbus_tk.defines as cst
+from simple_flock import SimpleFlock
+from modbus_broker import open_session, uses_broker, lock_file, SOCKET_PATH, PORT, BAUDRATE, PRIORITY_ACTION
+from sanitrax_registers import modbus_keys
+
+STEPS = ("read", "write", "verify", "expect", "sleep")
+# Time in seconds to wait for the lock, longer than a poll cycle
+LOCK_TIMEOUT = 10.0
+
+
+## Returns the address of a register given by address or by name
+def register_address(text: str) -> int:
+    if text.isdigit():
+        return int(text)
+    if text in modbus_keys:
+        return modbus_keys.index(text)
+    raise ValueError("Unknown register: " + text)
+
+
+## Returns the steps of a script as dictionaries {"line", "text", "step", "address", "count", "values", "seconds"}
+#  @param lines Iterable of script lines
+def parse_script(lines) -> list:
+    steps = []
+    for number, line in enumerate(lines, 1):
+        text = line.split('#', 1)[0].strip()
+        if not text:
+            continue
+        words = text.split()
+        step = {"line": number, "text": text, "step": words[0].lower()}
+        try:
+            if step["step"] not in STEPS:
+                raise ValueError("Unknown step: " + words[0])
+            if step["step"] == "sleep":
+                step["seconds"] = float(words[1])
+            elif step["step"] == "read":
+                step["address"] = register_address(words[1])
+                step["count"] = int(words[2]) if len(words) > 2 else 1
+            else:
+                step["address"] = register_address(words[1])
+                step["values"] = [int(value, 0) & 0xFFFF for value in words[2:]]
+                if not step["values"]:
+                    raise ValueError("No values")
+                step["count"] = len(step["values"])
+        except (ValueError, IndexError) as ex:
+            raise ValueError("Line %d: %s (%s)" % (number, text, ex))
+        steps.append(step)
+    return steps
+
+
+## Returns the Modbus requests of a step as (function code, address, quantity, value) tuples
+def step_requests(step: dict) -> list:
+    requests = []
+    if step["step"] in ("write", "verify"):
+        if step["count"] == 1:
+            requests.append((cst.WRITE_SINGLE_REGISTER, step["address"], 0, step["values"][0]))
+        else:
+            requests.append((cst.WRITE_MULTIPLE_REGISTERS, step["address"], 0, step["values"]))
+    if step["step"] in ("read", "verify", "expect"):
+        requests.append((cst.READ_HOLDING_REGISTERS, step["address"], step["count"], 0))
+    return requests
+
+
+## Returns (ok, message) for a step from the answers of its requests, an answer is a result or an Exception
+def step_result(step: dict, answers: list) -> tuple:
+    for answer in answers:
+        if isinstance(answer, Exception):
+            return False, "error: " + str(answer)
+    if step["step"] == "write":
+        return True, "OK"
+    values = list(answers[-1])
+    if step["step"] == "read":
+        return True, " ".join(str(value) for value in values)
+    if values != step["values"]:
+        return False, "MISMATCH, read " + " ".join(str(value) for value in values)
+    return True, "OK"
+
+
+## Executes the requests of a batch of steps and returns the answers per step, "pipeline" needs a BrokerSession
+def execute_batch(session, batch: list, pipeline: bool) -> list:
+    requests = [request for step in batch for request in step_requests(step)]
+    if pipeline:
+        try:
+            answers = session.transact([{"op": "execute", "function": function, "address": address,
+                                         "quantity": quantity, "value": value}
+                                        for function, address, quantity, value in requests])
+            answers = [answer["result"] if "error" not in answer else Exception(answer["error"])
+                       for answer in answers]
+        except (OSError, ValueError) as ex:
+            answers = [ex] * len(requests)
+    else:
+        answers = []
+        for function, address, quantity, value in requests:
+            try:
+                answers.append(session.execute(function, address, quantity, value))
+            except Exception as ex:
+                answers.append(ex)
+    per_step = []
+    for step in batch:
+        count = len(step_requests(step))
+        per_step.append(answers[:count])
+        answers = answers[count:]
+    return per_step
+
+
+## Runs the steps on a session and prints a line per step and a timing report
+#  @param session BrokerSession or ModbusSession
+#  @param steps Steps from parse_script()
+#  @param pipeline (optional) Send the steps between two sleeps at once when the session is a BrokerSession
+#  @param stop_on_error (optional) Stop at the first failed step, this turns pipelining off
+#  @param out (optional) Output stream
+#  @return Number of failed steps
+def run(session, steps: list, pipeline: bool=True, stop_on_error: bool=False, out=sys.stdout) -> int:
+    pipeline = pipeline and not stop_on_error and uses_broker(session)
+    failed = 0
+    requests = 0
+    start = time.monotonic()
+    batches = []
+    for step in steps:
+        if step["step"] == "sleep" or not pipeline or not batches or batches[-1][0]["step"] == "sleep":
+            batches.append([step])
+        else:
+            batches[-1].append(step)
+    for batch in batches:
+        if batch[0]["step"] == "sleep":
+            time.sleep(batch[0]["seconds"])
+            print("%4d %s: OK" % (batch[0]["line"], batch[0]["text"]), file=out)
+            continue
+        batch_start = time.monotonic()
+        results = execute_batch(session, batch, pipeline)
+        duration = time.monotonic() - batch_start
+        for step, answers in zip(batch, results):
+            requests += len(answers)
+            ok, message = step_result(step, answers)
+            if not ok:
+                failed += 1
+            if len(batch) == 1:
+                message += " (%.1f ms)" % (1000.0 * duration)
+            print("%4d %s: %s" % (step["line"], step["text"], message), file=out)
+        if len(batch) > 1:
+            print("     %d steps pipelined in %.1f ms" % (len(batch), 1000.0 * duration), file=out)
+        if failed and stop_on_error:
+            break
+    total = time.monotonic() - start
+    print("%d steps, %d Modbus requests, %d failed, %.3f s (%.1f ms per request)"
+          % (len(steps), requests, failed, total, 1000.0 * total / requests if requests else 0.0), file=out)
+    return failed
+
+
+## Runs the steps like run(). Without the broker the session opens the serial port itself, so the lock of the
+#  port is taken first, as Sanitrax_CTRL.py does around its cycles (see lock_file() in modbus_broker.py).
+#  @return Number of failed steps, None if the port stayed locked
+def run_locked(session, steps: list, pipeline: bool=True, stop_on_error: bool=False, out=sys.stdout):
+    if uses_broker(session):
+        return run(session, steps, pipeline, stop_on_error, out)
+    try:
+        with SimpleFlock(lock_file(session.port), LOCK_TIMEOUT):
+            return run(session, steps, pipeline, stop_on_error, out)
+    except TimeoutError:
+        print("Serial port", session.port, "is in use (" + lock_file(session.port) + "),",
+              "start modbus_broker.py or try again later", file=sys.stderr)
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a script of Modbus reads, writes and verifications")
+    parser.add_argument("script", help="script file, or - for stdin")
+    parser.add_argument("--broker", default=SOCKET_PATH, help="socket of the Modbus broker (default %(default)s)")
+    parser.add_argument("--port", default=PORT, help="serial port without broker (default %(default)s)")
+    parser.add_argument("--baudrate", type=int, default=BAUDRATE, help="baudrate without broker (default %(default)s)")
+    parser.add_argument("--timeout", type=float, default=1.0, help="response timeout without broker (default 1)")
+    parser.add_argument("--no-pipeline", action="store_true", help="send the steps one by one")
+    parser.add_argument("--stop-on-error", action="store_true", help="stop at the first failed step")
+    args = parser.parse_args()
+
+    try:
+        if args.script == '-':
+            steps = parse_script(sys.stdin)
+        else:
+            with open(args.script, 'r') as fp:
+                steps = parse_script(fp)
+    except (OSError, ValueError) as ex:
+        print(ex, file=sys.stderr)
+        sys.exit(2)
+
+    with open_session(args.broker, PRIORITY_ACTION, args.port, args.baudrate, args.timeout) as session:
+        failed = run_locked(session, steps, not args.no_pipeline, args.stop_on_error)
+    sys.exit(0 if failed == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
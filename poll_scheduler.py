@@ -0,0 +1,60 @@
+from sanitrax_registers import modbus_keys, bstate, hstate, pstate
+
+# States that are polled at the fast rate: (state register, state names)
+ACTIVE_STATES = (('mb_bstate', ('BREAKTANK_AUTO_TIMEOUT',)),
+                 ('mb_hstate', ('HYDROPHORE_AUTO_ON',)),
+                 ('mb_p1state', ('PUMP_AUTO_ON',)),
+                 ('mb_p2state', ('PUMP_AUTO_ON',)))
+STATE_NAMES = {'mb_bstate': bstate, 'mb_hstate': hstate, 'mb_p1state': pstate, 'mb_p2state': pstate}
+
+
+## Returns the reasons why the plant is active, an empty list when it is idle: a breaktank timeout, a running
+#  hydrophore or pump in automatic mode, or a set bit in mb_fault.
+#  @param modbus_values List of the register values of a cycle, the index of a value is its address
+def activity(modbus_values: list) -> list:
+    reasons = []
+    for key, names in ACTIVE_STATES:
+        value = modbus_values[modbus_keys.index(key)]
+        states = STATE_NAMES[key]
+        if value is not None and value < len(states) and states[value] in names:
+            reasons.append(key[3:] + ' ' + states[value])
+    fault = modbus_values[modbus_keys.index('mb_fault')]
+    if fault:
+        reasons.append('fault 0x%04x' % fault)
+    return reasons
+
+
+## Chooses the time until the next poll from the state of the plant. While the plant is active it is polled every
+#  "min_interval" seconds. Once it is idle the rate stays fast for "hold" more cycles, to catch the end of the
+#  event, and then the interval grows by "backoff" every cycle up to the "max_interval" heartbeat. Activity
+#  switches back to the fast rate at once.
+class PollScheduler:
+    ## Initializes the scheduler, it starts at the fast rate
+    #  @param min_interval Time in seconds between two polls while active
+    #  @param max_interval Time in seconds between two polls while idle (the heartbeat)
+    #  @param backoff (optional) Factor by which the interval grows per idle cycle
+    #  @param hold (optional) Number of idle cycles that are still polled at the fast rate
+    def __init__(self, min_interval: float, max_interval: float, backoff: float=2.0, hold: int=3):
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError("Invalid poll intervals: %s to %s" % (min_interval, max_interval))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = max(backoff, 1.0)
+        self.hold = hold
+        self.interval = min_interval
+        self.__idle = 0
+
+    ## Returns the interval until the next poll after a cycle
+    #  @param active True if the plant was active in the cycle, None if the controller could not be read
+    def next_interval(self, active: bool) -> float:
+        if active is None:
+            # Nothing is known about the plant, keep the current rate
+            return self.interval
+        if active:
+            self.__idle = 0
+            self.interval = self.min_interval
+        else:
+            self.__idle += 1
+            if self.__idle > self.hold:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
@@ -0,0 +1,98 @@
+import time
+
+
+## A block of consecutive holding registers that is refreshed at its own interval
+class RegisterGroup:
+    ## Initializes the group
+    #  @param name Name of the group
+    #  @param address First register address of the group
+    #  @param amount Number of registers in the group
+    #  @param interval Refresh interval in seconds (0 means every cycle)
+    def __init__(self, name: str, address: int, amount: int, interval: float):
+        self.name = name
+        self.address = address
+        self.amount = amount
+        self.interval = interval
+        self.last_read = None
+
+    ## Returns True if the group was never read or its refresh interval has passed
+    def is_due(self, now: float) -> bool:
+        return self.last_read is None or now - self.last_read >= self.interval
+
+
+## Plans which registers have to be read each cycle and keeps a merged image of the complete register space.
+#  Groups that are due in the same cycle are coalesced into as few read requests as possible, bridging small
+#  gaps between them because one extra register costs less bus time than an extra request frame.
+class ReadPlanner:
+    ## Initializes the planner
+    #  @param groups List of RegisterGroup objects, they should not overlap
+    #  @param max_gap (optional) Largest gap in registers that is read along to merge two requests
+    #  @param max_amount (optional) Maximum number of registers in a single read request
+    def __init__(self, groups: list, max_gap: int=8, max_amount: int=125):
+        self.groups = sorted(groups, key=lambda group: group.address)
+        self.size = max(group.address + group.amount for group in self.groups)
+        self.image = [None] * self.size
+        self.__max_gap = max_gap
+        self.__max_amount = max_amount
+
+    ## Creates a planner from a register key tuple
+    #  @param keys Tuple of register names, the index of a name is its address
+    #  @param groups Iterable of (name, first key, last key, interval) tuples
+    #  @param max_gap (optional) See ReadPlanner()
+    @classmethod
+    def from_keys(cls, keys: tuple, groups, max_gap: int=8):
+        register_groups = []
+        for name, first_key, last_key, interval in groups:
+            first = keys.index(first_key)
+            register_groups.append(RegisterGroup(name, first, keys.index(last_key) - first + 1, interval))
+        return cls(register_groups, max_gap=max_gap)
+
+    ## Returns the groups that have to be read at time "now"
+    def due(self, now: float=None) -> list:
+        if now is None:
+            now = time.monotonic()
+        return [group for group in self.groups if group.is_due(now)]
+
+    ## Returns the read requests for this cycle as a list of (address, amount) tuples
+    def plan(self, now: float=None) -> list:
+        reads = []
+        for group in self.due(now):
+            if reads:
+                address, amount = reads[-1]
+                end = group.address + group.amount
+                if group.address - (address + amount) <= self.__max_gap and end - address <= self.__max_amount:
+                    reads[-1] = (address, end - address)
+                    continue
+            reads.append((group.address, group.amount))
+        return reads
+
+    ## Stores the result of a read request in the image and marks the groups it fully covers as refreshed
+    #  @param address Starting address of the read
+    #  @param values Register values that were read
+    #  @param now (optional) Time of the read (time.monotonic())
+    def store(self, address: int, values, now: float=None):
+        if now is None:
+            now = time.monotonic()
+        end = address + len(values)
+        self.image[address:end] = values
+        for group in self.groups:
+            if group.address >= address and group.address + group.amount <= end:
+                group.last_read = now
+
+    ## Updates registers in the image after they have been written, without changing the refresh times
+    def update(self, address: int, values):
+        self.image[address:address + len(values)] = values
+
+    ## Forces a group (or all groups if no name is given) to be read in the next cycle
+    def invalidate(self, name: str=None):
+        for group in self.groups:
+            if name is None or group.name == name:
+                group.last_read = None
+
+    ## Returns True when every register in the image has been read at least once
+    def complete(self) -> bool:
+        return None not in self.image
+
+    ## Returns the merged register image as a tuple
+    def values(self) -> tuple:
+        return tuple(self.image)
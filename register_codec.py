@@ -0,0 +1,143 @@
+import math
+import struct
+
+# Lookup table with the bits of every byte value, least significant bit first
+BYTE_BITS = tuple(tuple((value >> bit) & 1 for bit in range(8)) for value in range(256))
+
+
+## Decodes 16-bit bitfield registers (fault, IO and drive status words) into dictionaries of named bits.
+#  The field layout is compiled once, decoding a register is two table lookups per register.
+class BitfieldDecoder:
+    ## Initializes the decoder
+    #  @param fields Iterable of (name, register address, bit names) tuples, bit names start at bit 0
+    def __init__(self, fields):
+        self.fields = tuple((name, address, tuple(keys)) for name, address, keys in fields)
+        self.previous = None
+
+    ## Creates a decoder that finds the register addresses by name
+    #  @param register_keys Tuple of register names, the index of a name is its address
+    #  @param fields Iterable of (name, register name, bit names) tuples
+    @classmethod
+    def from_keys(cls, register_keys: tuple, fields):
+        return cls((name, register_keys.index(register), keys) for name, register, keys in fields)
+
+    ## Returns a dictionary of field name to a dictionary of bit name: 0 or 1, for all fields
+    #  @param values Tuple of register values, indexed by address
+    def decode(self, values) -> dict:
+        decoded = {}
+        for name, address, keys in self.fields:
+            value = values[address]
+            decoded[name] = dict(zip(keys, BYTE_BITS[value & 0xFF] + BYTE_BITS[(value >> 8) & 0xFF]))
+        return decoded
+
+    ## Returns only the bits that changed since the previous call, as a dictionary of field name to a dictionary
+    #  of bit name: new value. Fields without changes are left out, the first call returns every bit.
+    #  @param values Tuple of register values, indexed by address
+    def changes(self, values) -> dict:
+        current = tuple(values[address] for name, address, keys in self.fields)
+        if self.previous is None:
+            self.previous = current
+            return self.decode(values)
+        changed = {}
+        for (name, address, keys), old, new in zip(self.fields, self.previous, current):
+            flipped = old ^ new
+            if not flipped:
+                continue
+            bits = changed[name] = {}
+            while flipped:
+                lowest = flipped & -flipped
+                bit = lowest.bit_length() - 1
+                if bit < len(keys):
+                    bits[keys[bit]] = (new >> bit) & 1
+                flipped ^= lowest
+        self.previous = current
+        return changed
+
+
+## Describes how a register, or a pair of registers for a float32, is converted to an engineering value:
+#  value = (raw - zero) / divisor * factor + offset, truncated to an int if "integer" is set
+class RegisterSpec:
+    ## Initializes the description
+    #  @param type (optional) "uint16", "int16" (two's complement) or "float32" (IEEE 754 over two registers)
+    #  @param zero (optional) Raw value that is subtracted first
+    #  @param divisor (optional) Divisor of the raw value
+    #  @param factor (optional) Multiplier after the division
+    #  @param offset (optional) Value that is added last
+    #  @param integer (optional) Truncate the result to an int
+    #  @param words (optional) For float32: names of the two registers, in the order they are read
+    #  @param word_order (optional) For float32: "big" if the first register holds the high word, else "little"
+    def __init__(self, type: str='uint16', zero=0, divisor=1, factor=1, offset=0, integer: bool=False,
+                 words: tuple=None, word_order: str='big'):
+        if type not in ('uint16', 'int16', 'float32'):
+            raise ValueError("Unknown register type: " + type)
+        if type == 'float32' and (words is None or len(words) != 2):
+            raise ValueError("A float32 register needs the names of its two words")
+        self.type = type
+        self.zero = zero
+        self.divisor = divisor
+        self.factor = factor
+        self.offset = offset
+        self.integer = integer
+        self.words = words
+        self.word_order = word_order
+
+    ## Returns True if the value is not just the (signed) register value
+    @property
+    def scaled(self) -> bool:
+        return self.zero != 0 or self.divisor != 1 or self.factor != 1 or self.offset != 0 or self.integer
+
+
+## Converts a tuple of raw register values into engineering values. The register map is compiled once into index
+#  tables, so decoding does not look up keys and does not rewrite dictionary entries.
+class RegisterCodec:
+    ## Initializes the codec
+    #  @param keys Tuple of register names, the index of a name is its address
+    #  @param register_map Dictionary of name to RegisterSpec, registers that are not in the map are uint16.
+    #                      A float32 entry adds a new name that is not a register itself.
+    def __init__(self, keys: tuple, register_map: dict):
+        self.keys = tuple(keys)
+        signed = []
+        scaled = []
+        floats = []
+        for name, spec in register_map.items():
+            if spec.type == 'float32':
+                first, second = (keys.index(word) for word in spec.words)
+                high, low = (first, second) if spec.word_order == 'big' else (second, first)
+                floats.append((name, high, low, spec))
+                continue
+            index = keys.index(name)
+            if spec.type == 'int16':
+                signed.append(index)
+            if spec.scaled:
+                scaled.append((index, spec.zero, spec.divisor, spec.factor, spec.offset, spec.integer))
+        self.__signed = tuple(sorted(signed))
+        self.__scaled = tuple(sorted(scaled))
+        self.__floats = tuple(floats)
+
+    ## Returns the register values with the two's complement of the signed registers resolved
+    #  @param raw Tuple of raw (unsigned) register values, indexed by address
+    def signed(self, raw) -> tuple:
+        values = list(raw)
+        for index in self.__signed:
+            if index < len(values) and values[index] > 0x7FFF:
+                values[index] -= 0x10000
+        return tuple(values)
+
+    ## Returns (values, engineering): the signed register values as a tuple and a dictionary of name to
+    #  engineering value for every register that was read, plus the float32 values
+    #  @param raw Tuple of raw (unsigned) register values, indexed by address
+    def decode(self, raw) -> tuple:
+        values = self.signed(raw)
+        engineering = list(values)
+        for index, zero, divisor, factor, offset, integer in self.__scaled:
+            if index < len(engineering):
+                value = (engineering[index] - zero) / divisor * factor + offset
+                engineering[index] = int(value) if integer else value
+        engineering = dict(zip(self.keys, engineering))
+        for name, high, low, spec in self.__floats:
+            value = struct.unpack('>f', struct.pack('>HH', raw[high] & 0xFFFF, raw[low] & 0xFFFF))[0]
+            if math.isfinite(value):
+                engineering[name] = (value - spec.zero) / spec.divisor * spec.factor + spec.offset
+            else:
+                engineering[name] = None
+        return values, engineering
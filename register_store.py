@@ -0,0 +1,194 @@
+import os
+import sys
+import mmap
+import time
+import struct
+from bisect import bisect_left
+
+# File layout: a 16 byte header followed by fixed-width little-endian records of a float64 Unix timestamp and the
+# uint16 register values, padded to a multiple of 8 bytes so timestamp and register columns can be viewed in place.
+MAGIC = b'SRXB'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI4x')  # magic, version, register count, record size
+HEADER_SIZE = HEADER.size
+MISSING = 0xFFFF
+
+
+## Returns the record size for a number of registers
+def record_size(count: int) -> int:
+    return (8 + 2 * count + 7) // 8 * 8
+
+
+## Appends raw register rows to one binary file per UTC day ("<directory>/YYYY-MM-DD_<name>.bin").
+#  Like CsvLogger the file of the current day is kept open and rows are buffered.
+class RegisterStore:
+    ## Initializes the store, the file is opened with the first row
+    #  @param directory Directory of the files
+    #  @param name Name of the log, part of the file name
+    #  @param count Number of registers per row
+    #  @param flush_rows (optional) Number of buffered rows that triggers a write
+    #  @param flush_interval (optional) Maximum time in seconds that a row stays in the buffer
+    def __init__(self, directory: str, name: str, count: int, flush_rows: int=1, flush_interval: float=0.0):
+        self.directory = directory
+        self.name = name
+        self.count = count
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval
+        self.__record = struct.Struct('<d%dH%dx' % (count, record_size(count) - 8 - 2 * count))
+        self.__rows = []
+        self.__day = None
+        self.__fp = None
+        self.__last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    ## Returns the file name for a date (YYYY-MM-DD)
+    def filename(self, logdate: str) -> str:
+        return os.path.join(self.directory, logdate + "_" + self.name + '.bin')
+
+    def __open(self, logdate: str):
+        self.__close_file()
+        self.__fp = open(self.filename(logdate), 'ab')
+        self.__day = logdate
+        if self.__fp.tell() == 0:
+            self.__fp.write(HEADER.pack(MAGIC, VERSION, self.count, self.__record.size))
+        else:
+            # Drop a partial record that was cut off by a power loss, so the records stay aligned
+            size = self.__fp.tell()
+            extra = (size - HEADER_SIZE) % self.__record.size
+            if extra:
+                self.__fp.truncate(size - extra)
+                self.__fp.seek(0, os.SEEK_END)
+
+    def __close_file(self):
+        if self.__fp is not None:
+            self.__fp.close()
+            self.__fp = None
+
+    ## Adds a row of register values, missing (None) values are stored as 0xFFFF
+    #  @param values Register values, at most "count"
+    #  @param timestamp (optional) Unix timestamp of the row, defaults to now
+    def write(self, values, timestamp: float=None):
+        if timestamp is None:
+            timestamp = time.time()
+        row = [MISSING if value is None else value & 0xFFFF for value in values[:self.count]]
+        row.extend([MISSING] * (self.count - len(row)))
+        self.__rows.append((time.strftime("%Y-%m-%d", time.gmtime(timestamp)),
+                            self.__record.pack(timestamp, *row)))
+        if len(self.__rows) >= self.flush_rows or time.monotonic() - self.__last_flush >= self.flush_interval:
+            self.flush()
+
+    ## Writes all buffered rows to their files, a new file is started for every new UTC day
+    def flush(self):
+        for logdate, record in self.__rows:
+            if logdate != self.__day:
+                self.__open(logdate)
+            self.__fp.write(record)
+        self.__rows = []
+        self.__last_flush = time.monotonic()
+        if self.__fp is not None:
+            self.__fp.flush()
+
+    ## Writes the buffered rows and closes the file
+    def close(self):
+        self.flush()
+        self.__close_file()
+        self.__day = None
+
+
+## Read access to a binary register file through a memory map. Columns are returned as strided memoryviews on the
+#  map without copying; numpy.asarray() turns them into arrays, also without copying. The views (and arrays on
+#  them) have to be released or dropped before the archive is closed.
+class RegisterArchive:
+    ## Opens a file written by RegisterStore
+    #  @param path File name
+    def __init__(self, path: str):
+        if sys.byteorder != 'little':
+            raise OSError("Register archives can only be mapped on little-endian machines")
+        self.path = path
+        self.__fp = open(path, 'rb')
+        header = self.__fp.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            self.__fp.close()
+            raise ValueError(path + " is not a register archive")
+        magic, version, self.count, self.record_size = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or self.record_size != record_size(self.count):
+            self.__fp.close()
+            raise ValueError(path + " is not a register archive")
+        size = os.fstat(self.__fp.fileno()).st_size
+        # A record that is still being written is left out
+        self.rows = (size - HEADER_SIZE) // self.record_size
+        self.__map = None
+        self.__view = None
+        if self.rows:
+            self.__map = mmap.mmap(self.__fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__view = memoryview(self.__map)[HEADER_SIZE:HEADER_SIZE + self.rows * self.record_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def close(self):
+        if self.__view is not None:
+            self.__view.release()
+            self.__view = None
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        self.__fp.close()
+
+    ## Returns the timestamps of all rows as a memoryview of float64 values
+    def timestamps(self) -> memoryview:
+        if self.__view is None:
+            return memoryview(b'').cast('d')
+        return self.__view.cast('d')[::self.record_size // 8]
+
+    ## Returns register "index" of all rows as a memoryview of uint16 values
+    #  @param index Register address
+    #  @param start (optional) First row
+    #  @param stop (optional) Row after the last row
+    def column(self, index: int, start: int=0, stop: int=None) -> memoryview:
+        if not 0 <= index < self.count:
+            raise IndexError("Register " + str(index) + " is not in the archive")
+        if self.__view is None:
+            return memoryview(b'').cast('H')
+        if stop is None or stop > self.rows:
+            stop = self.rows
+        step = self.record_size // 2
+        return self.__view.cast('H')[start * step + 4 + index:stop * step:step]
+
+    ## Returns (timestamp, values) of one row
+    def row(self, row: int) -> tuple:
+        if not 0 <= row < self.rows:
+            raise IndexError("Row " + str(row) + " is not in the archive")
+        offset = row * self.record_size
+        timestamp = struct.unpack_from('<d', self.__view, offset)[0]
+        return timestamp, struct.unpack_from('<%dH' % self.count, self.__view, offset + 8)
+
+    ## Returns the (start, stop) rows of the records with first <= timestamp < last, the rows are expected to be
+    #  in time order, which they are as long as the clock is not set back
+    def range(self, first: float=None, last: float=None) -> tuple:
+        timestamps = self.timestamps()
+        start = 0 if first is None else bisect_left(timestamps, first)
+        stop = self.rows if last is None else bisect_left(timestamps, last)
+        return start, max(start, stop)
+
+    ## Returns the archive as a numpy structured array ("time" and "r0".."rN" fields) on the memory map
+    def as_numpy(self):
+        import numpy
+        dtype = numpy.dtype({'names': ['time'] + ['r' + str(index) for index in range(self.count)],
+                             'formats': ['<f8'] + ['<u2'] * self.count,
+                             'offsets': [0] + [8 + 2 * index for index in range(self.count)],
+                             'itemsize': self.record_size})
+        if self.__view is None:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.frombuffer(self.__view, dtype=dtype)
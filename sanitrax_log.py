@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+# Query and export tool for the raw register logs that Sanitrax_CTRL.py writes to "log/" (CSV and binary).
+# Example: registers of pump 1 for one hour, as 1 minute min/max/mean buckets in engineering units:
+#   python3 sanitrax_log.py --from "2025-10-09 12:00" --to "2025-10-09 13:00" \
+#       --registers mb_p1_Vac,mb_p1_Temp --bucket 60 --decode --format json
+# CSV logs get a sparse time index in "log/.index", which is updated with every query, so a query only reads the
+# rows of the requested time range. Binary logs are searched directly.
+
+import io
+import os
+import re
+import sys
+import csv
+import json
+import time
+import calendar
+import argparse
+from bisect import bisect_right
+from register_codec import RegisterCodec
+from register_store import RegisterArchive
+from sanitrax_registers import modbus_keys, register_map
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "log")
+LOG_NAME = "Sanitrax"
+# Number of rows between two entries of the time index
+INDEX_STEP = 256
+INDEX_DIR = ".index"
+# Number of registers in a log row
+LOG_REGISTERS = 95
+AGGREGATES = ("min", "max", "mean")
+TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+
+## Returns the Unix timestamp of a "YYYY-MM-DD[ HH:MM[:SS]]" UTC time or of a number
+def parse_time(text: str) -> float:
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    text = text.rstrip('Z')
+    for format in TIME_FORMATS:
+        try:
+            return float(calendar.timegm(time.strptime(text, format)))
+        except ValueError:
+            pass
+    raise ValueError("Unknown time: " + text)
+
+
+## Returns the time as "YYYY-MM-DDTHH:MM:SSZ"
+def format_time(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+## Sparse time index of a CSV log: the timestamp and byte offset of every "step"th row. The log is only appended
+#  to, so an update continues where the previous update stopped. The index is rebuilt if the log got shorter.
+class CsvIndex:
+    ## Initializes the index, call update() before use
+    #  @param path File name of the CSV log
+    #  @param index_path File name of the index
+    #  @param step (optional) Number of rows between two index entries
+    def __init__(self, path: str, index_path: str, step: int=INDEX_STEP):
+        self.path = path
+        self.index_path = index_path
+        self.step = step
+        self.size = 0
+        self.rows = 0
+        self.entries = []
+        self.__days = {}
+
+    ## Returns the Unix timestamp of a row, from its "Date" and "Time (UTC)" columns
+    def timestamp(self, logdate: str, logtime: str) -> float:
+        day = self.__days.get(logdate)
+        if day is None:
+            day = self.__days[logdate] = calendar.timegm(time.strptime(logdate, "%Y-%m-%d"))
+        hours, minutes, seconds = logtime.split(':')
+        return day + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+    def __load(self):
+        try:
+            with open(self.index_path, 'r') as fp:
+                stored = json.load(fp)
+            if stored["step"] == self.step:
+                self.size = stored["size"]
+                self.rows = stored["rows"]
+                self.entries = stored["entries"]
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.size = 0
+        self.rows = 0
+        self.entries = []
+
+    def __save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        with open(self.index_path + '.tmp', 'w') as fp:
+            json.dump({"step": self.step, "size": self.size, "rows": self.rows, "entries": self.entries}, fp,
+                      separators=(',', ':'))
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    ## Indexes the rows that were added since the last update
+    #  @param rebuild (optional) Index the whole file again
+    def update(self, rebuild: bool=False):
+        if rebuild:
+            self.size = self.rows = 0
+            self.entries = []
+        else:
+            self.__load()
+        with open(self.path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size < self.size:
+                self.size = self.rows = 0
+                self.entries = []
+            if self.size == 0:
+                # Skip the header
+                header = fp.readline()
+                if not header.endswith(b'\n'):
+                    return
+                self.size = fp.tell()
+            fp.seek(self.size)
+            start = self.size
+            offset = self.size
+            for line in fp:
+                # A row that is still being written is indexed with the next update
+                if not line.endswith(b'\n'):
+                    break
+                if self.rows % self.step == 0:
+                    logdate, logtime = line.decode('ascii', 'replace').split(';', 2)[:2]
+                    self.entries.append((self.timestamp(logdate, logtime), offset))
+                self.rows += 1
+                offset += len(line)
+            self.size = offset
+        if self.size != start or rebuild:
+            self.__save()
+
+    ## Returns the offset of the last indexed row at or before "first", reading from there finds all later rows
+    def seek(self, first: float) -> int:
+        if first is None or not self.entries:
+            return self.entries[0][1] if self.entries else self.size
+        position = bisect_right([timestamp for timestamp, offset in self.entries], first) - 1
+        return self.entries[max(0, position)][1]
+
+
+## Yields (timestamp, raw register tuple) for the rows of a CSV log with first <= timestamp < last
+def read_csv(path: str, first: float, last: float, index_dir: str, rebuild: bool=False):
+    index = CsvIndex(path, os.path.join(index_dir, os.path.basename(path) + '.idx'))
+    index.update(rebuild)
+    with open(path, 'rb') as fp:
+        fp.seek(index.seek(first))
+        # Rows after the indexed part of the file are read too, they are the newest rows
+        for row in csv.reader(io.TextIOWrapper(fp, encoding='ascii', errors='replace', newline=''), delimiter=';'):
+            try:
+                timestamp = index.timestamp(row[0], row[1])
+                values = tuple(int(value) for value in row[2:])
+            except (ValueError, IndexError):
+                continue
+            if last is not None and timestamp >= last:
+                break
+            if first is None or timestamp >= first:
+                yield timestamp, values
+
+
+## Yields (timestamp, raw register tuple) for the rows of a binary log with first <= timestamp < last
+def read_binary(path: str, first: float, last: float):
+    with RegisterArchive(path) as archive:
+        start, stop = archive.range(first, last)
+        for row in range(start, stop):
+            yield archive.row(row)
+
+
+## Returns the log files ((date, path) tuples) that can hold rows between "first" and "last", in date order.
+#  When a day has a CSV and a binary log, "source" picks one: "auto" prefers the binary log.
+def log_files(directory: str, name: str, first: float, last: float, source: str="auto") -> list:
+    pattern = re.compile(r"^(\d{4}-\d{2}-\d{2})_" + re.escape(name) + r"\.(csv|bin)$")
+    days = {}
+    for filename in os.listdir(directory):
+        match = pattern.match(filename)
+        if match is None:
+            continue
+        logdate, extension = match.groups()
+        if source == "csv" and extension != "csv" or source == "binary" and extension != "bin":
+            continue
+        day = calendar.timegm(time.strptime(logdate, "%Y-%m-%d"))
+        if (first is not None and day + 86400 <= first) or (last is not None and day >= last):
+            continue
+        if logdate not in days or extension == "bin":
+            days[logdate] = os.path.join(directory, filename)
+    return sorted(days.items())
+
+
+## Returns the output columns as (name, address) tuples, address is None for values that only exist decoded
+#  @param registers Comma separated register names or addresses, all logged registers if empty
+#  @param decode Output engineering values
+def select_columns(registers: str, decode: bool) -> list:
+    if not registers:
+        columns = [(name, address) for address, name in enumerate(modbus_keys[:LOG_REGISTERS])]
+        if decode:
+            columns.extend((name, None) for name, spec in register_map.items() if spec.type == 'float32')
+        return columns
+    columns = []
+    for register in registers.split(','):
+        register = register.strip()
+        if register.isdigit() and int(register) < LOG_REGISTERS:
+            columns.append((modbus_keys[int(register)], int(register)))
+        elif register in modbus_keys[:LOG_REGISTERS]:
+            columns.append((register, modbus_keys.index(register)))
+        elif decode and register in register_map and register_map[register].type == 'float32':
+            columns.append((register, None))
+        else:
+            raise ValueError("Unknown register: " + register
+                             + (" (needs --decode)" if register in register_map and not decode else ""))
+    return columns
+
+
+## Yields (timestamp, values) with the values of the columns, raw or decoded
+def select(rows, columns: list, decode: bool):
+    codec = RegisterCodec(modbus_keys, register_map) if decode else None
+    for timestamp, raw in rows:
+        if codec is not None:
+            engineering = codec.decode(raw)[1]
+            yield timestamp, [engineering.get(name) for name, address in columns]
+        else:
+            yield timestamp, [raw[address] if address < len(raw) else None for name, address in columns]
+
+
+## Yields (bucket start, values) with the aggregates of every column per bucket of "bucket" seconds, the values
+#  are ordered per column and then per aggregate. Buckets without rows are left out.
+def downsample(rows, count: int, bucket: float, aggregates: tuple):
+    current = None
+    stats = None
+    for timestamp, values in rows:
+        start = timestamp - timestamp % bucket
+        if start != current:
+            if current is not None:
+                yield current, summarize(stats, aggregates)
+            current = start
+            stats = [[None, None, 0, 0] for i in range(count)]
+        for stat, value in zip(stats, values):
+            if value is None:
+                continue
+            if stat[3] == 0 or value < stat[0]:
+                stat[0] = value
+            if stat[3] == 0 or value > stat[1]:
+                stat[1] = value
+            stat[2] += value
+            stat[3] += 1
+    if current is not None:
+        yield current, summarize(stats, aggregates)
+
+
+def summarize(stats: list, aggregates: tuple) -> list:
+    values = []
+    for minimum, maximum, total, count in stats:
+        for aggregate in aggregates:
+            if aggregate == "min":
+                values.append(minimum)
+            elif aggregate == "max":
+                values.append(maximum)
+            else:
+                values.append(total / count if count else None)
+    return values
+
+
+def write_csv(out, header: list, rows, delimiter: str):
+    writer = csv.writer(out, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(["time"] + header)
+    for timestamp, values in rows:
+        writer.writerow([format_time(timestamp)] + ['' if value is None else value for value in values])
+
+
+def write_json(out, header: list, rows):
+    # Written as a list of records, one per line, without keeping the result in memory
+    out.write('[')
+    separator = '\n'
+    for timestamp, values in rows:
+        record = {"time": format_time(timestamp)}
+        record.update(zip(header, values))
+        out.write(separator + json.dumps(record, separators=(',', ':')))
+        separator = ',\n'
+    out.write('\n]\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and export the Sanitrax register logs")
+    parser.add_argument("--dir", default=LOG_DIR, help="log directory (default %(default)s)")
+    parser.add_argument("--name", default=LOG_NAME, help="name of the log (default %(default)s)")
+    parser.add_argument("--from", dest="first", type=parse_time,
+                        help="first time, UTC \"YYYY-MM-DD[ HH:MM[:SS]]\" or Unix timestamp")
+    parser.add_argument("--to", dest="last", type=parse_time, help="end time (exclusive), same formats as --from")
+    parser.add_argument("--registers", default="", help="comma separated register names or addresses (default all)")
+    parser.add_argument("--decode", action="store_true", help="output engineering values instead of raw registers")
+    parser.add_argument("--bucket", type=float, default=0, help="downsample to buckets of this many seconds")
+    parser.add_argument("--aggregates", default=",".join(AGGREGATES),
+                        help="aggregates per bucket: min, max and/or mean (default %(default)s)")
+    parser.add_argument("--format", choices=("csv", "json"), default="csv", help="output format (default csv)")
+    parser.add_argument("--delimiter", default=";", help="CSV delimiter (default %(default)s)")
+    parser.add_argument("--output", help="output file (default stdout)")
+    parser.add_argument("--source", choices=("auto", "csv", "binary"), default="auto",
+                        help="log files to read when a day has both (default auto: binary)")
+    parser.add_argument("--reindex", action="store_true", help="rebuild the time index of the CSV logs")
+    parser.add_argument("--index-only", action="store_true", help="only update the time index of the CSV logs")
+    args = parser.parse_args()
+
+    try:
+        columns = select_columns(args.registers, args.decode)
+        aggregates = tuple(aggregate.strip() for aggregate in args.aggregates.split(','))
+        for aggregate in aggregates:
+            if aggregate not in AGGREGATES:
+                raise ValueError("Unknown aggregate: " + aggregate)
+        files = log_files(args.dir, args.name, args.first, args.last, args.source)
+    except (ValueError, OSError) as ex:
+        print(ex, file=sys.stderr)
+        sys.exit(2)
+
+    index_dir = os.path.join(args.dir, INDEX_DIR)
+    if args.index_only:
+        for logdate, path in log_files(args.dir, args.name, args.first, args.last, "csv"):
+            CsvIndex(path, os.path.join(index_dir, os.path.basename(path) + '.idx')).update(args.reindex)
+        return
+
+    def rows():
+        for logdate, path in files:
+            if path.endswith('.bin'):
+                yield from read_binary(path, args.first, args.last)
+            else:
+                yield from read_csv(path, args.first, args.last, index_dir, args.reindex)
+
+    header = [name for name, address in columns]
+    output = select(rows(), columns, args.decode)
+    if args.bucket > 0:
+        header = [name + "_" + aggregate for name in header for aggregate in aggregates]
+        output = downsample(output, len(columns), args.bucket, aggregates)
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        if args.format == "json":
+            write_json(out, header, output)
+        else:
+            write_csv(out, header, output, args.delimiter)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+# Register map of the Sanitrax controller, shared by the polling script and the tools that read its logs
+
+from register_codec import RegisterSpec
+
+# Substructed raw value for correct scaling
+RAW_FACTOR = 4630
+# Raw values interval between equilevant -1 to 0 bars
+RAW_DIF = 14050
+
+# Raw value for 60 degrees (absence of calculation origin)
+RAW_TEMP_MAX = 10000
+RAW_TEMP_MIN = 0
+
+# Actual temperature value in Celsius degrees value equilavent to 8000
+TEMP_MAX = 100
+TEMP_MIN = -100
+
+# STRING TUPLES AND DICTIONARIES
+modbus_keys = ('mb_magic',  # Used for API version (R) and special functions (W)
+               'mb_hydrophore_postrun',  # Time to run after pressure has been reached
+               'mb_hydrophore_timeout',  # Maximum time to reach pressure
+               'mb_breaktank_delay',  # Delay for exiting error states in the breaktank
+               'mb_breaktank_fill_timeout',  # Maximum time for breaktank to go from empty to low
+               'mb_pump_start',  # Vacuum pressure value for pump start
+               'mb_pump_stop',  # Vacuum pressure value for pump stop
+               'mb_pump_throttle_start',  # Vacuum pressure value for pump to start throttling down
+               'mb_pump_throttle_stop',  # Vacuum pressure value for pump to stop throttling down
+               'mb_pump_timeout',  # Maximum time to reach vacuum pressure
+               'mb_pump_max_runtime',  # Maximum runtime at high power (fault if reached)
+               'mb_pump_max_temp',  # Maximum pump temperature
+               'mb_flush_start',  # Temperature value for flush valve open
+               'mb_flush_stop',  # Temperature value for flush valve close
+               'mb_flush_timeout',  # Maximum time to reach low temperature
+               'mb_antifreeze_dose_1',  # Dosing concentration in % when external_temp < temp_1, set by user
+               'mb_antifreeze_dose_2',  # Dosing concentration in % when external_temp < temp_2, set by user
+               'mb_antifreeze_dose_3',  # Dosing concentration in % when external_temp < temp_3, set by user
+               'mb_antifreeze_dose_4',  # Dosing concentration in % when external_temp < temp_4, set by user
+               'mb_antifreeze_dose_5',  # Dosing concentration in % when external_temp < temp_5, set by user
+               'mb_antifreeze_dose_manual',  # Manual dosing concentration in %
+               'mb_antifreeze_temp_1',  # temperature limit for low value
+               'mb_antifreeze_temp_2',  # temperature limit lower value
+               'mb_antifreeze_temp_3',  # temperature limit lower value
+               'mb_antifreeze_temp_4',  # temperature limit lower value
+               'mb_antifreeze_temp_5',  # temperature limit lowest value
+               'mb_dosingpump_factor',  # Dosing pump  capacity in liters per hour
+               'mb_watermeter_factor',  # Pulse per liter
+               'mb_reset_breaktank',  # Set to 1 for exiting timeout state
+               'mb_reset_hydrophore',  # Set to 1 for exiting timeout state
+               'mb_reset_pump_1',  # Set to 1 for reset procedure and or exit timeout state
+               'mb_reset_pump_2',  # Set to 1 for reset procedure and or exit timeout state
+               'mb_fault_mask',  # Can be changed to disable specific alarms from triggering main alarm
+               'mb_fault',  # 16-bit fault register
+               'mb_input_top',  # IO related
+               'mb_input_bottom',
+               'mb_output',
+               'mb_output_mask',
+               'mb_output_fault',
+               'mb_water_counter',  # Pulse counter
+               'mb_dose_counter',   # Dosing counter
+               'mb_current_dose',   # Current dosing percentage
+               'mb_pcb_temp',  # Temperature of onboard sensor x0.1 degrees Kelvin
+               'mb_external_temp',  # Environment temperature
+               'mb_external_temp_float_a',  # Part A of 32-bit float point value
+               'mb_external_temp_float_b',  # Part B of 32-bit float point value
+               'mb_bstate',  # Breaktank state
+               'mb_hstate',  # Hydrophore
+               'mb_p1state',  # Pump 1
+               'mb_p2state',  # Pump 2
+               'mb_f1state',  # Flush Valve 1
+               'mb_f2state',  # Flush Valve 2
+               'mb_dstate',   # Dose pump
+               'mb_p1_mbcode',  # Modbus error code for pump 1 (0 = OK)
+               'mb_p1_Pot',  # Pump variables
+               'mb_p1_Temp',
+               'mb_p1_Vac',
+               'mb_p1_State',
+               'mb_p1_Freq',
+               'mb_p1_PID',
+               'mb_p1_Fault',
+               'mb_p1_Status',
+               'mb_p1_Freq_Output',
+               'mb_p1_Freq_Ramp',
+               'mb_p1_Motor_Current',
+               'mb_p1_Motor_Torque',
+               'mb_p1_Ext_Status_Word',
+               'mb_p1_Mains_Volt',
+               'mb_p1_Motor_Volt',
+               'mb_p1_Drive_Therm_State',
+               'mb_p1_3210',
+               'mb_p1_Motor_Power',
+               'mb_p2_mbcode',  # Modbus error code for pump 2 (0 = OK)
+               'mb_p2_Pot',
+               'mb_p2_Temp',
+               'mb_p2_Vac',
+               'mb_p2_State',
+               'mb_p2_Freq',
+               'mb_p2_PID',
+               'mb_p2_Fault',
+               'mb_p2_Status',
+               'mb_p2_Freq_Output',
+               'mb_p2_Freq_Ramp',
+               'mb_p2_Motor_Current',
+               'mb_p2_Motor_Torque',
+               'mb_p2_Ext_Status_Word',
+               'mb_p2_Mains_Volt',
+               'mb_p2_Motor_Volt',
+               'mb_p2_Drive_Therm_State',
+               'mb_p2_3210',
+               'mb_p2_Motor_Power',
+               'mb_custom_run',  # Custom modbus command (R/W)
+               'mb_custom_slave',
+               'mb_custom_command',
+               'mb_custom_address',
+               'mb_custom_quantity',
+               'mb_custom_data0',
+               'mb_custom_data1',
+               'mb_custom_data2',
+               'mb_custom_data3',
+               'mb_custom_data4',
+               'mb_custom_data5',
+               'mb_custom_data6',
+               'mb_custom_data7',
+               'mb_custom_data8',
+               'mb_custom_data9',
+               'mb_custom_data10',
+               'mb_custom_data11',
+               'mb_custom_data12',
+               'mb_custom_data13',
+               'mb_custom_data14',
+               'mb_custom_data15')
+
+input_top_keys = ('DC_OK_12V',
+                  'DC_OK_24V',
+                  'Tank_Low',
+                  'Tank_Normal',
+                  'Tank_High',
+                  'Tank_Overflow',
+                  'Pressure_Switch',
+                  'Water_Counter',
+                  'Anti_Freeze',
+                  'Flush_Valve_2',
+                  'Flush_Valve_1',
+                  'Fill_Tank_Valve',
+                  'Dose_Switch_1',
+                  'Dose_Switch_2',
+                  'Hydrophore_OK',
+                  'Emergency_Stop_OK')
+
+input_bottom_keys = ('Vacuum_Pump_2_green',
+                     'Vacuum_Pump_2_red',
+                     'Vacuum_Pump_1_green',
+                     'Vacuum_Pump_1_red',
+                     'Hydrophore_Run',
+                     'Hydrophore_Red',
+                     'Alarm_Lamp',
+                     'Reset_Alarm',
+                     'Hydrophore_Manual',
+                     'Hydrophore_Auto',
+                     'Pump1_Manual',
+                     'Pump1_Auto',
+                     'Pump2_Manual',
+                     'Pump2_Auto',
+                     'Flush_Button_1',
+                     'Flush_Button_2')
+
+output_keys = ('b0',
+               'b1',
+               'b2',
+               'b3',
+               'Fill_Tank_Valve',
+               'Flush_Valve_1',
+               'Flush_Valve_2',
+               'Anti_Freeze',
+               'b8',
+               'Alarm_Lamp',
+               'Hydrophore_Red',
+               'Hydrophore_Run',
+               'Vacuum_Pump_1_red',
+               'Vacuum_Pump_1_green',
+               'Vacuum_Pump_2_red',
+               'Vacuum_Pump_2_green')
+
+fault_keys = ('Water_Supply_Error',
+              'Tank_Empty',
+              'Tank_Overflow',
+              'Hydrophore_Fail',
+              'Hydrophore_Timeout',
+              'Pump1_Comm_Error',
+              'Pump2_Comm_Error',
+              'Pump1_Fault',
+              'Pump2_Fault',
+              'Pump1_Timeout',
+              'Pump2_Timeout',
+              'Pump1_Overheat',
+              'Pump2_Overheat',
+              'Emergency_Stop',
+              'Dosing_Error',
+              'Temp_Sensor_Error')
+
+bstate = ('BREAKTANK_OFF',
+          'BREAKTANK_MANUAL',
+          'BREAKTANK_FAIL',
+          'BREAKTANK_AUTO_EMPTY',
+          'BREAKTANK_AUTO_LOW',
+          'BREAKTANK_AUTO_NORMAL',
+          'BREAKTANK_AUTO_HIGH',
+          'BREAKTANK_AUTO_OVERFLOW',
+          'BREAKTANK_AUTO_TIMEOUT')
+
+hstate = ('HYDROPHORE_OFF',
+          'HYDROPHORE_MANUAL',
+          'HYDROPHORE_FAIL',
+          'HYDROPHORE_AUTO_OFF',
+          'HYDROPHORE_AUTO_ON',
+          'HYDROPHORE_AUTO_POSTRUN',
+          'HYDROPHORE_AUTO_TIMEOUT')
+
+pstate = ('PUMP_OFF',
+          'PUMP_MANUAL',
+          'PUMP_FAIL',
+          'PUMP_AUTO_OFF',
+          'PUMP_AUTO_ON',
+          'PUMP_AUTO_TIMEOUT')
+
+fstate = ('FLUSH_OFF',
+          'FLUSH_MANUAL',
+          'FLUSH_AUTO_ON',
+          'FLUSH_AUTO_TIMEOUT')
+
+dstate = ('DOSE_OFF',
+          'DOSE_FIXED_OFF',
+          'DOSE_FIXED_ON',
+          'DOSE_AUTO_OFF',
+          'DOSE_AUTO_ON',
+          'DOSE_ALWAYS_ON',
+          'DOSE_ALWAYS_ON_PAUSE')
+
+pump_fault_dict = {'-3': 'Pump Overheat',
+                   '-2': 'Pump Timeout',
+                   '-1': 'No communication',
+                   '0': 'OK',
+                   '2': 'Control Eeprom (EEF1)',
+                   '3': 'Incorrect config. (CFF)',
+                   '4': 'Invalid config. (CFI)',
+                   '5': 'Modbus com. (SLF1)',
+                   '6': 'int. com.link (ILF)',
+                   '7': 'Com. network (CnF)',
+                   '8': 'External flt-LI/Bit (EPF1)',
+                   '9': 'Overcurrent (OCF)',
+                   '10': 'Precharge (CrF)',
+                   '11': 'Speed fdback loss (SPF)',
+                   '12': 'Load slipping (AnF)',
+                   '16': 'Drive overheat (OHF)',
+                   '17': 'Motor overload (OLF)',
+                   '18': 'Overbraking (ObF)',
+                   '19': 'Mains overvoltage (OSF)',
+                   '20': '1 output phase loss (OPF1)',
+                   '21': 'Input phase loss (PHF)',
+                   '22': 'Undervoltage (USF)',
+                   '23': 'Motor short circuit (SCF1)',
+                   '24': 'Overspeed (SOF)',
+                   '25': 'Auto-tuning (tnF)',
+                   '26': 'Rating error (InF1)',
+                   '27': 'PWR Calib. (InF2)',
+                   '28': 'Int.serial link (InF3)',
+                   '29': 'Int.Mfg area (InF4)',
+                   '30': 'Power Eeprom (EEF2)',
+                   '32': 'Ground short circuit (SCF3)',
+                   '33': '3out ph loss (OPF2)',
+                   '34': 'CAN com. (COF)',
+                   '35': 'Brake control (bLF)',
+                   '38': 'External fault com. (EPF2)',
+                   '41': 'Brake feedback (brF)',
+                   '42': 'PC com. (SLF2)',
+                   '44': 'Torque/current lim (SSF)',
+                   '45': 'HMI com. (SLF3)',
+                   '49': 'LI6=PTC probe (PtFL)',
+                   '50': 'PTC fault (OtFL)',
+                   '51': 'Internal- I measure (InF9)',
+                   '52': 'Internal-mains circuit (InFA)',
+                   '53': 'Internal- th. sensor (InFb)',
+                   '54': 'IGBT overheat (tJF)',
+                   '55': 'IGBT short circuit (SCF4)',
+                   '56': 'Motor short circuit (SCF5)',
+                   '58': 'Out. contact. stuck (FCF1)',
+                   '59': 'Out. contact. open. (FCF2)',
+                   '64': 'input contactor (LCF)',
+                   '67': 'IGBT desaturation (HdF)',
+                   '68': 'Internal-option (InF6)',
+                   '69': 'internal- CPU (InFE)',
+                   '71': 'AI3 4-20mA loss (LFF3)',
+                   '73': 'Cards pairing (HCF)',
+                   '76': 'Load fault (dLF)',
+                   '77': 'Bad conf (CFI2)',
+                   '99': 'Ch.sw. fault (CSF)',
+                   '100': 'Pr.Underload.Flt (ULF)',
+                   '101': 'Proc.Overload Flt (OLC)',
+                   '105': 'Angle error (ASF)',
+                   '107': 'Safety fault (SAFF)',
+                   '108': 'FB fault (FbE)',
+                   '109': 'FB stop flt. (FbES)'}
+
+# Register groups read by the planner: (name, first key, last key, refresh interval in seconds)
+# Groups with interval 0 are read every cycle, in a single run everything is read in one request
+register_groups = (('settings', 'mb_magic', 'mb_watermeter_factor', 60.0),
+                   ('io', 'mb_reset_breaktank', 'mb_output_fault', 0.0),
+                   ('state', 'mb_water_counter', 'mb_dstate', 0.0),
+                   ('pump1', 'mb_p1_mbcode', 'mb_p1_Motor_Power', 0.0),
+                   ('pump2', 'mb_p2_mbcode', 'mb_p2_Motor_Power', 0.0),
+                   ('custom', 'mb_custom_run', 'mb_custom_address', 60.0))
+
+Pump_Status = ('Reserved',
+               'Ready',
+               'Running',
+               'Fault',
+               'Power section line supply present',
+               'Reserved',
+               'Reserved',
+               'Alarm',
+               'Reserved',
+               'Command via Network',
+               'Reference reached',
+               'Reference outside limits',
+               'Reserved',
+               'Reserved',
+               'STOP key pressed',
+               'Reverse rotation')
+
+AntiFreeze_Status = ('Dose 1',
+                     'Dose 2',
+                     'Dose 3',
+                     'Dose 4',
+                     'Dose 5',
+                     'Fixed Dose',
+                     'Temperature 1',
+                     'Temperature 2',
+                     'Temperature 3',
+                     'Temperature 4',
+                     'Temperature 5',
+                     'Dosing pump factor',
+                     'Water meter factor',
+                     'Water counter',
+                     'Dose counter',
+                     'Current dose')
+
+Temperature = ('External temperature',
+               'External temperature A',
+               'External temperature B')
+
+
+# 16-bit registers that hold a bitfield: (section name, register, bit names from bit 0)
+bitfield_registers = (('top', 'mb_input_top', input_top_keys),
+                      ('bottom', 'mb_input_bottom', input_bottom_keys),
+                      ('output', 'mb_output', output_keys),
+                      ('output_mask', 'mb_output_mask', output_keys),
+                      ('output_fault', 'mb_output_fault', output_keys),
+                      ('fault', 'mb_fault', fault_keys),
+                      ('fault_mask', 'mb_fault_mask', fault_keys),
+                      ('pump1', 'mb_p1_Status', Pump_Status),
+                      ('pump2', 'mb_p2_Status', Pump_Status))
+
+# Registers that are not plain 16-bit unsigned values. Pressure and pump temperature are scaled from the raw
+# analog values, the drives report current and voltage in 0.1 units. Registers that are not listed are uint16.
+pump_pressure = RegisterSpec(zero=RAW_FACTOR, divisor=RAW_DIF, offset=-1)
+pump_temperature = RegisterSpec(zero=RAW_TEMP_MIN, divisor=RAW_TEMP_MAX - RAW_TEMP_MIN, factor=TEMP_MAX - TEMP_MIN,
+                                offset=TEMP_MIN, integer=True)
+register_map = {'mb_antifreeze_temp_1': RegisterSpec('int16'),
+                'mb_antifreeze_temp_2': RegisterSpec('int16'),
+                'mb_antifreeze_temp_3': RegisterSpec('int16'),
+                'mb_antifreeze_temp_4': RegisterSpec('int16'),
+                'mb_antifreeze_temp_5': RegisterSpec('int16'),
+                'mb_external_temp': RegisterSpec('int16', divisor=10),
+                'mb_external_temp_float': RegisterSpec('float32', words=('mb_external_temp_float_a',
+                                                                         'mb_external_temp_float_b')),
+                'mb_p1_Temp': pump_temperature,
+                'mb_p1_Vac': pump_pressure,
+                'mb_p1_Motor_Current': RegisterSpec(divisor=10),
+                'mb_p1_Mains_Volt': RegisterSpec(divisor=10),
+                'mb_p2_Temp': pump_temperature,
+                'mb_p2_Vac': pump_pressure,
+                'mb_p2_Motor_Current': RegisterSpec(divisor=10),
+                'mb_p2_Mains_Volt': RegisterSpec(divisor=10)}
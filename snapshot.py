@@ -0,0 +1,79 @@
+import os
+import json
+import time
+
+
+## Writes "text" to "path" through a temporary file and a rename, so readers see the old or the new file
+def replace_file(path: str, text: str):
+    with open(path + '.tmp', 'w') as fp:
+        fp.write(text)
+    os.replace(path + '.tmp', path)
+
+
+## Writes the decoded sections of a cycle as one snapshot file: {"sequence": n, "time": t, "sections": {...}}.
+#  The file is replaced atomically and only when a section changed, the sequence number counts the changes, so
+#  a reader gets a consistent state of one cycle with a single open. Optionally every section is also written to
+#  its own "<name>.json" file in "compat_dir", the layout that the NI-Toolkit reads. They are written when their
+#  section changed. The first write of a process also compares the files of the other sections with their
+#  content, since they may be stale or missing (for example after a run without them), and replaces those that
+#  differ. A run from cron whose sections did not change writes nothing, which spares the flash.
+class SnapshotWriter:
+    ## Initializes the writer and continues the sequence of an existing snapshot file
+    #  @param path Snapshot file
+    #  @param compat_dir (optional) Directory for the per-section files, None to leave them out
+    def __init__(self, path: str, compat_dir: str=None):
+        self.path = path
+        self.compat_dir = compat_dir
+        self.sequence = 0
+        self.__encoded = {}
+        self.__compat_written = False
+        try:
+            with open(path, 'r') as fp:
+                stored = json.load(fp)
+            self.sequence = stored["sequence"]
+            self.__encoded = {name: self.encode(section) for name, section in stored["sections"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+    @staticmethod
+    def encode(section) -> str:
+        return json.dumps(section, separators=(',', ':'))
+
+    ## Writes the snapshot if any section changed
+    #  @param sections Dictionary of section name to JSON serializable section
+    #  @param timestamp (optional) Unix timestamp of the snapshot, defaults to now
+    #  @return True if the snapshot was written
+    def write(self, sections: dict, timestamp: float=None) -> bool:
+        encoded = {name: self.encode(section) for name, section in sections.items()}
+        changed = [name for name in encoded if self.__encoded.get(name) != encoded[name]]
+        verify = [] if self.__compat_written else [name for name in encoded if name not in changed]
+        self.__compat_written = True
+        if not changed and encoded.keys() == self.__encoded.keys():
+            self.__write_compat(sections, changed, verify)
+            return False
+        self.sequence += 1
+        if timestamp is None:
+            timestamp = time.time()
+        # The sections are already encoded, they are put into the document as they are
+        replace_file(self.path, '{"sequence":%d,"time":%s,"sections":{%s}}\n' % (
+            self.sequence, json.dumps(timestamp),
+            ','.join(json.dumps(name) + ':' + text for name, text in encoded.items())))
+        self.__write_compat(sections, changed, verify)
+        self.__encoded = encoded
+        return True
+
+    ## Writes the compat files of the sections "names", and of the sections "verify" when the file differs
+    def __write_compat(self, sections: dict, names: list, verify: list):
+        if self.compat_dir is None:
+            return
+        for name in names + verify:
+            path = os.path.join(self.compat_dir, name + '.json')
+            text = json.dumps(sections[name], indent=4) + '\n'
+            if name in verify:
+                try:
+                    with open(path, 'r') as fp:
+                        if fp.read() == text:
+                            continue
+                except (OSError, UnicodeDecodeError):
+                    pass
+            replace_file(path, text)
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+
+
+## Returns a flat dictionary of "path/to/key": value for all leaves of a nested dictionary
+def flatten(document: dict, prefix: str='') -> dict:
+    flat = {}
+    for key, value in document.items():
+        path = prefix + str(key)
+        if isinstance(value, dict) and value:
+            flat.update(flatten(value, path + '/'))
+        else:
+            flat[path] = value
+    return flat
+
+
+## Returns the changes between two flattened documents as a dictionary of "path": value, removed paths get the
+#  value None (which deletes them in the database). A multi-path update may not hold a path and one of its
+#  descendants, so a removed path is left out when a changed path replaces it (a leaf that became a dictionary or
+#  the other way around).
+def diff(old: dict, new: dict) -> dict:
+    changes = {path: value for path, value in new.items() if path not in old or old[path] != value}
+    removed = [path for path in old if path not in new]
+    for path in removed:
+        if not any(path.startswith(changed + '/') or changed.startswith(path + '/') for changed in changes):
+            changes[path] = None
+    return changes
+
+
+## Publishes a status document as field level changes against the last published document. A full document is
+#  published on the first run, every "resync_cycles" publications and after a failed publication. The last document
+#  is kept in memory and only written to a file after a full publication, every "persist_interval" seconds and by
+#  close(), to spare the flash storage. The file is only used at start when it was written by close() less than
+#  "persist_interval" seconds ago, so a run from cron continues with changes while a daemon that crashed (and may
+#  have published after the last write) starts with a full publication.
+class StatusPublisher:
+    ## Initializes the publisher
+    #  @param path File to keep the last published document in
+    #  @param resync_cycles (optional) Number of publications after which the full document is sent again
+    #  @param persist_interval (optional) Maximum time in seconds between two writes of the file, and the maximum
+    #                          age of the file at start
+    def __init__(self, path: str, resync_cycles: int=60, persist_interval: float=3600.0):
+        self.path = path
+        self.resync_cycles = resync_cycles
+        self.persist_interval = persist_interval
+        self.cycles = 0
+        self.last = None
+        self.__document = None
+        self.__persisted = time.monotonic()
+        try:
+            with open(path, 'r') as fp:
+                stored = json.load(fp)
+            if stored["closed"] and 0 <= time.time() - stored["time"] < persist_interval:
+                self.cycles = stored["cycles"]
+                self.last = flatten(stored["status"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+    ## Returns the value to publish for "document": the full document or a dictionary of changed paths
+    #  @return Tuple of (value, full), value is None if nothing changed
+    def prepare(self, document: dict) -> tuple:
+        if self.last is None or self.cycles >= self.resync_cycles:
+            return document, True
+        changes = diff(self.last, flatten(document))
+        return (changes if changes else None), False
+
+    ## Stores "document" as the last published document
+    #  @param document The complete status document that was published
+    #  @param full True if the complete document was published
+    def published(self, document: dict, full: bool):
+        self.last = flatten(document)
+        self.__document = document
+        self.cycles = 0 if full else self.cycles + 1
+        if full or time.monotonic() - self.__persisted >= self.persist_interval:
+            self.__persist(False)
+
+    ## Forces the next publication to send the full document, for example after a connection loss
+    def resync(self):
+        self.last = None
+        self.__document = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    ## Writes the last published document to the file, to continue with changes on the next start
+    def close(self):
+        if self.__document is not None:
+            self.__persist(True)
+
+    def __persist(self, closed: bool):
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump({"cycles": self.cycles, "time": time.time(), "closed": closed, "status": self.__document}, fp,
+                      separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+        self.__persisted = time.monotonic()
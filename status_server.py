@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+
+# Longest time in seconds that a long-poll request is kept waiting
+MAX_WAIT = 60.0
+
+
+## Request handler, the state is kept on the StatusServer object
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def __reply(self, status: int, body: bytes=b'', etag: str=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        if status == 200:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server.status
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        if path in ('', '/status'):
+            section = None
+        elif path.startswith('/status/'):
+            section = path[len('/status/'):]
+        else:
+            self.__reply(404)
+            return
+        try:
+            wait = min(float(parse_qs(url.query).get('wait', ['0'])[0]), MAX_WAIT)
+        except ValueError:
+            self.__reply(400)
+            return
+        known = self.headers.get('If-None-Match')
+        self.__reply(*server.get(section, known, wait))
+
+
+class UnixStatusServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    # BaseHTTPRequestHandler expects a (host, port) client address
+    def get_request(self):
+        request, address = ThreadingUnixStreamServer.get_request(self)
+        return request, ('local', 0)
+
+
+## Serves the decoded sections of the last cycle over HTTP on a local TCP port or a Unix socket:
+#  "GET /status" returns {"sequence": n, "time": t, "sections": {...}}, "GET /status/<section>" one section.
+#  Every response has an ETag, a request with a matching If-None-Match gets 304. With "?wait=<seconds>" such a
+#  request (or, without If-None-Match, any request) waits until the next change, so clients see changes at once.
+#  Sections are encoded when they are published, requests only copy bytes.
+class StatusServer:
+    ## Initializes the server, call start() to serve
+    #  @param port (optional) TCP port on 127.0.0.1
+    #  @param socket_path (optional) Unix socket, used instead of the TCP port
+    def __init__(self, port: int=None, socket_path: str=None):
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.__server = UnixStatusServer(socket_path, StatusRequestHandler)
+        else:
+            self.__server = ThreadingHTTPServer(('127.0.0.1', port or 0), StatusRequestHandler)
+            self.__server.daemon_threads = True
+        self.__server.status = self
+        self.socket_path = socket_path
+        self.sequence = 0
+        self.__boot = '%x' % int(time.time())
+        self.__sections = {}  # name: (version, encoded section)
+        self.__document = None
+        self.__changed = threading.Condition()
+        self.__stopped = False
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    ## Returns the "host:port" address of the server, or the socket path
+    @property
+    def address(self) -> str:
+        if self.socket_path is not None:
+            return self.socket_path
+        host, port = self.__server.server_address[:2]
+        return host + ':' + str(port)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        with self.__changed:
+            self.__stopped = True
+            self.__changed.notify_all()
+        if self.socket_path is not None:
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    ## Publishes the sections of a cycle, waiting clients are woken up if a section changed
+    #  @param sections Dictionary of section name to JSON serializable section
+    #  @param timestamp (optional) Unix timestamp of the cycle, defaults to now
+    def publish(self, sections: dict, timestamp: float=None):
+        encoded = {name: json.dumps(section, separators=(',', ':')).encode('utf-8')
+                   for name, section in sections.items()}
+        with self.__changed:
+            if (encoded.keys() == self.__sections.keys() and
+                    all(self.__sections[name][1] == text for name, text in encoded.items())):
+                return
+            self.sequence += 1
+            self.__sections = {name: (self.__sections[name][0] if name in self.__sections and
+                                      self.__sections[name][1] == text else self.sequence, text)
+                               for name, text in encoded.items()}
+            self.__document = (('{"sequence":%d,"time":%s,"sections":{' % (
+                self.sequence, json.dumps(time.time() if timestamp is None else timestamp))).encode('utf-8') +
+                b','.join(json.dumps(name).encode('utf-8') + b':' + text
+                          for name, (version, text) in self.__sections.items()) + b'}}')
+            self.__changed.notify_all()
+
+    def __current(self, section: str) -> tuple:
+        if section is None:
+            if self.__document is None:
+                return None, None
+            return self.__document, '"%s-%d"' % (self.__boot, self.sequence)
+        if section not in self.__sections:
+            return None, None
+        version, text = self.__sections[section]
+        return text, '"%s-%s-%d"' % (self.__boot, section, version)
+
+    ## Returns (status, body, etag) for the whole document (section None) or a section: 200 with the body, 304 if
+    #  "known" is the current ETag, 404 for an unknown section or 503 before the first publication. With "wait" the
+    #  call first waits up to that many seconds for a change.
+    def get(self, section: str, known: str=None, wait: float=0.0) -> tuple:
+        deadline = time.monotonic() + wait
+        with self.__changed:
+            body, etag = self.__current(section)
+            # Without an ETag a long-poll waits for the next change of the whole document
+            start = self.sequence
+            while wait > 0 and not self.__stopped and (etag == known if known is not None else self.sequence == start):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__changed.wait(remaining)
+                body, etag = self.__current(section)
+        if etag is None:
+            return (503 if self.__document is None else 404), b'', None
+        if known is not None and etag == known:
+            return 304, b'', etag
+        return 200, body, etag
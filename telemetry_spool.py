@@ -0,0 +1,162 @@
+import os
+import json
+import time
+
+SEGMENT_SUFFIX = '.jsonl'
+CURSOR_FILE = 'cursor'
+
+
+## On-disk, append-only store for telemetry that could not be delivered. Records are appended as JSON lines to
+#  segment files in a spool directory, the oldest segments are deleted when the spool grows beyond its maximum
+#  size. A cursor file remembers how far the backlog has been replayed, so the spool survives process restarts.
+class TelemetrySpool:
+    ## Initializes the spool
+    #  @param path Spool directory, created if it does not exist
+    #  @param max_bytes (optional) Maximum total size of the spool, the oldest records are evicted first
+    #  @param segment_bytes (optional) Size at which a new segment file is started
+    def __init__(self, path: str, max_bytes: int=8 * 1024 * 1024, segment_bytes: int=512 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes)
+        self.evicted = 0
+        self.__fp = None
+        os.makedirs(path, exist_ok=True)
+        self.__cursor = self.__load_cursor()
+
+    def __segments(self) -> list:
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def __segment_file(self, number: int) -> str:
+        return os.path.join(self.path, '%010d' % number + SEGMENT_SUFFIX)
+
+    def __load_cursor(self) -> tuple:
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE), 'r') as fp:
+                segment, offset = fp.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def __save_cursor(self):
+        cursor_file = os.path.join(self.path, CURSOR_FILE)
+        with open(cursor_file + '.tmp', 'w') as fp:
+            fp.write('%d %d\n' % self.__cursor)
+        os.replace(cursor_file + '.tmp', cursor_file)
+
+    ## Closes the open segment file
+    def close(self):
+        if self.__fp is not None:
+            self.__fp.close()
+            self.__fp = None
+
+    ## Returns the total size of the spool in bytes
+    def size(self) -> int:
+        return sum(os.path.getsize(self.__segment_file(number)) for number in self.__segments())
+
+    ## Returns True if there are records that have not been replayed yet
+    def pending(self) -> bool:
+        for number in self.__segments():
+            if number > self.__cursor[0] or (number == self.__cursor[0] and
+                                             os.path.getsize(self.__segment_file(number)) > self.__cursor[1]):
+                return True
+        return False
+
+    ## Appends a record to the spool
+    #  @param kind Kind of record, used by the sender to decide where it goes
+    #  @param data JSON serializable payload
+    #  @param timestamp (optional) Unix timestamp of the record, defaults to now
+    def append(self, kind: str, data, timestamp: int=None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        line = (json.dumps({"t": timestamp, "kind": kind, "data": data}, separators=(',', ':')) + '\n').encode('utf-8')
+        segments = self.__segments()
+        if self.__fp is None or self.__fp.tell() + len(line) > self.segment_bytes:
+            self.close()
+            number = segments[-1] if segments else self.__cursor[0] + 1
+            if segments and os.path.getsize(self.__segment_file(number)) + len(line) > self.segment_bytes:
+                number += 1
+            self.__fp = open(self.__segment_file(number), 'ab')
+        self.__fp.write(line)
+        self.__fp.flush()
+        self.__evict()
+
+    def __evict(self):
+        # Delete the oldest segments (never the one being written) until the spool fits again
+        segments = self.__segments()
+        total = self.size()
+        while total > self.max_bytes and len(segments) > 1:
+            oldest = self.__segment_file(segments.pop(0))
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+            self.evicted += 1
+        if segments and self.__cursor[0] < segments[0]:
+            self.__cursor = (segments[0], 0)
+            self.__save_cursor()
+
+    ## Yields (cursor, record) tuples for the records that have not been replayed yet, where "cursor" is the
+    #  position just after the record
+    def records(self):
+        for number in self.__segments():
+            if number < self.__cursor[0]:
+                continue
+            offset = self.__cursor[1] if number == self.__cursor[0] else 0
+            with open(self.__segment_file(number), 'rb') as fp:
+                fp.seek(offset)
+                for line in fp:
+                    offset += len(line)
+                    if not line.endswith(b'\n'):
+                        # Incomplete record that is still being written (or was cut off by a power loss)
+                        break
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        continue
+                    yield (number, offset), record
+
+    ## Marks all records up to "cursor" as delivered and deletes the segments that were completely replayed
+    def commit(self, cursor: tuple):
+        self.__cursor = cursor
+        for number in self.__segments():
+            if number < cursor[0] or (number == cursor[0] and os.path.getsize(self.__segment_file(number)) <= cursor[1]):
+                if self.__fp is not None and number == cursor[0]:
+                    self.close()
+                os.remove(self.__segment_file(number))
+        self.__save_cursor()
+
+    ## Replays the backlog in batches. Consecutive records of the same kind are merged into one batch by "merge",
+    #  the batches are delivered by "send" and the replay stops at the first batch that could not be delivered.
+    #  A call never waits: it stops after "max_batches" batches or once "budget" seconds were spent, and the next
+    #  call (in the next cycle) continues, so the uplink usage is spread over the cycles.
+    #  @param send Function (kind, data) returning True when the batch was delivered
+    #  @param merge Function (kind, data, data) returning the merged data of two records, or None if they can not
+    #               be merged
+    #  @param max_batches (optional) Maximum number of batches per call
+    #  @param batch_records (optional) Maximum number of records in one batch
+    #  @param budget (optional) Time in seconds after which no further batch is started
+    #  @return True if the complete backlog was delivered
+    def replay(self, send, merge, max_batches: int=4, batch_records: int=500, budget: float=1.0) -> bool:
+        start = time.monotonic()
+        batch = None
+        batches = 0
+        for cursor, record in self.records():
+            if batch is not None:
+                merged = None
+                if batch[0] == record["kind"] and batch[3] < batch_records:
+                    merged = merge(batch[0], batch[1], record["data"])
+                if merged is not None:
+                    batch = (batch[0], merged, cursor, batch[3] + 1)
+                    continue
+                if not send(batch[0], batch[1]):
+                    return False
+                self.commit(batch[2])
+                batches += 1
+                if batches >= max_batches or time.monotonic() - start >= budget:
+                    return False
+            batch = (record["kind"], record["data"], cursor, 1)
+        if batch is None:
+            return True
+        if not send(batch[0], batch[1]):
+            return False
+        self.commit(batch[2])
+        return True
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+
+
+## Writes "data" as JSON to "path" so that the file holds either the old or the new content after a power loss:
+#  the data is written to a temporary file that is synced to disk before it replaces the file
+def write_atomic(path: str, data):
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(data, fp, sort_keys=True, indent=4)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(path + '.tmp', path)
+    try:
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory)
+    except OSError:
+        pass
+    finally:
+        os.close(directory)
+
+
+## Lifetime total of the controller's water pulse counter, which wraps around or resets with a restart of the
+#  controller. The total is kept in memory, every change is appended to a journal and a checkpoint file is written
+#  atomically every "checkpoint_interval" seconds or once the total grew by "checkpoint_delta" pulses. After a
+#  checkpoint the journal is emptied. On start the checkpoint is loaded and the newer journal entries are applied,
+#  so a run from cron only appends a line to the journal. The journal is synced to disk at most every
+#  "journal_sync" seconds and at close(), a power loss can lose the pulses of that time.
+#  An unreadable checkpoint is kept as "<path>.corrupt" for a manual repair. When the journal does not hold the
+#  total either, no checkpoint is written until reset() is called, and a checkpoint never lowers the total of the
+#  previous one.
+class WaterCounter:
+    ## Initializes the counter and recovers the total from the checkpoint and the journal
+    #  @param path Checkpoint file, {"previous": ..., "sum": ..., "sequence": ...}
+    #  @param journal_path (optional) Journal file, defaults to the checkpoint file with ".journal" appended
+    #  @param checkpoint_interval (optional) Maximum time in seconds between two checkpoints
+    #  @param checkpoint_delta (optional) Number of pulses after which a checkpoint is written right away
+    #  @param journal_sync (optional) Maximum time in seconds between two syncs of the journal to disk
+    def __init__(self, path: str, journal_path: str=None, checkpoint_interval: float=300.0,
+                 checkpoint_delta: int=1000, journal_sync: float=60.0):
+        self.path = path
+        self.journal_path = journal_path if journal_path is not None else path + '.journal'
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_delta = checkpoint_delta
+        self.journal_sync = journal_sync
+        self.sum = 0
+        self.previous = 0
+        self.sequence = 0
+        self.__checkpoint = (0, 0)  # sequence and sum of the last checkpoint
+        self.__checkpoint_time = 0.0
+        self.__journal = None
+        self.__journal_synced = 0.0
+        self.unknown = False
+        self.__recover()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __recover(self):
+        corrupt = None
+        try:
+            with open(self.path, 'r') as fp:
+                data = json.load(fp)
+            self.sum = int(data["sum"])
+            self.previous = int(data["previous"])
+            self.sequence = int(data.get("sequence", 0))
+            # The checkpoint age is kept in the file time, so runs from cron also checkpoint at the interval
+            self.__checkpoint_time = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            corrupt = self.path + '.corrupt'
+            if os.path.exists(corrupt):
+                corrupt += '.%d' % time.time()
+            try:
+                os.replace(self.path, corrupt)
+            except OSError:
+                pass
+            print("Water counter checkpoint unreadable, kept as", corrupt + ", recovering from the journal:", ex)
+            self.sum = self.previous = self.sequence = 0
+        self.__checkpoint = (self.sequence, self.sum)
+        try:
+            with open(self.journal_path, 'r') as fp:
+                for line in fp:
+                    # A line that was cut off by a power loss has no newline
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        sequence, total, previous = (int(value) for value in line.split())
+                    except ValueError:
+                        continue
+                    if sequence > self.sequence:
+                        self.sequence, self.sum, self.previous = sequence, total, previous
+        except OSError:
+            pass
+        # Every journal line holds the total, without one the total of the corrupt checkpoint is unknown
+        self.unknown = corrupt is not None and self.sequence == 0
+        if self.unknown:
+            print("Water counter total unknown, no checkpoint is written until it is reset")
+
+    ## Adds the pulses since the previous reading to the total
+    #  @param pulse Current value of the controller's pulse counter
+    #  @return The lifetime total
+    def update(self, pulse: int) -> int:
+        if pulse < self.previous:
+            self.previous = 0
+        if pulse == self.previous:
+            return self.sum
+        self.sum += pulse - self.previous
+        self.previous = pulse
+        self.sequence += 1
+        if self.__journal is None:
+            self.__journal = open(self.journal_path, 'a')
+        self.__journal.write('%d %d %d\n' % (self.sequence, self.sum, self.previous))
+        self.__journal.flush()
+        if time.monotonic() - self.__journal_synced >= self.journal_sync:
+            os.fsync(self.__journal.fileno())
+            self.__journal_synced = time.monotonic()
+        if (self.sum - self.__checkpoint[1] >= self.checkpoint_delta or
+                time.time() - self.__checkpoint_time >= self.checkpoint_interval):
+            self.checkpoint()
+        return self.sum
+
+    ## Writes the checkpoint if anything changed since the last one and empties the journal
+    def checkpoint(self):
+        if self.sequence == self.__checkpoint[0] and os.path.exists(self.path):
+            return
+        if self.unknown:
+            return
+        if self.sum < self.__checkpoint[1]:
+            print("Water counter total", self.sum, "below the checkpoint", self.__checkpoint[1], "not written")
+            return
+        write_atomic(self.path, {"sum": self.sum, "previous": self.previous, "sequence": self.sequence})
+        self.__checkpoint = (self.sequence, self.sum)
+        self.__checkpoint_time = time.time()
+        if self.__journal is not None:
+            self.__journal.close()
+            self.__journal = None
+        # Entries up to the checkpoint are ignored on recovery, so a crash before this point does no harm
+        with open(self.journal_path, 'w'):
+            pass
+
+    ## Sets the total, for example after replacing the controller, and writes the checkpoint at once
+    #  @param total (optional) New lifetime total
+    def reset(self, total: int=0):
+        self.sum = total
+        self.sequence += 1
+        self.unknown = False
+        self.__checkpoint = (self.__checkpoint[0], total)
+        self.checkpoint()
+
+    ## Closes the journal, the changes since the last checkpoint are recovered from it on the next start
+    def close(self):
+        if self.__journal is not None:
+            self.__journal.flush()
+            os.fsync(self.__journal.fileno())
+            self.__journal.close()
+            self.__journal = None